@@ -46,7 +46,7 @@ def iot_service_provisioning_factory(cli_ctx, *_):
     return get_mgmt_service_client(cli_ctx, IotDpsClient)
 
 
-def _bind_sdk(target, sdk_type, device_id=None, auth=None):
+def _bind_sdk(target, sdk_type, device_id=None, auth=None, sessions=None):
     from azext_iot.sdk.device.iot_hub_gateway_device_apis import IotHubGatewayDeviceAPIs
     from azext_iot.sdk.service.iot_hub_gateway_service_apis import IotHubGatewayServiceAPIs
 
@@ -69,8 +69,12 @@ def _bind_sdk(target, sdk_type, device_id=None, auth=None):
         auth = SasTokenAuthentication(sas_uri, target['policy'], target['primarykey'])
 
     if sdk_type is SdkType.device_sdk:
+        client = IotHubGatewayDeviceAPIs(auth, endpoint)
+        if sessions:
+            # Connections are kept alive until the ExitStack `sessions` exits
+            sessions.enter_context(client)
         return (
-            IotHubGatewayDeviceAPIs(auth, endpoint),
+            client,
             _get_sdk_exception_type(sdk_type)
         )
 
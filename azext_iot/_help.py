@@ -63,6 +63,35 @@ helps['iot hub monitor-events'] = """
     - name: Receive all messages and parse message payload as JSON
       text: >
         az iot hub monitor-events -n {iothub_name} --content-type application/json
+    - name: Spread partitions of a busy hub across 4 worker processes
+      text: >
+        az iot hub monitor-events -n {iothub_name} --workers 4
+    - name: Resume from the last received event of each partition across invocations
+      text: >
+        az iot hub monitor-events -n {iothub_name} --cg {consumer_group_name} --checkpoint-dir ~/.iot/checkpoints
+    - name: Receive and write out events in batches of up to 100 per partition with 300 link credit
+      text: >
+        az iot hub monitor-events -n {iothub_name} --batch-size 100 --prefetch 300
+    - name: Write events as newline delimited JSON to gzip compressed files rotated every 100 MiB
+      text: >
+        az iot hub monitor-events -n {iothub_name} --ndjson --output-file events.ndjson --rotate-size 100 --gzip
+    - name: Output a per-device summary of temperature and humidity telemetry every 30 seconds
+      text: >
+        az iot hub monitor-events -n {iothub_name} --aggregate 30 --aggregate-fields temperature humidity
+    - name: Report per-partition throughput and enqueue lag every 10 seconds to a Prometheus text file
+      text: >
+        az iot hub monitor-events -n {iothub_name} --workers 4 --metrics 10 --metrics-file monitor.prom
+    - name: Keep receiving when a slow consumer reads the output, discarding the oldest buffered events
+      text: >
+        az iot hub monitor-events -n {iothub_name} --ndjson --queue-size 5000 --queue-policy drop-oldest | jq .
+    - name: Capture raw events to a compressed file, then replay them offline with their original pacing
+      text: >
+        az iot hub monitor-events -n {iothub_name} --record events.cap.gz
+
+        az iot hub monitor-events --replay events.cap.gz --replay-pace original --properties all
+    - name: Monitor several IoT Hubs from one process, tagging every event with its source hub
+      text: >
+        az iot hub monitor-events -n {iothub_name} --hubs {iothub_name_2} {iothub_name_3} --ndjson
 """
 
 helps['iot hub monitor-feedback'] = """
@@ -86,6 +115,12 @@ helps['iot hub monitor-feedback'] = """
     - name: Exit feedback monitor upon receiving a message with specific id (uuid)
       text: >
         az iot hub monitor-feedback -n {iothub_name} -d {device_id} -w {message_id}
+    - name: Wait up to 5 minutes on feedback of several messages and output the outcome of each
+      text: >
+        az iot hub monitor-feedback -n {iothub_name} -w {message_id} {message_id_2} --timeout 300
+    - name: Write feedback as newline delimited JSON to a file
+      text: >
+        az iot hub monitor-feedback -n {iothub_name} --ndjson --output-file feedback.ndjson
 """
 
 helps['iot hub device-identity'] = """
@@ -552,10 +587,83 @@ helps['iot device c2d-message send'] = """
         az iot device c2d-message send -d {device_id} -n {iothub_name} --wait
 """
 
+helps['iot device c2d-message send-batch'] = """
+    type: command
+    short-summary: Send many cloud-to-device messages over pooled connections.
+    long-summary: |
+                  EXPERIMENTAL requires Python 3.5+
+                  This command relies on and may install dependent Cython package (uamqp) upon first execution.
+                  https://github.com/Azure/azure-uamqp-python
+                  Messages are read from a newline delimited JSON file, one record per line, e.g.
+                  {"deviceId": "dev1", "data": {"cmd": "reboot"}, "properties": {"k": "v"}, "ack": "full"}
+                  The output holds the send state of every message and the overall throughput.
+    examples:
+    - name: Send all messages of a file over 4 connections
+      text: >
+        az iot device c2d-message send-batch -n {iothub_name} --input-file messages.ndjson --clients 4
+    - name: Send messages and wait up to 10 minutes on their feedback
+      text: >
+        az iot device c2d-message send-batch -n {iothub_name} --input-file messages.ndjson --wait --timeout 600
+"""
+
+helps['iot device c2d-message purge'] = """
+    type: command
+    short-summary: Purge the cloud-to-device message queue of one device or a fleet of devices.
+    long-summary: |
+                  Queues are purged concurrently. Progress is written to stderr and the output
+                  holds the number of purged devices and messages and every failed device.
+    examples:
+    - name: Purge the C2D queue of a device
+      text: >
+        az iot device c2d-message purge -n {iothub_name} -d {device_id}
+    - name: Purge the C2D queues of all devices matching a query with 16 concurrent requests
+      text: >
+        az iot device c2d-message purge -n {iothub_name} -q "select deviceId from devices where tags.campaign = 'c1'" -w 16
+    - name: Purge the C2D queues of the devices listed in a file
+      text: >
+        az iot device c2d-message purge -n {iothub_name} --id-file devices.txt
+"""
+
+helps['iot device simulate-fleet'] = """
+    type: command
+    short-summary: Simulate a fleet of devices sending device-to-cloud messages from one process.
+    long-summary: |
+                  Every device holds its own MQTT connection and publishes at QoS 1 at its own rate,
+                  paced by its own schedule so a slow or reconnecting device does not delay the others.
+                  A device that falls behind resumes at its rate instead of bursting to catch up,
+                  missed send slots are counted in skippedSlots.
+                  All connections are driven by a single event loop, so thousands of devices can be
+                  simulated from one CLI call. The devices must exist in the IoT Hub.
+                  Progress is written to stderr. The output holds the aggregate publish throughput
+                  and PUBACK latency percentiles.
+    examples:
+    - name: Simulate 500 devices named sim0 to sim499, each sending 60 messages every 2 seconds
+      text: >
+        az iot device simulate-fleet -n {iothub_name} --device-prefix sim --device-count 500 --mc 60 --mi 2
+    - name: Simulate the devices returned by a query, each sending 5 messages per second
+      text: >
+        az iot device simulate-fleet -n {iothub_name} -q "select deviceId from devices where tags.sim = true" --mi 0.2
+    - name: Simulate a list of devices
+      text: >
+        az iot device simulate-fleet -n {iothub_name} --device-ids {device_id} {device_id_2} --mc 10
+    - name: Simulate 100 devices reporting a temperature random walk
+      text: >
+        az iot device simulate-fleet -n {iothub_name} --device-prefix sim --device-count 100
+        --template '{"device": "{{deviceId}}", "temp": {{walk:21:0.2:15:30:1}}, "humidity": {{random:40:60}}}'
+"""
+
 helps['iot device send-d2c-message'] = """
     type: command
-    short-summary: Send an mqtt device-to-cloud message.
-    long-summary: Supports application and system properties to send with message.
+    short-summary: Send mqtt or batched https device-to-cloud messages.
+    long-summary: |
+                  Supports application and system properties to send with message.
+                  Messages are published at QoS 1 over one connection, keeping up to --max-inflight
+                  messages awaiting acknowledgement at once. The output holds the achieved throughput
+                  and PUBACK latency percentiles. The command fails when any message is left
+                  unacknowledged.
+                  With --protocol http, messages are packed into batched requests of up to 256 KB,
+                  or --batch-size messages, over port 443. The output then holds request latency
+                  percentiles per batch.
     examples:
     - name: Basic usage
       text: az iot device send-d2c-message -n {iothub_name} -d {device_id}
@@ -565,6 +673,14 @@ helps['iot device send-d2c-message'] = """
       text: az iot device send-d2c-message -n {iothub_name} -d {device_id} --props 'key0=value0;key1=value1'
     - name: Send system properties (Message Id and Correlation Id)
       text: az iot device send-d2c-message -n {iothub_name} -d {device_id} --props '$.mid=<id>;$.cid=<id>'
+    - name: Send 50000 messages with up to 200 awaiting acknowledgement
+      text: az iot device send-d2c-message -n {iothub_name} -d {device_id} --mc 50000 --mif 200
+    - name: Send 1000 numbered messages rendered from a payload template
+      text: >
+        az iot device send-d2c-message -n {iothub_name} -d {device_id} --mc 1000
+        --template '{"seq": {{counter}}, "ts": "{{timestamp}}", "temp": {{walk:21:0.2:15:30:1}}}'
+    - name: Send 10000 messages over https in batches of up to 500 messages
+      text: az iot device send-d2c-message -n {iothub_name} -d {device_id} --mc 10000 --protocol http --batch-size 500
 """
 
 helps['iot device simulate'] = """
@@ -574,6 +690,10 @@ helps['iot device simulate'] = """
                   and acknowledge cloud-to-device (c2d) messages. For mqtt simulation, all c2d messages will
                   be acknowledged with completion. For http simulation c2d acknowledgement is based on user
                   selection which can be complete, reject or abandon.
+                  Messages are sent on an absolute timeline, so the time spent sending does not
+                  add to the interval. The output compares the achieved with the requested rate.
+                  With --batch-size (http only), messages are buffered as they fall due and sent
+                  in batched requests once --batch-size messages are pending.
     examples:
     - name: Basic usage (mqtt).
       text: az iot device simulate -n {iothub_name} -d {device_id}
@@ -585,6 +705,14 @@ helps['iot device simulate'] = """
       text: az iot device simulate -n {iothub_name} -d {device_id} --rs {reject}
     - name: Abandon c2d messages (http only)
       text: az iot device simulate -n {iothub_name} -d {device_id} --rs {abandon}
+    - name: Send 20 messages per second, ramping up over the first minute.
+      text: az iot device simulate -n {iothub_name} -d {device_id} --msg-count 5000 --msg-rate 20 --ramp-up 60
+    - name: Send bursts of up to 10 messages at an average of one message every 0.5 seconds.
+      text: az iot device simulate -n {iothub_name} -d {device_id} --msg-interval 0.5 --burst 10
+    - name: Send sensor readings rendered from a payload template file.
+      text: az iot device simulate -n {iothub_name} -d {device_id} --mi 0.1 --template ./telemetry.json
+    - name: Buffer 100 messages per second and send them over https in batches of 50.
+      text: az iot device simulate -n {iothub_name} -d {device_id} --protocol http --msg-rate 100 --batch-size 50
 """
 
 helps['iot device upload-file'] = """
@@ -1107,6 +1235,12 @@ helps['iot dt monitor-events'] = """
         az iot dt monitor-events --login {iothub_cs} --device-id {device_id}
         --interface {plug_and_play_interface} --consumer-group {consumer_group_name}
         --properties all --source private -r {pnp_repository}
+    - name: Summarize telemetry per device and interface every 60 seconds.
+      text: >
+        az iot dt monitor-events --hub-name {iothub_name} --source public --aggregate 60
+    - name: Monitor a device's telemetry with values converted to their schema types and enum names.
+      text: >
+        az iot dt monitor-events --hub-name {iothub_name} --device-id {device_id} --source device --typed-telemetry
 """
 
 helps['iot dt update-property'] = """
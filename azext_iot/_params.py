@@ -42,6 +42,103 @@ event_msg_prop_type = CLIArgumentType(
     'sys = system properties, app = application properties, anno = annotations'
 )
 
+monitor_ndjson_type = CLIArgumentType(
+    overrides=get_three_state_flag(),
+    options_list=['--ndjson'],
+    arg_group='Monitor Output',
+    help='Write each monitored event as compact single line JSON (newline delimited JSON).'
+)
+
+monitor_output_file_type = CLIArgumentType(
+    options_list=['--output-file', '--of'],
+    arg_group='Monitor Output',
+    help='Write monitored events to this file instead of stdout. Writes are buffered.'
+)
+
+monitor_rotate_size_type = CLIArgumentType(
+    options_list=['--rotate-size'],
+    arg_group='Monitor Output',
+    type=int,
+    help='Rotate --output-file after it reaches this size in MiB. Up to 5 rotated files are kept.'
+)
+
+monitor_gzip_type = CLIArgumentType(
+    overrides=get_three_state_flag(),
+    options_list=['--gzip'],
+    arg_group='Monitor Output',
+    help='Gzip compress --output-file.'
+)
+
+monitor_aggregate_type = CLIArgumentType(
+    options_list=['--aggregate'],
+    arg_group='Monitor Aggregation',
+    type=int,
+    help='Window in seconds. Instead of every event, output one per-device summary of event count, '
+    'bytes and numeric payload field min/max/mean per window.'
+)
+
+monitor_aggregate_fields_type = CLIArgumentType(
+    options_list=['--aggregate-fields', '--af'],
+    arg_group='Monitor Aggregation',
+    nargs='+',
+    help='Space-separated numeric payload fields to summarize with --aggregate. '
+    'Use "." for nested fields. If omitted all top level numeric fields are summarized.'
+)
+
+monitor_metrics_type = CLIArgumentType(
+    options_list=['--metrics'],
+    arg_group='Monitor Metrics',
+    type=int,
+    help='Interval in seconds to report per-partition throughput, enqueue lag (p50/p99) and time spent '
+    'filtering, decoding and writing events. Reports go to stderr unless --metrics-file is provided. '
+    'With --replay, enqueue lag is measured against the recorded receive time of each event.'
+)
+
+monitor_metrics_file_type = CLIArgumentType(
+    options_list=['--metrics-file', '--mf'],
+    arg_group='Monitor Metrics',
+    help='Prometheus text format file rewritten every --metrics interval. '
+    'With --workers each worker writes its own file, suffixed by worker index.'
+)
+
+monitor_queue_size_type = CLIArgumentType(
+    options_list=['--queue-size', '--qs'],
+    arg_group='Monitor Output',
+    type=int,
+    help='Maximum number of rendered events buffered between the partition receivers and the output writer. '
+    'Default: 1024.'
+)
+
+monitor_queue_policy_type = CLIArgumentType(
+    options_list=['--queue-policy', '--qp'],
+    arg_group='Monitor Output',
+    overrides=get_enum_type(['block', 'drop-oldest', 'sample']),
+    help='Behavior when the output queue is full. block pauses receiving (no events lost), '
+    'drop-oldest discards the oldest queued events and sample keeps 1 in 10 events once the queue is half full. '
+    'Default: block.'
+)
+
+monitor_record_type = CLIArgumentType(
+    options_list=['--record'],
+    arg_group='Monitor Capture',
+    help='Capture raw received events (body, annotations, system and application properties, partition) '
+    'to this file for later --replay. Use a ".gz" or ".zst" (requires zstandard) extension to compress.'
+)
+
+monitor_replay_type = CLIArgumentType(
+    options_list=['--replay'],
+    arg_group='Monitor Capture',
+    help='Replay a file captured with --record through the monitor filters and output instead of '
+    'connecting to the hub.'
+)
+
+monitor_replay_pace_type = CLIArgumentType(
+    options_list=['--replay-pace'],
+    arg_group='Monitor Capture',
+    overrides=get_enum_type(['fast', 'original']),
+    help='Replay as fast as possible or with the original spacing between events. Default: fast.'
+)
+
 
 def load_arguments(self, _):
     """
@@ -89,6 +186,10 @@ def load_arguments(self, _):
                          help='Reinstall uamqp dependency compatible with extension version. Default: false')
         context.argument('repo_endpoint', options_list=['--endpoint', '-e'], help='IoT Plug and Play endpoint.')
         context.argument('repo_id', options_list=['--repo-id', '-r'], help='IoT Plug and Play repository Id.')
+        context.argument('ndjson', arg_type=monitor_ndjson_type)
+        context.argument('output_file', arg_type=monitor_output_file_type)
+        context.argument('rotate_size', arg_type=monitor_rotate_size_type)
+        context.argument('compress', arg_type=monitor_gzip_type)
 
     with self.argument_context('iot hub') as context:
         context.argument('target_json', options_list=['--json', '-j'],
@@ -123,10 +224,43 @@ def load_arguments(self, _):
         context.argument('content_type', options_list=['--content-type', '--ct'],
                          help='Specify the Content-Type of the message payload to automatically format the output to that type.')
         context.argument('device_query', options_list=['--device-query', '-q'], help='Specify a custom query to filter devices.')
+        context.argument('workers', options_list=['--workers', '-w'], type=int,
+                         help='Number of worker processes to spread Event Hub partitions across. '
+                         'Each worker uses its own AMQP connection. Output from all workers is merged into one stream. '
+                         'Cannot be combined with --aggregate or --record. '
+                         'If omitted all partitions are monitored in a single process.')
+        context.argument('checkpoint_dir', options_list=['--checkpoint-dir', '--cd'],
+                         help='Local directory used to persist the last received offset of each partition '
+                         'per consumer group. When a checkpoint exists for a partition, monitoring resumes '
+                         'right after it and --enqueued-time is ignored for that partition.')
+        context.argument('prefetch', options_list=['--prefetch'], type=int,
+                         help='Link credit granted to each partition receiver. '
+                         'Higher values avoid a credit round-trip per message. '
+                         'Defaults to --batch-size in batch mode, otherwise 0.')
+        context.argument('batch_size', options_list=['--batch-size', '--bs'], type=int,
+                         help='Enable batch receive. Up to this many events per partition are received, '
+                         'processed and written out in one pass. Must not exceed --prefetch.')
+        context.argument('aggregate', arg_type=monitor_aggregate_type)
+        context.argument('aggregate_fields', arg_type=monitor_aggregate_fields_type)
+        context.argument('metrics', arg_type=monitor_metrics_type)
+        context.argument('metrics_file', arg_type=monitor_metrics_file_type)
+        context.argument('queue_size', arg_type=monitor_queue_size_type)
+        context.argument('queue_policy', arg_type=monitor_queue_policy_type)
+        context.argument('record', arg_type=monitor_record_type)
+        context.argument('replay', arg_type=monitor_replay_type)
+        context.argument('replay_pace', arg_type=monitor_replay_pace_type)
+        context.argument('hubs', options_list=['--hubs'], nargs='+',
+                         help='Space-separated names or connection strings of additional IoT Hubs to monitor '
+                         'in the same process. Every event is tagged with the name of its source hub. '
+                         'Hubs given by name are looked up across the subscription.')
 
     with self.argument_context('iot hub monitor-feedback') as context:
-        context.argument('wait_on_id', options_list=['--wait-on-msg', '-w'],
-                         help='Feedback monitor will block until a message with specific id (uuid) is received.')
+        context.argument('wait_on_id', options_list=['--wait-on-msg', '-w'], nargs='+',
+                         help='Feedback monitor will block until feedback of every space-separated message id (uuid) '
+                         'is received, then output the outcome of each message.')
+        context.argument('timeout', options_list=['--timeout', '--to', '-t'], type=int,
+                         help='Maximum seconds to wait on feedback of the messages given by --wait-on-msg. '
+                         'Messages without feedback are reported with a Timeout outcome. If omitted wait indefinitely.')
 
     with self.argument_context('iot hub device-identity') as context:
         context.argument('edge_enabled', options_list=['--edge-enabled', '--ee'],
@@ -224,6 +358,45 @@ def load_arguments(self, _):
         context.argument('protocol_type', options_list=['--protocol', '--proto'],
                          arg_type=get_enum_type(ProtocolType),
                          help='Indicates device-to-cloud message protocol')
+        context.argument('template', options_list=['--template', '--tpl'],
+                         help='Message payload template, inline or as a file path. Placeholders are rendered '
+                         'per message: {{counter}}, {{timestamp}}, {{deviceId}}, {{uuid}}, '
+                         '{{random:min:max[:decimals]}}, {{randint:min:max}} and '
+                         '{{walk:start:step[:min:max[:decimals]]}}. Overrides --data.')
+        context.argument('batch_size', options_list=['--batch-size', '--bs'], type=int,
+                         help='Maximum number of messages sent in one batched HTTPS request. Batches are '
+                         'also limited to 256 KB. Supported with HTTP only.')
+
+    with self.argument_context('iot device simulate') as context:
+        context.argument('msg_interval', options_list=['--msg-interval', '--mi'], type=float,
+                         help='Delay in seconds between device-to-cloud messages. Fractions are allowed. Default: 3.')
+        context.argument('msg_rate', options_list=['--msg-rate', '--mr'], type=float,
+                         help='Device-to-cloud messages per second. Alternative to --msg-interval.')
+        context.argument('burst', options_list=['--burst'], type=int,
+                         help='Number of messages that may be sent back to back, at start or to catch up '
+                         'after a delay. Missed messages beyond the burst are skipped.')
+        context.argument('ramp_up', options_list=['--ramp-up'], type=float,
+                         help='Seconds over which the message rate grows linearly from 0 to the requested rate.')
+
+    with self.argument_context('iot device send-d2c-message') as context:
+        context.argument('max_inflight', options_list=['--max-inflight', '--mif'], type=int,
+                         help='Number of published messages that may await acknowledgement at once. Default: 64.')
+
+    with self.argument_context('iot device simulate-fleet') as context:
+        context.argument('device_query', options_list=['--device-query', '-q'],
+                         help='Simulate every device returned by this IoT Hub query.')
+        context.argument('device_ids', options_list=['--device-ids', '--ids'], nargs='+',
+                         help='Space-separated Ids of the devices to simulate.')
+        context.argument('device_prefix', options_list=['--device-prefix', '--dp'],
+                         help='Simulate the devices named by this prefix followed by 0 to --device-count - 1.')
+        context.argument('device_count', options_list=['--device-count', '--dc'], type=int,
+                         help='Number of devices to simulate with --device-prefix.')
+        context.argument('msg_count', options_list=['--msg-count', '--mc'], type=int,
+                         help='Number of device-to-cloud messages each device sends.')
+        context.argument('msg_interval', options_list=['--msg-interval', '--mi'], type=float,
+                         help='Seconds between the messages of each device. Fractions are allowed.')
+        context.argument('connect_concurrency', options_list=['--connect-concurrency', '--cc'], type=int,
+                         help='Number of devices connecting at the same time. Default: 32.')
 
     with self.argument_context('iot device c2d-message') as context:
         context.argument('ack', options_list=['--ack'], arg_type=get_enum_type(AckType),
@@ -241,7 +414,33 @@ def load_arguments(self, _):
     with self.argument_context('iot device c2d-message send') as context:
         context.argument('wait_on_feedback', options_list=['--wait', '-w'],
                          arg_type=get_three_state_flag(),
-                         help='If set the c2d send operation will block until device feedback has been received.')
+                         help='If set the c2d send operation will block until device feedback has been received, '
+                         'then output the feedback outcome and its latency.')
+
+    with self.argument_context('iot device c2d-message send-batch') as context:
+        context.argument('input_file', options_list=['--input-file', '--if'],
+                         help='Newline delimited JSON file with one message record per line. Records have a '
+                         '"deviceId" and optionally "data", "properties" (object), "correlationId", "messageId" '
+                         'and "ack" (full, positive, negative or none).')
+        context.argument('clients', options_list=['--clients'], type=int,
+                         help='Number of AMQP connections messages are spread across. Transfers on each '
+                         'connection are pipelined. Default: 1, maximum 16.')
+        context.argument('wait_on_feedback', options_list=['--wait', '-w'],
+                         arg_type=get_three_state_flag(),
+                         help='If set the command listens on feedback before sending and blocks until feedback '
+                         'of every message requesting an ack has been received.')
+        context.argument('timeout', options_list=['--timeout', '--to', '-t'], type=int,
+                         help='Maximum seconds to wait on feedback. Messages without feedback are reported '
+                         'with a Timeout outcome. If omitted wait indefinitely.')
+
+    with self.argument_context('iot device c2d-message purge') as context:
+        context.argument('device_query', options_list=['--device-query', '-q'],
+                         help='Purge the C2D queues of every device returned by this IoT Hub query.')
+        context.argument('id_file', options_list=['--id-file'],
+                         help='Purge the C2D queues of the devices listed in this file, one device Id per line.')
+        context.argument('workers', options_list=['--workers', '-w'], type=int,
+                         help='Number of concurrent purge requests. Throttled requests are retried '
+                         'after a backoff that pauses every worker. Default: 8, maximum 32.')
 
     with self.argument_context('iot device upload-file') as context:
         context.argument('file_path', options_list=['--file-path', '--fp'],
@@ -395,6 +594,10 @@ def load_arguments(self, _):
         context.argument('properties', options_list=['--properties', '--props', '-p'], arg_type=event_msg_prop_type)
         context.argument('content_type', options_list=['--content-type', '--ct'],
                          help='Specify the Content-Type of the message payload to automatically format the output to that type.')
+        context.argument('ndjson', arg_type=monitor_ndjson_type)
+        context.argument('output_file', arg_type=monitor_output_file_type)
+        context.argument('rotate_size', arg_type=monitor_rotate_size_type)
+        context.argument('compress', arg_type=monitor_gzip_type)
         context.argument('repair', options_list=['--repair', '-r'],
                          arg_type=get_three_state_flag(),
                          help='Reinstall uamqp dependency compatible with extension version. Default: false')
@@ -453,6 +656,20 @@ def load_arguments(self, _):
                          help='Reinstall uamqp dependency compatible with extension version. Default: false')
         context.argument('device_query', options_list=['--device-query', '-q'],
                          help='Specify a custom query to filter devices.')
+        context.argument('aggregate', arg_type=monitor_aggregate_type)
+        context.argument('aggregate_fields', arg_type=monitor_aggregate_fields_type)
+        context.argument('metrics', arg_type=monitor_metrics_type)
+        context.argument('metrics_file', arg_type=monitor_metrics_file_type)
+        context.argument('queue_size', arg_type=monitor_queue_size_type)
+        context.argument('queue_policy', arg_type=monitor_queue_policy_type)
+        context.argument('record', arg_type=monitor_record_type)
+        context.argument('replay', arg_type=monitor_replay_type)
+        context.argument('replay_pace', arg_type=monitor_replay_pace_type)
+        context.argument('typed_telemetry', options_list=['--typed-telemetry', '--tt'],
+                         arg_type=get_three_state_flag(),
+                         help='Convert telemetry values to the type declared by their interface schema. '
+                         'Numeric and boolean values sent as strings are parsed and enum values are '
+                         'replaced by their enum name. Default: false')
 
     with self.argument_context('iot pnp') as context:
         context.argument('model', options_list=['--model', '-m'],
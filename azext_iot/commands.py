@@ -90,6 +90,7 @@ def load_command_table(self, _):
     with self.command_group('iot device', command_type=iothub_ops) as cmd_group:
         cmd_group.command('send-d2c-message', 'iot_device_send_message')
         cmd_group.command('simulate', 'iot_simulate_device')
+        cmd_group.command('simulate-fleet', 'iot_simulate_fleet')
         cmd_group.command('upload-file', 'iot_device_upload_file')
 
     with self.command_group('iot device c2d-message', command_type=iothub_ops) as cmd_group:
@@ -98,6 +99,8 @@ def load_command_table(self, _):
         cmd_group.command('reject', 'iot_c2d_message_reject')
         cmd_group.command('receive', 'iot_c2d_message_receive')
         cmd_group.command('send', 'iot_c2d_message_send')
+        cmd_group.command('send-batch', 'iot_c2d_message_send_batch')
+        cmd_group.command('purge', 'iot_c2d_message_purge')
 
     with self.command_group('iot dps enrollment', command_type=iotdps_ops) as cmd_group:
         cmd_group.command('create', 'iot_dps_device_enrollment_create')
@@ -0,0 +1,246 @@
+# coding=utf-8
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+"""
+payload_template: Precompiled message payload templates.
+
+A template is parsed once into literal byte segments and placeholder fields. Rendering a
+message fills the field slots of a prebuilt segment list and joins it, so no dict is built
+or serialized per message. Random values are drawn in batches.
+
+Placeholders:
+    {{counter}}                                 message number, starting at 1
+    {{timestamp}}                               UTC ISO 8601 time with milliseconds
+    {{deviceId}}                                device Id, resolved when a renderer is bound
+    {{uuid}}                                    random version 4 UUID
+    {{random:min:max[:decimals]}}               uniform random number, 2 decimals by default
+    {{randint:min:max}}                         uniform random integer, bounds included
+    {{walk:start:step[:min:max[:decimals]]}}    random walk moving up to `step` per message
+"""
+
+import json
+import re
+from itertools import accumulate, chain, count
+from random import Random
+from time import gmtime, strftime, time
+
+# Random values drawn at once per field
+RANDOM_BATCH_SIZE = 256
+
+PLACEHOLDER = re.compile(r"\{\{\s*(\w+)((?::[^:}]*)*)\s*\}\}")
+
+
+class _Field(object):
+    """ Placeholder field. `renderer` returns a callable producing the bytes of the next message. """
+
+    def renderer(self, rand, device_id):
+        raise NotImplementedError()
+
+
+class _Counter(_Field):
+    def renderer(self, rand, device_id):
+        numbers = count(1)
+        return lambda: b"%d" % next(numbers)
+
+
+class _Timestamp(_Field):
+    def renderer(self, rand, device_id):
+        cache = [None, b""]
+
+        def render():
+            now = time()
+            second = int(now)
+            if second != cache[0]:
+                cache[0] = second
+                cache[1] = strftime("%Y-%m-%dT%H:%M:%S", gmtime(second)).encode()
+            return cache[1] + b".%03dZ" % int((now - second) * 1000)
+
+        return render
+
+
+class _DeviceId(_Field):
+    def renderer(self, rand, device_id):
+        value = json.dumps(device_id or "")[1:-1].encode()
+        return lambda: value
+
+
+def _batched(draw):
+    """ Returns a callable yielding values of `draw(n)` batches one at a time. """
+    state = [iter(())]
+
+    def render():
+        value = next(state[0], None)
+        if value is None:
+            state[0] = iter(draw(RANDOM_BATCH_SIZE))
+            value = next(state[0])
+        return value
+
+    return render
+
+
+class _Uuid(_Field):
+    VERSION_MASK = ~(0xF000 << 64) & ~(0xC000 << 48)
+    VERSION_BITS = (0x4000 << 64) | (0x8000 << 48)
+
+    def renderer(self, rand, device_id):
+        mask, bits = self.VERSION_MASK, self.VERSION_BITS
+
+        def draw(n):
+            hexes = [b"%032x" % (rand.getrandbits(128) & mask | bits) for _ in range(n)]
+            return [b"-".join((h[:8], h[8:12], h[12:16], h[16:20], h[20:])) for h in hexes]
+
+        return _batched(draw)
+
+
+class _Random(_Field):
+    def __init__(self, low, high, decimals=2):
+        self.low = float(low)
+        self.high = float(high)
+        self.format = b"%." + str(int(decimals)).encode() + b"f"
+
+    def renderer(self, rand, device_id):
+        low, span, fmt = self.low, self.high - self.low, self.format
+        return _batched(lambda n: [fmt % (low + span * rand.random()) for _ in range(n)])
+
+
+class _RandInt(_Field):
+    def __init__(self, low, high):
+        self.low = int(low)
+        self.high = int(high)
+
+    def renderer(self, rand, device_id):
+        low, high = self.low, self.high
+        return _batched(lambda n: [b"%d" % rand.randint(low, high) for _ in range(n)])
+
+
+class _Walk(_Field):
+    def __init__(self, start, step, low=None, high=None, decimals=2):
+        self.start = float(start)
+        self.step = float(step)
+        self.low = float(low) if low not in (None, "") else float("-inf")
+        self.high = float(high) if high not in (None, "") else float("inf")
+        self.format = b"%." + str(int(decimals)).encode() + b"f"
+
+    def renderer(self, rand, device_id):
+        low, high, step, fmt = self.low, self.high, self.step, self.format
+        position = [min(high, max(low, self.start))]
+
+        def move(value, delta):
+            return min(high, max(low, value + delta))
+
+        def draw(n):
+            deltas = [step * (2 * rand.random() - 1) for _ in range(n - 1)]
+            values = list(accumulate(chain(position, deltas), move))
+            position[0] = move(values[-1], step * (2 * rand.random() - 1))
+            return [fmt % value for value in values]
+
+        return _batched(draw)
+
+
+FIELDS = {
+    "counter": (_Counter, 0, 0),
+    "timestamp": (_Timestamp, 0, 0),
+    "deviceid": (_DeviceId, 0, 0),
+    "uuid": (_Uuid, 0, 0),
+    "random": (_Random, 2, 3),
+    "randint": (_RandInt, 2, 2),
+    "walk": (_Walk, 2, 5),
+}
+
+
+def _compile_field(name, args):
+    spec = FIELDS.get(name.lower())
+    if not spec:
+        raise ValueError("Unknown template placeholder '{}'.".format(name))
+    field_type, min_args, max_args = spec
+    if not min_args <= len(args) <= max_args:
+        raise ValueError(
+            "Template placeholder '{}' takes {} to {} arguments.".format(name, min_args, max_args)
+        )
+    try:
+        return field_type(*args)
+    except ValueError:
+        raise ValueError("Invalid arguments for template placeholder '{}': {}.".format(name, ":".join(args)))
+
+
+class PayloadTemplate(object):
+    """
+    Compiled payload template.
+
+    Args:
+        parts (list): literal str segments and placeholder fields in order.
+    """
+
+    def __init__(self, parts):
+        self.parts = []
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode("utf8")
+            if isinstance(part, bytes) and self.parts and isinstance(self.parts[-1], bytes):
+                self.parts[-1] += part
+            elif part != b"":
+                self.parts.append(part)
+
+    @property
+    def static(self):
+        return all(isinstance(part, bytes) for part in self.parts)
+
+    def renderer(self, device_id=None, seed=None):
+        """ Returns a callable rendering the next message of one device as bytes. """
+        if self.static:
+            payload = b"".join(self.parts)
+            return lambda: payload
+
+        rand = Random(seed)
+        segments = []
+        slots = []
+        for part in self.parts:
+            if isinstance(part, bytes):
+                segments.append(part)
+            else:
+                slots.append((len(segments), part.renderer(rand, device_id)))
+                segments.append(b"")
+        join = b"".join
+
+        def render():
+            for index, field in slots:
+                segments[index] = field()
+            return join(segments)
+
+        return render
+
+    def render(self, msg_count, device_id=None, seed=None):
+        """ Lazily renders `msg_count` messages of one device. """
+        render = self.renderer(device_id, seed)
+        for _ in range(msg_count):
+            yield render()
+
+
+def compile_template(text):
+    """
+    Compiles template text.
+
+    Raises:
+        ValueError: when a placeholder is unknown or has invalid arguments.
+    """
+    parts = []
+    position = 0
+    for match in PLACEHOLDER.finditer(text):
+        parts.append(text[position:match.start()])
+        args = match.group(2).split(":")[1:] if match.group(2) else []
+        parts.append(_compile_field(match.group(1), args))
+        position = match.end()
+    parts.append(text[position:])
+    return PayloadTemplate(parts)
+
+
+def default_template(data, device_id=False):
+    """ Simulation payload with a message Id, timestamp, optional device Id and numbered `data`. """
+    parts = ['{"id": "', _Uuid(), '", "timestamp": "', _Timestamp(), '"']
+    if device_id:
+        parts.extend([', "deviceId": "', _DeviceId(), '"'])
+    parts.extend([', "data": ', json.dumps(data + " #")[:-1], _Counter(), '"}'])
+    return PayloadTemplate(parts)
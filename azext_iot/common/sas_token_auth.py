@@ -12,6 +12,7 @@ sas_token_auth: Module containing Shared Access Signature token class.
 from base64 import b64encode, b64decode
 from hashlib import sha256
 from hmac import HMAC
+from threading import Lock
 from time import time
 try:
     from urllib import (urlencode, quote_plus)
@@ -39,27 +40,54 @@ class SasTokenAuthentication(Authentication):
             self.expiry = time() + 3600  # Default expiry is an hour later
         else:
             self.expiry = expiry
+        # (key, token) pair replaced in one assignment, so threads sharing the instance never
+        # pair a token with another expiry
+        self._signed = (None, None)
+        self._renew_lock = Lock()
 
-    def signed_session(self):
+    def signed_session(self, session=None):
         """
         Create requests session with SAS auth headers.
 
+        Args:
+            session (requests.Session): existing session to sign, a new one is created if omitted.
+
         Returns:
             session (): requests.Session.
         """
-        session = super(SasTokenAuthentication, self).signed_session()
+        session = super(SasTokenAuthentication, self).signed_session(session)
         session.headers['Authorization'] = self.generate_sas_token()
         return session
 
+    def renew(self, duration, margin):
+        """
+        Extends the expiry to `duration` seconds from now when less than `margin` seconds are left.
+        Safe to call from several threads sharing the instance.
+
+        Returns:
+            result (bool): whether the expiry was extended.
+        """
+        with self._renew_lock:
+            now = time()
+            if self.expiry - now >= margin:
+                return False
+            self.expiry = now + duration
+            return True
+
     def generate_sas_token(self):
         """
         Create a shared access signiture token as a string literal.
+        The token is signed once and reused until the uri, policy, key or expiry change.
 
         Returns:
             result (str): SAS token as string literal.
         """
-        encoded_uri = quote_plus(self.uri)
         ttl = int(self.expiry)
+        key = (self.uri, self.policy, self.key, ttl)
+        signed_key, token = self._signed
+        if token and signed_key == key:
+            return token
+        encoded_uri = quote_plus(self.uri)
         sign_key = '%s\n%d' % (encoded_uri, ttl)
         signature = b64encode(HMAC(b64decode(self.key), sign_key.encode('utf-8'), sha256).digest())
 
@@ -72,7 +100,9 @@ class SasTokenAuthentication(Authentication):
         if self.policy:
             result['skn'] = self.policy
 
-        return 'SharedAccessSignature ' + urlencode(result)
+        token = 'SharedAccessSignature ' + urlencode(result)
+        self._signed = (key, token)
+        return token
 
 
 class BasicSasTokenAuthentication(Authentication):
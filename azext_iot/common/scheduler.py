@@ -0,0 +1,127 @@
+# coding=utf-8
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+"""
+scheduler: Drift free send rate scheduling.
+
+Send times are derived from the start of the schedule instead of the previous send, so the
+time spent sending never accumulates into the interval. Tokens accrue along the rate profile
+into a bucket of `burst` messages, which bounds how many messages are sent back to back at
+start or to catch up after a stall. Whole slots beyond the bucket are skipped, fractions are
+kept so late wake ups do not shift the timeline.
+"""
+
+import math
+from time import perf_counter, sleep
+
+from azext_iot.common.utility import percentiles
+
+# Token fractions below this are float noise, not time left to wait
+_EPSILON = 1e-9
+
+
+class RateSchedule(object):
+    """
+    Absolute send timeline of a token bucket with an optional linear ramp.
+
+    Args:
+        rate (float): messages per second once ramped up.
+        burst (int): bucket capacity, the messages that may be sent back to back.
+        ramp (float): seconds over which the rate grows linearly from 0 to `rate`.
+        clock (callable): monotonic clock in seconds.
+    """
+
+    def __init__(self, rate, burst=1, ramp=0, clock=perf_counter):
+        if rate <= 0:
+            raise ValueError("rate must be greater than 0")
+        if burst < 1:
+            raise ValueError("burst must be 1 or greater")
+        if ramp < 0:
+            raise ValueError("ramp must not be negative")
+        self.rate = float(rate)
+        self.burst = burst
+        self.ramp = float(ramp)
+        self.clock = clock
+        self.started = None
+        self.spent = 0.0
+        self.sent = 0
+        self.skipped = 0
+        self.first_send = None
+        self.last_send = None
+        self.lags = []
+
+    def _accrued(self, elapsed):
+        """ Tokens accrued `elapsed` seconds into the schedule. """
+        if elapsed <= 0:
+            return 0.0
+        if elapsed < self.ramp:
+            return self.rate * elapsed * elapsed / (2 * self.ramp)
+        return self.rate * (elapsed - self.ramp / 2)
+
+    def _elapsed_for(self, tokens):
+        """ Seconds into the schedule at which `tokens` tokens have accrued. """
+        if tokens <= 0:
+            return 0.0
+        if tokens < self.rate * self.ramp / 2:
+            return math.sqrt(2 * tokens * self.ramp / self.rate)
+        return tokens / self.rate + self.ramp / 2
+
+    def start(self):
+        self.started = self.clock()
+
+    def delay(self):
+        """ Seconds until the next message is due, 0 when it may be sent now. """
+        if self.started is None:
+            self.start()
+        elapsed = self.clock() - self.started
+        available = self._accrued(elapsed) + self.burst - self.spent
+        overflow = math.floor(available - self.burst + _EPSILON)
+        if overflow >= 1:
+            self.spent += overflow
+            self.skipped += int(overflow)
+            available -= overflow
+        if available >= 1 - _EPSILON:
+            return 0
+        return max(0.0, self._elapsed_for(self.spent + 1 - self.burst) - elapsed)
+
+    def consume(self):
+        """ Records a send of the due message. """
+        now = self.clock()
+        if self.started is None:
+            self.started = now
+        due = self.started + self._elapsed_for(self.spent + 1 - self.burst)
+        self.lags.append(max(0.0, now - due))
+        self.spent += 1
+        self.sent += 1
+        if self.first_send is None:
+            self.first_send = now
+        self.last_send = now
+
+    def wait(self, sleep=sleep):
+        """ Blocks until the next message is due and records its send. """
+        while True:
+            delay = self.delay()
+            if delay <= 0:
+                self.consume()
+                return
+            sleep(delay)
+
+    def achieved_rate(self):
+        if self.sent < 2 or self.last_send <= self.first_send:
+            return None
+        return (self.sent - 1) / (self.last_send - self.first_send)
+
+    def report(self):
+        achieved = self.achieved_rate()
+        return {
+            "requestedRate": round(self.rate, 3),
+            "achievedRate": round(achieved, 3) if achieved is not None else None,
+            "burst": self.burst,
+            "rampSec": self.ramp,
+            "messagesSent": self.sent,
+            "skippedSlots": self.skipped,
+            "scheduleLagMs": percentiles(self.lags),
+        }
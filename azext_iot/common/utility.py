@@ -184,6 +184,7 @@ def execute_onthread(**kwargs):
                 'args' (list) to specify method arguments
                 'max_runs' (int) indicate an upper bound on number of executions
                 'return_handle' (bool) indicates whether to return a Thread handle
+                'schedule' (RateSchedule) paces executions on an absolute timeline instead of 'interval'
 
     Returns:
         Event(): Object to set the event cancellation flag
@@ -196,6 +197,7 @@ def execute_onthread(**kwargs):
     method_args = kwargs.get('args')
     max_runs = kwargs.get('max_runs')
     handle = kwargs.get('return_handle')
+    schedule = kwargs.get('schedule')
 
     if not interval:
         interval = 2
@@ -206,6 +208,20 @@ def execute_onthread(**kwargs):
 
     cancellation_token = Event()
 
+    def scheduled_wrap(max_runs=None):
+        runs = 0
+        while not (max_runs and runs >= max_runs):
+            delay = schedule.delay()
+            if delay > 0:
+                if cancellation_token.wait(delay):
+                    break
+                continue
+            if cancellation_token.is_set():
+                break
+            schedule.consume()
+            method(*method_args)
+            runs += 1
+
     def method_wrap(max_runs=None):
         runs = 0
         while not cancellation_token.wait(interval):
@@ -215,7 +231,7 @@ def execute_onthread(**kwargs):
             method(*method_args)
             runs += 1
 
-    op = Thread(target=method_wrap, args=(max_runs,))
+    op = Thread(target=scheduled_wrap if schedule else method_wrap, args=(max_runs,))
     op.start()
 
     if handle:
@@ -320,6 +336,51 @@ def init_monitoring(cmd, timeout, properties, enqueued_time, repair, yes):
     return (enqueued_time, properties, timeout, output)
 
 
+def validate_monitor_output(output_file=None, rotate_size=None, compress=False):
+    from knack.util import CLIError
+
+    if (rotate_size is not None or compress) and not output_file:
+        raise CLIError('Output rotation and compression require an output file.')
+    if rotate_size is not None and rotate_size < 1:
+        raise CLIError('Output rotation size must be 1 MiB or greater.')
+
+
+def validate_monitor_aggregate(aggregate=None, aggregate_fields=None):
+    from knack.util import CLIError
+
+    if aggregate_fields and aggregate is None:
+        raise CLIError('Aggregate fields require an --aggregate window.')
+    if aggregate is not None and aggregate < 1:
+        raise CLIError('Aggregate window must be 1 second or greater.')
+
+
+def validate_monitor_metrics(metrics=None, metrics_file=None):
+    from knack.util import CLIError
+
+    if metrics_file and metrics is None:
+        raise CLIError('A metrics file requires a --metrics interval.')
+    if metrics is not None and metrics < 1:
+        raise CLIError('Metrics interval must be 1 second or greater.')
+
+
+def validate_monitor_queue(queue_size=None):
+    from knack.util import CLIError
+
+    if queue_size is not None and queue_size < 1:
+        raise CLIError('Output queue size must be 1 or greater.')
+
+
+def validate_monitor_capture(record=None, replay=None, replay_pace=None):
+    from knack.util import CLIError
+
+    if record and replay:
+        raise CLIError('Events can either be recorded or replayed, not both.')
+    if replay_pace and not replay:
+        raise CLIError('Replay pace requires a --replay capture file.')
+    if replay and not os.path.isfile(replay):
+        raise CLIError('Capture file "{}" does not exist.'.format(replay))
+
+
 def get_sas_token(target):
     from azext_iot.common.digitaltwin_sas_token_auth import DigitalTwinSasTokenAuthentication
     token = ''
@@ -336,3 +397,27 @@ def dict_clean(d):
     if not isinstance(d, dict):
         return d
     return dict((k, dict_clean(v)) for k, v in d.items() if v is not None)
+
+
+LATENCY_PERCENTILES = (50, 90, 99)
+
+
+def percentiles(values, points=LATENCY_PERCENTILES, scale=1000, ndigits=1):
+    """
+    Nearest rank percentiles of a sequence of seconds, multiplied by `scale` and rounded to
+    `ndigits`. Milliseconds rounded to 0.1 by default, `ndigits` None skips rounding.
+    """
+    if not values:
+        return {}
+
+    def _value(value):
+        value *= scale
+        return value if ndigits is None else round(value, ndigits)
+
+    ordered = sorted(values)
+    result = {}
+    for point in points:
+        index = min(len(ordered) - 1, max(0, int(round(point / 100.0 * len(ordered))) - 1))
+        result["p{}".format(point)] = _value(ordered[index])
+    result["max"] = _value(ordered[-1])
+    return result
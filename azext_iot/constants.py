@@ -14,9 +14,13 @@ EDGE_DEPLOYMENT_SCHEMA_2_PATH = os.path.join(EXTENSION_ROOT, 'assets', 'edge-dep
 BASE_API_VERSION = "2018-08-30-preview"
 METHOD_INVOKE_MAX_TIMEOUT_SEC = 300
 METHOD_INVOKE_MIN_TIMEOUT_SEC = 10
-MIN_SIM_MSG_INTERVAL = 1
+SIM_MSG_INTERVAL_DEFAULT = 3
 MIN_SIM_MSG_COUNT = 1
-SIM_RECEIVE_SLEEP_SEC = 3
+# C2D polling of HTTP simulation backs off from the min to the max sleep while queues are empty
+SIM_RECEIVE_MIN_SLEEP_SEC = 0.5
+SIM_RECEIVE_MAX_SLEEP_SEC = 10
+SIM_HTTP_TOKEN_DURATION_SEC = 3600
+SIM_HTTP_TOKEN_RENEW_MARGIN_SEC = 300
 PNP_API_VERSION = "2019-07-01-preview"
 PNP_ENDPOINT = "https://provider.azureiotrepository.com"
 PNP_REPO_ENDPOINT = "https://repo.azureiotrepository.com"
@@ -0,0 +1,389 @@
+# coding=utf-8
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+"""
+d2c: Device-to-cloud message sending over a persistent connection.
+
+Messages are pulled lazily from an iterable and published at QoS 1 while fewer than the
+in-flight window are unacknowledged, so a send of any size holds at most a window of
+messages in memory and the link stays busy while PUBACKs are outstanding.
+
+Tokens are renewed by reconnecting before they expire. Lost connections are re-established
+with jittered backoff, and unacknowledged messages are resent in order on the new connection.
+
+Where only HTTPS is available, messages are packed into IoT Hub batch requests instead,
+up to the request size limit, over one kept alive session.
+"""
+
+import asyncio
+import json
+import sys
+from array import array
+from base64 import b64encode
+from time import perf_counter
+
+import six
+
+from knack.log import get_logger
+from azext_iot.common.utility import percentiles
+from azext_iot.operations._mqtt import AsyncMqttDevice, ReconnectBackoff, connection_result
+
+logger = get_logger(__name__)
+
+D2C_MAX_INFLIGHT_DEFAULT = 64
+D2C_CONNECT_TIMEOUT_SEC = 30
+# Time without any PUBACK after which a send with outstanding messages is abandoned
+D2C_ACK_TIMEOUT_SEC = 30
+D2C_MISC_INTERVAL_SEC = 1
+D2C_PROGRESS_INTERVAL_SEC = 5
+D2C_TOKEN_DURATION_SEC = 3600
+# The connection is re-established with a fresh token this long before the current one expires
+D2C_TOKEN_RENEW_MARGIN_SEC = 300
+# Consecutive failed reconnects after which the send is abandoned
+D2C_RECONNECT_MAX_ATTEMPTS = 10
+# IoT Hub limit on the body of one batched HTTPS request
+D2C_HTTP_BATCH_MAX_BYTES = 256 * 1024
+# Batch format names of the MQTT system properties
+D2C_HTTP_SYSTEM_PROPERTIES = {
+    "$.mid": "iothub-messageid",
+    "$.cid": "iothub-correlationid",
+    "$.uid": "iothub-userid",
+    "$.ct": "iothub-contenttype",
+    "$.ce": "iothub-contentencoding",
+}
+D2C_HTTP_APP_PROPERTY_PREFIX = "iothub-app-"
+
+
+class MqttD2CSender(object):
+    """
+    Publishes the device-to-cloud messages of one device over a single MQTT connection.
+
+    Args:
+        target (dict): IoT Hub connection target.
+        device_id (str): device to send as.
+        properties (dict): application and system properties sent with every message.
+        max_inflight (int): unacknowledged messages allowed before publishing waits.
+        token_duration (int): lifetime in seconds of the connection SAS token.
+    """
+
+    def __init__(
+        self,
+        target,
+        device_id,
+        properties=None,
+        max_inflight=D2C_MAX_INFLIGHT_DEFAULT,
+        token_duration=D2C_TOKEN_DURATION_SEC,
+    ):
+        self.target = target
+        self.device_id = device_id
+        self.properties = properties
+        self.max_inflight = max_inflight
+        self.token_duration = token_duration
+        self.device = None
+        self.sent = 0
+        self.acked = 0
+        self.publish_failures = 0
+        self.latencies = array("d")
+        self.started = None
+        self.finished = None
+        self.reconnects = 0
+        self.backoff = ReconnectBackoff()
+        self._acked = None
+        self._last_ack = None
+
+    def send(self, messages):
+        """
+        Publishes every payload of `messages`, an iterable consumed lazily.
+
+        Returns:
+            report (dict): message counts, throughput and PUBACK latency percentiles.
+        """
+        loop = asyncio.SelectorEventLoop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self._send(loop, messages))
+        except KeyboardInterrupt:
+            six.print_("Stopping send...", file=sys.stderr)
+        finally:
+            if self.device:
+                self.device.close()
+            loop.close()
+        return self.report()
+
+    def report(self):
+        elapsed = ((self.finished or perf_counter()) - self.started) if self.started else 0
+        return {
+            "messagesSent": self.sent,
+            "messagesAcked": self.acked,
+            "publishFailures": self.publish_failures,
+            "unacked": self.device.pending if self.device else 0,
+            "reconnects": self.reconnects,
+            "maxInflight": self.max_inflight,
+            "elapsedSec": round(elapsed, 3),
+            "messagesPerSec": round(self.acked / elapsed, 1) if elapsed else None,
+            "pubackLatencyMs": percentiles(self.latencies),
+        }
+
+    def _ack(self, latency):
+        self.acked += 1
+        self.latencies.append(latency)
+        self._last_ack = perf_counter()
+        self._acked.set()
+
+    async def _connect(self, loop):
+        self.device = AsyncMqttDevice(
+            self.target,
+            self.device_id,
+            loop,
+            token_duration=self.token_duration,
+            max_inflight=self.max_inflight,
+            on_ack=self._ack,
+            properties=self.properties,
+        )
+        self.device.connect()
+        self.device.attach()
+        try:
+            rc = await asyncio.wait_for(asyncio.shield(self.device.connected), D2C_CONNECT_TIMEOUT_SEC)
+        except asyncio.TimeoutError:
+            raise RuntimeError("Connecting to the IoT Hub MQTT broker timed out.")
+        if rc != 0:
+            raise RuntimeError(
+                "Connecting to the IoT Hub MQTT broker {}.".format(connection_result.get(rc, "failed ({})".format(rc)))
+            )
+
+    async def _send(self, loop, messages):
+        self._acked = asyncio.Event()
+        await self._connect(loop)
+        housekeeping = asyncio.ensure_future(self._housekeeping())
+        self.started = self._last_ack = perf_counter()
+        try:
+            for payload in messages:
+                if not await self._wait_window(loop, self.max_inflight - 1):
+                    break
+                if self.device.publish(payload):
+                    self.sent += 1
+                else:
+                    self.publish_failures += 1
+            await self._wait_window(loop, 0)
+        finally:
+            self.finished = perf_counter()
+            housekeeping.cancel()
+
+    async def _wait_window(self, loop, size):
+        """ Waits until at most `size` messages are unacknowledged. Returns False if the send must stop. """
+        while True:
+            if not await self._ensure_connected(loop):
+                return False
+            if self.device.pending <= size:
+                return True
+            if perf_counter() - self._last_ack > D2C_ACK_TIMEOUT_SEC:
+                logger.warning("No acknowledgement received in %ss, stopping.", D2C_ACK_TIMEOUT_SEC)
+                return False
+            self._acked.clear()
+            try:
+                await asyncio.wait_for(self._acked.wait(), D2C_MISC_INTERVAL_SEC)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _ensure_connected(self, loop):
+        if self.device.disconnected:
+            logger.warning("Connection lost with %s messages unacknowledged, reconnecting.", self.device.pending)
+            return await self._reconnect(loop)
+        if self.device.expires_in() < D2C_TOKEN_RENEW_MARGIN_SEC:
+            self.device.close()
+            return await self._reconnect(loop, planned=True)
+        return True
+
+    async def _reconnect(self, loop, planned=False):
+        """ Reconnects with a fresh token, after a jittered backoff unless the reconnect is planned. """
+        for attempt in range(D2C_RECONNECT_MAX_ATTEMPTS):
+            if attempt or not planned:
+                await asyncio.sleep(self.backoff.next_delay())
+            self.device.prepare_reconnect()
+            try:
+                await loop.run_in_executor(None, self.device.reconnect)
+            except Exception as e:
+                logger.debug("Reconnect attempt %s failed: %s", attempt + 1, e)
+                continue
+            self.device.attach()
+            try:
+                rc = await asyncio.wait_for(asyncio.shield(self.device.connected), D2C_CONNECT_TIMEOUT_SEC)
+            except asyncio.TimeoutError:
+                rc = None
+            if rc == 0:
+                self.backoff.reset()
+                self.reconnects += 1
+                self._last_ack = perf_counter()
+                return True
+            logger.debug("Reconnect attempt %s refused: %s", attempt + 1, connection_result.get(rc, rc))
+        logger.warning("Reconnecting failed %s times, stopping.", D2C_RECONNECT_MAX_ATTEMPTS)
+        return False
+
+    async def _housekeeping(self):
+        last_progress = perf_counter()
+        while True:
+            await asyncio.sleep(D2C_MISC_INTERVAL_SEC)
+            self.device.misc()
+            if perf_counter() - last_progress >= D2C_PROGRESS_INTERVAL_SEC:
+                last_progress = perf_counter()
+                six.print_(
+                    "{} sent, {} acked, {:.1f} msg/s".format(
+                        self.sent, self.acked, self.acked / (last_progress - self.started)
+                    ),
+                    file=sys.stderr,
+                    flush=True,
+                )
+
+
+class HttpD2CBatcher(object):
+    """
+    Packs device-to-cloud messages into IoT Hub batch request bodies.
+
+    Every message becomes a base64 encoded entry of a JSON array. Entries are appended to the
+    pending body until the next one would exceed `max_bytes` or `max_messages` are packed.
+
+    Args:
+        properties (dict): application and system properties sent with every message.
+        max_bytes (int): size limit of one request body.
+        max_messages (int): messages per request, unbounded by default.
+    """
+
+    def __init__(self, properties=None, max_bytes=D2C_HTTP_BATCH_MAX_BYTES, max_messages=None):
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        batch_properties = {}
+        for key, value in (properties or {}).items():
+            name = D2C_HTTP_SYSTEM_PROPERTIES.get(key, D2C_HTTP_APP_PROPERTY_PREFIX + key)
+            batch_properties[name] = value
+        # Everything but the body is the same for every entry
+        self._prefix = b'{"body":"'
+        self._suffix = '","base64Encoded":true,"properties":{}}}'.format(
+            json.dumps(batch_properties, separators=(",", ":"))
+        ).encode()
+        self._entries = []
+        self._size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, payload):
+        """ Packs a str or bytes payload. Returns the list of (body, message count) batches it completed. """
+        if not isinstance(payload, bytes):
+            payload = payload.encode("utf8")
+        entry = b"".join((self._prefix, b64encode(payload), self._suffix))
+        # Brackets of the array and the separator of every entry
+        if len(entry) + 2 > self.max_bytes:
+            raise ValueError(
+                "Message of {} bytes exceeds the {} bytes batch limit once encoded.".format(len(payload), self.max_bytes)
+            )
+        ready = []
+        if self._entries and self._size + len(entry) + 1 > self.max_bytes:
+            ready.extend(self.flush())
+        self._entries.append(entry)
+        self._size += len(entry) + (1 if len(self._entries) > 1 else 2)
+        if self.max_messages and len(self._entries) >= self.max_messages:
+            ready.extend(self.flush())
+        return ready
+
+    def flush(self):
+        """ Returns the pending batch, if any, as a list of (body, message count). """
+        if not self._entries:
+            return []
+        batch = (b"".join((b"[", b",".join(self._entries), b"]")), len(self._entries))
+        self._entries = []
+        self._size = 0
+        return [batch]
+
+    def batches(self, messages):
+        """ Lazily packs the payloads of `messages` into (body, message count) batches. """
+        for payload in messages:
+            for batch in self.add(payload):
+                yield batch
+        for batch in self.flush():
+            yield batch
+
+
+class HttpD2CBatchSender(object):
+    """
+    Sends the device-to-cloud messages of one device as batched HTTPS requests.
+
+    Args:
+        sdk (tuple): device sdk and its errors module, bound to a kept alive session.
+        device_id (str): device to send as.
+        properties (dict): application and system properties sent with every message.
+        max_bytes (int): size limit of one request body.
+        max_messages (int): messages per request, unbounded by default.
+        renew (callable): called before every request to renew the session token.
+    """
+
+    def __init__(
+        self,
+        sdk,
+        device_id,
+        properties=None,
+        max_bytes=D2C_HTTP_BATCH_MAX_BYTES,
+        max_messages=None,
+        renew=None,
+    ):
+        self.sdk = sdk
+        self.device_id = device_id
+        self.batcher = HttpD2CBatcher(properties, max_bytes=max_bytes, max_messages=max_messages)
+        self.renew = renew
+        self.sent = 0
+        self.batches = 0
+        self.bytes_sent = 0
+        self.latencies = array("d")
+        self.started = None
+        self.finished = None
+
+    def send(self, messages):
+        """
+        Sends every payload of `messages`, an iterable consumed lazily.
+
+        Returns:
+            report (dict): message and batch counts, throughput and request latency percentiles.
+        """
+        self.started = perf_counter()
+        try:
+            for body, count in self.batcher.batches(messages):
+                self.send_batch(body, count)
+        finally:
+            self.finished = perf_counter()
+        return self.report()
+
+    def add(self, payload):
+        """ Packs one payload, sending the batches it completes. """
+        if self.started is None:
+            self.started = perf_counter()
+        for body, count in self.batcher.add(payload):
+            self.send_batch(body, count)
+
+    def flush(self):
+        """ Sends the pending batch. """
+        for body, count in self.batcher.flush():
+            self.send_batch(body, count)
+
+    def send_batch(self, body, count):
+        if self.renew:
+            self.renew()
+        start = perf_counter()
+        self.sdk[0].send_device_event_batch(self.device_id, body)
+        self.latencies.append(perf_counter() - start)
+        self.batches += 1
+        self.sent += count
+        self.bytes_sent += len(body)
+
+    def report(self):
+        elapsed = ((self.finished or perf_counter()) - self.started) if self.started else 0
+        return {
+            "messagesSent": self.sent,
+            "batches": self.batches,
+            "messagesPerBatch": round(self.sent / self.batches, 1) if self.batches else None,
+            "bytesSent": self.bytes_sent,
+            "elapsedSec": round(elapsed, 3),
+            "messagesPerSec": round(self.sent / elapsed, 1) if elapsed else None,
+            "batchLatencyMs": percentiles(self.latencies),
+        }
@@ -0,0 +1,230 @@
+# coding=utf-8
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+"""
+fleet: Simulates many devices from one process over a single selector event loop.
+
+Every device holds its own MQTT connection and is paced by its own drift-free rate schedule,
+so a slow or reconnecting device never takes sending budget from the others. Device start
+times are spread over the first interval so a fleet does not publish in lockstep.
+"""
+
+import asyncio
+import sys
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from random import uniform
+from time import perf_counter
+
+import six
+
+from knack.log import get_logger
+from azext_iot.common.scheduler import RateSchedule
+from azext_iot.common.utility import percentiles
+from azext_iot.operations._mqtt import AsyncMqttDevice
+
+logger = get_logger(__name__)
+
+# Concurrent TLS handshakes while connecting a fleet
+FLEET_CONNECT_CONCURRENCY = 32
+FLEET_CONNECT_TIMEOUT_SEC = 30
+# Time devices wait on outstanding PUBACKs after their last publish
+FLEET_ACK_TIMEOUT_SEC = 30
+FLEET_PROGRESS_INTERVAL_SEC = 5
+FLEET_MISC_INTERVAL_SEC = 1
+FLEET_MAX_INFLIGHT = 20
+# Margin added to the expected run time when signing connection tokens
+FLEET_TOKEN_MARGIN_SEC = 600
+
+
+class FleetStats(object):
+    """ Aggregate counters and PUBACK latencies of a simulated fleet. """
+
+    def __init__(self):
+        self.connected = 0
+        self.connect_failures = {}
+        self.sent = 0
+        self.acked = 0
+        self.publish_failures = 0
+        self.c2d_received = 0
+        self.skipped_slots = 0
+        self.latencies = array("d")
+        self.started = perf_counter()
+
+    def ack(self, latency):
+        self.acked += 1
+        self.latencies.append(latency)
+
+    def c2d(self, device_id, msg):
+        self.c2d_received += 1
+
+    def progress(self):
+        elapsed = perf_counter() - self.started
+        return "{} connected, {} sent, {} acked, {:.1f} msg/s, PUBACK {}".format(
+            self.connected,
+            self.sent,
+            self.acked,
+            self.acked / elapsed if elapsed else 0,
+            " ".join("{}={}ms".format(k, v) for k, v in percentiles(self.latencies).items()) or "n/a",
+        )
+
+    def report(self, devices):
+        elapsed = perf_counter() - self.started
+        return {
+            "devices": devices,
+            "connected": self.connected,
+            "connectFailures": [
+                {"deviceId": device_id, "error": error} for device_id, error in self.connect_failures.items()
+            ],
+            "messagesSent": self.sent,
+            "messagesAcked": self.acked,
+            "publishFailures": self.publish_failures,
+            "c2dReceived": self.c2d_received,
+            "skippedSlots": self.skipped_slots,
+            "elapsedSec": round(elapsed, 3),
+            "messagesPerSec": round(self.acked / elapsed, 1) if elapsed else None,
+            "pubackLatencyMs": percentiles(self.latencies),
+        }
+
+
+class FleetSimulator(object):
+    """
+    Runs a fleet of simulated MQTT devices in one event loop.
+
+    Args:
+        target (dict): IoT Hub connection target.
+        device_ids (list): devices to simulate.
+        template (PayloadTemplate): message payload template, bound to each device.
+        msg_count (int): messages each device sends.
+        msg_interval (float): seconds between messages of a device.
+        connect_concurrency (int): concurrent connection handshakes.
+    """
+
+    def __init__(
+        self,
+        target,
+        device_ids,
+        template,
+        msg_count,
+        msg_interval,
+        connect_concurrency=FLEET_CONNECT_CONCURRENCY,
+    ):
+        self.target = target
+        self.device_ids = device_ids
+        self.template = template
+        self.msg_count = msg_count
+        self.msg_interval = msg_interval
+        self.connect_concurrency = connect_concurrency
+        self.stats = FleetStats()
+        self.devices = []
+        self.token_duration = int(msg_count * msg_interval) + FLEET_TOKEN_MARGIN_SEC
+
+    def run(self):
+        """ Simulates the fleet and returns the aggregate report. """
+        loop = asyncio.SelectorEventLoop()
+        asyncio.set_event_loop(loop)
+        executor = ThreadPoolExecutor(max_workers=self.connect_concurrency)
+        six.print_(
+            "Simulating {} devices, {} messages each every {}s, use ctrl-c to stop...".format(
+                len(self.device_ids), self.msg_count, self.msg_interval
+            ),
+            file=sys.stderr,
+        )
+        try:
+            loop.run_until_complete(self._run(loop, executor))
+        except KeyboardInterrupt:
+            six.print_("Stopping fleet simulation...", file=sys.stderr)
+        finally:
+            for device in self.devices:
+                device.close()
+            executor.shutdown(wait=False)
+            loop.close()
+        return self.stats.report(len(self.device_ids))
+
+    async def _run(self, loop, executor):
+        self.stats.started = perf_counter()
+        handshakes = asyncio.Semaphore(self.connect_concurrency)
+        housekeeping = [
+            asyncio.ensure_future(self._misc()),
+            asyncio.ensure_future(self._progress()),
+        ]
+        try:
+            await asyncio.gather(
+                *[self._simulate(loop, executor, handshakes, d) for d in self.device_ids],
+                return_exceptions=True
+            )
+        finally:
+            for task in housekeeping:
+                task.cancel()
+
+    async def _connect(self, loop, executor, handshakes, device):
+        async with handshakes:
+            try:
+                await loop.run_in_executor(executor, device.connect)
+            except Exception as e:
+                return str(e)
+            device.attach()
+        try:
+            rc = await asyncio.wait_for(asyncio.shield(device.connected), FLEET_CONNECT_TIMEOUT_SEC)
+        except asyncio.TimeoutError:
+            return "connect timed out"
+        return None if rc == 0 else "connect refused ({})".format(rc)
+
+    async def _simulate(self, loop, executor, handshakes, device_id):
+        stats = self.stats
+        device = AsyncMqttDevice(
+            self.target,
+            device_id,
+            loop,
+            token_duration=self.token_duration,
+            max_inflight=FLEET_MAX_INFLIGHT,
+            on_ack=stats.ack,
+            on_c2d=stats.c2d,
+        )
+        self.devices.append(device)
+
+        error = await self._connect(loop, executor, handshakes, device)
+        if error:
+            stats.connect_failures[device_id] = error
+            device.close()
+            return
+        stats.connected += 1
+
+        # Spread device start times over one interval
+        render = self.template.renderer(device_id)
+        schedule = RateSchedule(1.0 / self.msg_interval, clock=loop.time)
+        await asyncio.sleep(uniform(0, self.msg_interval))
+        schedule.start()
+        for count in range(1, self.msg_count + 1):
+            delay = schedule.delay()
+            while delay > 0:
+                await asyncio.sleep(delay)
+                delay = schedule.delay()
+            schedule.consume()
+            if device.disconnected:
+                stats.publish_failures += self.msg_count - count + 1
+                break
+            if device.publish(render()):
+                stats.sent += 1
+            else:
+                stats.publish_failures += 1
+
+        stats.skipped_slots += schedule.skipped
+        deadline = loop.time() + FLEET_ACK_TIMEOUT_SEC
+        while device.pending and not device.disconnected and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        device.close()
+
+    async def _misc(self):
+        while True:
+            await asyncio.sleep(FLEET_MISC_INTERVAL_SEC)
+            for device in self.devices:
+                device.misc()
+
+    async def _progress(self):
+        while True:
+            await asyncio.sleep(FLEET_PROGRESS_INTERVAL_SEC)
+            six.print_(self.stats.progress(), file=sys.stderr, flush=True)
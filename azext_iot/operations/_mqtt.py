@@ -9,45 +9,102 @@ import ssl
 import os
 import six
 
-from time import time, sleep
+from itertools import islice
+from random import uniform
+from threading import Event, Thread
+from time import perf_counter, time, sleep
 from paho.mqtt import client as mqtt
 
-from azext_iot.constants import EXTENSION_ROOT
+from knack.log import get_logger
+from knack.util import CLIError
+
+from azext_iot.constants import EXTENSION_ROOT, BASE_API_VERSION
 from azext_iot.common.sas_token_auth import SasTokenAuthentication
+from azext_iot.common.scheduler import RateSchedule
+from azext_iot.common.utility import url_encode_dict
+
+logger = get_logger(__name__)
+
+CONNECT_POLL_SEC = 0.1
+NETWORK_LOOP_TIMEOUT_SEC = 1.0
+MQTT_TOKEN_DURATION_SEC = 3600
+# Connections are re-established with a fresh token this long before the current one expires
+MQTT_TOKEN_RENEW_MARGIN_SEC = 300
+RECONNECT_MIN_DELAY_SEC = 1
+RECONNECT_MAX_DELAY_SEC = 60
+# Consecutive failed reconnects after which simulation is abandoned
+MQTT_RECONNECT_MAX_ATTEMPTS = 10
 
 connection_result = {0: "success", 1: "refused - incorrect protocol version", 2: "refused - invalid client id",
                      3: "refused - server unavailable", 4: "refused - bad username or password", 5: "refused - not authorized"}
+# Refusals retrying cannot fix
+FATAL_CONNECTION_RESULTS = (4, 5)
+
+
+class ReconnectBackoff(object):
+    """
+    Exponential reconnect delays with full jitter, so devices dropped together do not
+    reconnect together.
+    """
+
+    def __init__(self, min_delay=RECONNECT_MIN_DELAY_SEC, max_delay=RECONNECT_MAX_DELAY_SEC):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.attempts = 0
+
+    def next_delay(self):
+        ceiling = min(self.max_delay, self.min_delay * 2 ** self.attempts)
+        self.attempts += 1
+        return uniform(0, ceiling)
+
+    def reset(self):
+        self.attempts = 0
 
 
 class mqtt_client_wrap(object):
 
-    def __init__(self, target, device_id):
+    def __init__(self, target, device_id, token_duration=MQTT_TOKEN_DURATION_SEC):
         self.target = target
         self.device_id = device_id
+        self.token_duration = token_duration
 
-        sas = SasTokenAuthentication(target['entity'], target['policy'], target['primarykey'], time() + 360).generate_sas_token()
+        self.auth = SasTokenAuthentication(target['entity'], target['policy'], target['primarykey'],
+                                           time() + token_duration)
         cwd = EXTENSION_ROOT
         cert_path = os.path.join(cwd, 'digicert.pem')
-        auth = {'username': '{}/{}/api-version=2016-11-14'.format(target['entity'], device_id), 'password': sas}
+        self.username = '{}/{}/api-version=2016-11-14'.format(target['entity'], device_id)
         tls = {'ca_certs': cert_path, 'tls_version': ssl.PROTOCOL_SSLv23}
         self.topic_publish = 'devices/{}/messages/events/'.format(device_id)
         self.topic_receive = 'devices/{}/messages/devicebound/#'.format(device_id)
         self.connected = False
+        self.reconnects = 0
+        self.backoff = ReconnectBackoff()
+        self.error = None
+        self._stop = Event()
 
         self.client = mqtt.Client(protocol=mqtt.MQTTv311, client_id=device_id)
         self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
         self.client.on_message = self.on_message
         self.client.on_publish = self.on_publish
         self.client.tls_set(ca_certs=tls['ca_certs'], tls_version=tls['tls_version'])
-        self.client.username_pw_set(username=auth['username'], password=sas)
+        self.client.username_pw_set(username=self.username, password=self.auth.generate_sas_token())
         self.client.connect(host=self.target['entity'], port=8883)
 
     def on_connect(self, client, userdata, flags, rc):
         six.print_("Connected to target IoT Hub MQTT broker with result: {}".format(connection_result[rc]))
+        if rc in FATAL_CONNECTION_RESULTS:
+            self._fail(connection_result[rc])
+        if rc != 0:
+            return
         self.client.subscribe(self.topic_receive)
         six.print_("Subscribed to device bound message queue")
+        self.backoff.reset()
         self.connected = True
 
+    def on_disconnect(self, client, userdata, rc):
+        self.connected = False
+
     def on_message(self, client, userdata, msg):
         six.print_()
         six.print_("_Received C2D message with topic_: {}".format(msg.topic))
@@ -59,19 +116,229 @@ class mqtt_client_wrap(object):
     def is_connected(self):
         return self.connected
 
-    def execute(self, data, publish_delay=2, msg_count=100):
+    def _fail(self, message):
+        self.error = CLIError(message)
+        self._stop.set()
+
+    def _wait_connected(self):
+        while not self.is_connected():
+            if self.error:
+                raise self.error
+            sleep(CONNECT_POLL_SEC)
+
+    def renew_credentials(self):
+        self.auth.expiry = time() + self.token_duration
+        self.client.username_pw_set(username=self.username, password=self.auth.generate_sas_token())
+
+    def _network_loop(self):
+        """ Runs the client until stopped, renewing the token before expiry and reconnecting on loss. """
+        planned = False
+        while not self._stop.is_set():
+            if self.auth.expiry - time() < MQTT_TOKEN_RENEW_MARGIN_SEC:
+                # IoT Hub drops connections once their token expires, reconnect with a fresh one first
+                self.renew_credentials()
+                self.client.disconnect()
+                planned = True
+            if self.client.loop(timeout=NETWORK_LOOP_TIMEOUT_SEC) == mqtt.MQTT_ERR_SUCCESS:
+                continue
+
+            self.connected = False
+            if not planned and self.backoff.attempts >= MQTT_RECONNECT_MAX_ATTEMPTS:
+                self._fail("Reconnecting to the IoT Hub MQTT broker failed {} times.".format(MQTT_RECONNECT_MAX_ATTEMPTS))
+                break
+            if self._stop.wait(0 if planned else self.backoff.next_delay()):
+                break
+            planned = False
+            try:
+                self.client.reconnect()
+                self.reconnects += 1
+            except Exception as e:
+                logger.debug("Reconnect of %s failed: %s", self.device_id, e)
+
+    def _publish(self, payload):
+        """
+        Publishes a message at QoS 1 once connected. A message the client cannot send because the
+        connection was just lost (MQTT_ERR_NO_CONN) stays queued and is resent after reconnecting.
+        """
+        self._wait_connected()
+        self.client.publish(self.topic_publish, payload, qos=1)
+
+    def execute(self, messages, publish_delay=2, msg_count=100, schedule=None):
+        """ Publishes `msg_count` payloads of `messages` on `schedule`, one every `publish_delay` seconds by default. """
+        if schedule is None:
+            schedule = RateSchedule(1.0 / publish_delay)
+        network = Thread(target=self._network_loop)
+        network.daemon = True
         try:
-            msgs = 0
-            self.client.loop_start()
-            while True:
-                if self.is_connected():
-                    if msgs < msg_count:
-                        msgs += 1
-                        self.client.publish(self.topic_publish, data.generate(True))
-                    else:
-                        break
-                sleep(publish_delay)
+            network.start()
+            self._wait_connected()
+            schedule.start()
+            for payload in islice(messages, msg_count):
+                schedule.wait()
+                self._publish(payload)
+            report = schedule.report()
+            report['reconnects'] = self.reconnects
+            return report
         except Exception as x:
             raise x
         finally:
-            self.client.loop_stop()
+            self._stop.set()
+            network.join()
+
+
+class AsyncMqttDevice(object):
+    """
+    MQTT device connection driven by a selector based asyncio event loop instead of a network thread.
+
+    Many devices share one loop. QoS 1 publishes are pipelined up to `max_inflight` unacknowledged
+    messages and every PUBACK is reported to `on_ack` with its latency in seconds.
+
+    Args:
+        target (dict): IoT Hub connection target.
+        device_id (str): device to connect as.
+        loop (asyncio.AbstractEventLoop): selector event loop driving the connection.
+        token_duration (int): lifetime in seconds of the connection SAS token.
+        max_inflight (int): unacknowledged QoS 1 messages allowed before publishes are queued.
+        on_ack (callable): called with the PUBACK latency of every published message.
+        on_c2d (callable): called with every received C2D message.
+        properties (dict): application and system properties sent with every message.
+    """
+
+    def __init__(self, target, device_id, loop, token_duration=3600, max_inflight=20, on_ack=None, on_c2d=None,
+                 properties=None):
+        self.target = target
+        self.device_id = device_id
+        self.loop = loop
+        self.on_ack = on_ack
+        self.on_c2d = on_c2d
+        self.topic_publish = 'devices/{}/messages/events/{}'.format(
+            device_id, url_encode_dict(properties) if properties else '')
+        self.topic_receive = 'devices/{}/messages/devicebound/#'.format(device_id)
+        self.connected = loop.create_future()
+        self.disconnected = False
+        self._pending = {}
+        self._sock = None
+        self._writing = False
+
+        self.token_duration = token_duration
+        self.auth = SasTokenAuthentication(target['entity'], target['policy'], target['primarykey'],
+                                           time() + token_duration)
+        self.username = '{}/{}/api-version={}'.format(target['entity'], device_id, BASE_API_VERSION)
+        self.client = mqtt.Client(protocol=mqtt.MQTTv311, client_id=device_id)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_publish = self._on_publish
+        self.client.on_message = self._on_message
+        self.client.max_inflight_messages_set(max_inflight)
+        self.client.tls_set(ca_certs=os.path.join(EXTENSION_ROOT, 'digicert.pem'), tls_version=ssl.PROTOCOL_SSLv23)
+        self.client.username_pw_set(username=self.username, password=self.auth.generate_sas_token())
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def expires_in(self):
+        """ Seconds until the connection token expires. """
+        return self.auth.expiry - time()
+
+    def connect(self):
+        """ Opens the TLS connection and sends CONNECT. Blocking, run it in an executor. """
+        self.client.connect(host=self.target['entity'], port=8883)
+
+    def prepare_reconnect(self):
+        """ Releases the current socket and resets the connected future. Must be called on the loop thread. """
+        self._detach()
+        self.connected = self.loop.create_future()
+
+    def reconnect(self):
+        """
+        Reconnects with a freshly signed token. Unacknowledged QoS 1 messages are resent by the
+        client on the new connection. Blocking, run it in an executor after prepare_reconnect.
+        """
+        self.auth.expiry = time() + self.token_duration
+        self.client.username_pw_set(username=self.username, password=self.auth.generate_sas_token())
+        self.client.reconnect()
+
+    def attach(self):
+        """ Hands the connected socket to the event loop. Must be called on the loop thread. """
+        self.disconnected = False
+        self._sock = self.client.socket()
+        self.loop.add_reader(self._sock, self._read)
+        self._flush()
+
+    def publish(self, payload):
+        """ Publishes a QoS 1 message. Returns False if the message could not be queued. """
+        sent_at = perf_counter()
+        info = self.client.publish(self.topic_publish, payload, qos=1)
+        if info.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+            return False
+        self._pending[info.mid] = sent_at
+        self._flush()
+        return True
+
+    def misc(self):
+        """ Keep-alive and retry housekeeping, call about once a second. """
+        if self._sock:
+            self.client.loop_misc()
+            self._flush()
+
+    def close(self):
+        if self._sock:
+            self.client.disconnect()
+            self._flush()
+            self._detach()
+
+    def _detach(self):
+        if self._sock:
+            self.loop.remove_reader(self._sock)
+            if self._writing:
+                self.loop.remove_writer(self._sock)
+                self._writing = False
+            self._sock = None
+
+    def _read(self):
+        rc = self.client.loop_read()
+        # TLS may hold decrypted bytes the selector does not see
+        while rc == mqtt.MQTT_ERR_SUCCESS and self._sock and getattr(self._sock, 'pending', None) and \
+                self._sock.pending():
+            rc = self.client.loop_read()
+        if rc != mqtt.MQTT_ERR_SUCCESS or self.client.socket() is None:
+            self._on_disconnect(self.client, None, rc)
+            return
+        self._flush()
+
+    def _flush(self):
+        if not self._sock or not self.client.want_write():
+            return
+        self.client.loop_write()
+        if self._sock and self.client.want_write():
+            if not self._writing:
+                self.loop.add_writer(self._sock, self._write)
+                self._writing = True
+
+    def _write(self):
+        self.client.loop_write()
+        if self._sock and not self.client.want_write() and self._writing:
+            self.loop.remove_writer(self._sock)
+            self._writing = False
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            client.subscribe(self.topic_receive, qos=1)
+        if not self.connected.done():
+            self.connected.set_result(rc)
+
+    def _on_disconnect(self, client, userdata, rc):
+        self.disconnected = True
+        self._detach()
+        if not self.connected.done():
+            self.connected.set_result(rc or mqtt.MQTT_ERR_CONN_LOST)
+
+    def _on_publish(self, client, userdata, mid):
+        sent_at = self._pending.pop(mid, None)
+        if sent_at is not None and self.on_ack:
+            self.on_ack(perf_counter() - sent_at)
+
+    def _on_message(self, client, userdata, msg):
+        if self.on_c2d:
+            self.on_c2d(self.device_id, msg)
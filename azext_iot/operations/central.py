@@ -8,7 +8,7 @@ from knack.util import CLIError
 from azext_iot._factory import _bind_sdk
 from azext_iot.common._azure import get_iot_hub_token_from_central_app_id
 from azext_iot.common.shared import SdkType
-from azext_iot.common.utility import (unpack_msrest_error, init_monitoring)
+from azext_iot.common.utility import (unpack_msrest_error, init_monitoring, validate_monitor_output)
 from azext_iot.common.sas_token_auth import BasicSasTokenAuthentication
 
 
@@ -29,9 +29,13 @@ def iot_central_device_show(cmd, device_id, app_id):
 
 
 def iot_central_monitor_events(cmd, app_id, device_id=None, consumer_group='$Default', timeout=300, enqueued_time=None,
-                               repair=False, properties=None, yes=False):
+                               repair=False, properties=None, yes=False, ndjson=False, output_file=None,
+                               rotate_size=None, compress=False):
 
+    validate_monitor_output(output_file, rotate_size, compress)
     (enqueued_time, properties, timeout, output) = init_monitoring(cmd, timeout, properties, enqueued_time, repair, yes)
+    if ndjson:
+        output = 'ndjson'
 
     import importlib
 
@@ -45,4 +49,7 @@ def iot_central_monitor_events(cmd, app_id, device_id=None, consumer_group='$Def
                      properties=properties,
                      timeout=timeout,
                      device_id=device_id,
-                     output=output)
+                     output=output,
+                     output_file=output_file,
+                     rotate_size=rotate_size,
+                     compress=compress)
@@ -178,9 +178,12 @@ def iot_digitaltwin_monitor_events(cmd, device_id=None, device_query=None, inter
                                    source_model=ModelSourceType.public.value, repo_endpoint=PNP_ENDPOINT,
                                    repo_id=None, consumer_group='$Default', timeout=300, hub_name=None,
                                    resource_group_name=None, yes=False, properties=None, repair=False,
-                                   login=None, repo_login=None):
+                                   login=None, repo_login=None, ndjson=False, output_file=None, rotate_size=None,
+                                   compress=False, aggregate=None, aggregate_fields=None, metrics=None,
+                                   metrics_file=None, queue_size=None, queue_policy=None, record=None, replay=None,
+                                   replay_pace=None, typed_telemetry=None):
     source_model = source_model.lower()
-    pnp_context = {'enabled': True, 'interface': {}}
+    pnp_context = {'enabled': True, 'interface': {}, 'typed': bool(typed_telemetry)}
     target_interfaces = []
     interface_id = None
     if all([device_id, device_query]):
@@ -216,14 +219,19 @@ def iot_digitaltwin_monitor_events(cmd, device_id=None, device_query=None, inter
                                                           repo_endpoint, repo_id, repo_login)
 
             for telemetry in found_telemetry:
-                telemetry_data = {'display': telemetry.get('displayName'), 'unit': telemetry.get('unit')}
+                telemetry_data = {'display': telemetry.get('displayName'), 'unit': telemetry.get('unit'),
+                                  'schema': telemetry.get('schema')}
                 pnp_context['interface'][entity['urn_id']][telemetry['name']] = telemetry_data
 
     _iot_hub_monitor_events(cmd=cmd, interface=interface_id, pnp_context=pnp_context,
                             hub_name=hub_name, device_id=device_id, consumer_group=consumer_group, timeout=timeout,
                             enqueued_time=None, resource_group_name=resource_group_name,
                             yes=yes, properties=properties, repair=repair,
-                            login=login, device_query=device_query)
+                            login=login, device_query=device_query, ndjson=ndjson,
+                            output_file=output_file, rotate_size=rotate_size, compress=compress,
+                            aggregate=aggregate, aggregate_fields=aggregate_fields, metrics=metrics,
+                            metrics_file=metrics_file, queue_size=queue_size, queue_policy=queue_policy,
+                            record=record, replay=replay, replay_pace=replay_pace)
 
 
 def _iot_digitaltwin_interface_show(cmd, device_id, interface, hub_name=None, resource_group_name=None, login=None):
@@ -0,0 +1,206 @@
+# coding=utf-8
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+"""
+aggregates: Windowed per-device rollups of monitored telemetry.
+
+Instead of rendering every event, the aggregator keeps running counts, byte totals and
+min/max/mean of numeric payload fields per device (and PnP interface), emitting one
+summary document per window. State is reset every window, so memory is bounded by
+the devices active within a single window.
+"""
+
+import asyncio
+import json
+from datetime import datetime
+
+from knack.log import get_logger
+
+logger = get_logger(__name__)
+
+_NUMERIC_TYPES = (int, float)
+
+
+class FieldStats(object):
+    __slots__ = ("count", "total", "min", "max")
+
+    def __init__(self, value):
+        self.count = 1
+        self.total = value
+        self.min = value
+        self.max = value
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.total / self.count,
+        }
+
+
+class Rollup(object):
+    __slots__ = ("count", "bytes", "fields")
+
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.fields = {}
+
+    def add(self, size, values):
+        self.count += 1
+        self.bytes += size
+        fields = self.fields
+        for name, value in values:
+            stats = fields.get(name)
+            if stats is None:
+                fields[name] = FieldStats(value)
+            else:
+                stats.add(value)
+
+    def summary(self):
+        result = {"count": self.count, "bytes": self.bytes}
+        if self.fields:
+            result["fields"] = {
+                name: stats.summary() for name, stats in sorted(self.fields.items())
+            }
+        return result
+
+
+def _is_number(value):
+    return isinstance(value, _NUMERIC_TYPES) and not isinstance(value, bool)
+
+
+def compile_field_extractor(fields=None):
+    """
+    Compiles numeric field selection into an extractor of (name, value) pairs.
+
+    Args:
+        fields (list): payload field names, nested fields separated by '.'.
+            All top level numeric fields are extracted when not provided.
+    """
+    if not fields:
+
+        def extract_all(payload):
+            return [(name, value) for name, value in payload.items() if _is_number(value)]
+
+        return extract_all
+
+    paths = [(name, name.split(".")) for name in fields]
+
+    def extract_selected(payload):
+        result = []
+        for name, path in paths:
+            value = payload
+            for key in path:
+                if not isinstance(value, dict):
+                    value = None
+                    break
+                value = value.get(key)
+            if _is_number(value):
+                result.append((name, value))
+        return result
+
+    return extract_selected
+
+
+class EventAggregator(object):
+    """
+    Accumulates per-device rollups of filtered events over a time window.
+
+    Args:
+        window (int): window length in seconds.
+        fields (list): numeric payload fields to summarize, all top level numeric fields by default.
+        per_interface (bool): split device rollups by PnP interface.
+        content_type (str): content type override for payload parsing.
+        render (callable): renders the summary document.
+    """
+
+    def __init__(self, window, fields=None, per_interface=False, content_type=None, render=None):
+        self.window = window
+        self.per_interface = per_interface
+        self.content_type = content_type.lower() if content_type else None
+        self.render = render or json.dumps
+
+        self._extract = compile_field_extractor(fields)
+        self._rollups = {}
+        self._window_start = datetime.utcnow()
+
+    def _parse(self, view):
+        body = view.body
+        if body is None:
+            return None
+        ct = self.content_type or view.content_type
+        if ct != "application/json" and (ct or body[:1] != b"{"):
+            return None
+        try:
+            payload = json.loads(view.text())
+        except ValueError:
+            return None
+        return payload if isinstance(payload, dict) else None
+
+    def add(self, view):
+        body = view.body
+        payload = self._parse(view)
+        values = self._extract(payload) if payload else ()
+
+        key = view.origin
+        if self.per_interface:
+            key = (key, view.interface)
+        rollup = self._rollups.get(key)
+        if rollup is None:
+            rollup = self._rollups[key] = Rollup()
+        rollup.add(len(body) if body is not None else 0, values)
+
+    def collect(self):
+        """ Returns the summary document of the current window and starts a new one. """
+        start, end = self._window_start, datetime.utcnow()
+        rollups, self._rollups = self._rollups, {}
+        self._window_start = end
+        if not rollups:
+            return None
+
+        devices = {}
+        for key, rollup in rollups.items():
+            if self.per_interface:
+                device, interface = key
+                entry = devices.setdefault(device, {"count": 0, "bytes": 0, "interfaces": {}})
+                entry["count"] += rollup.count
+                entry["bytes"] += rollup.bytes
+                entry["interfaces"][interface or ""] = rollup.summary()
+            else:
+                devices[key] = rollup.summary()
+
+        return {
+            "aggregate": {
+                "start": start.isoformat() + "Z",
+                "end": end.isoformat() + "Z",
+                "window": self.window,
+                "devices": devices,
+            }
+        }
+
+    def emit(self, printer):
+        document = self.collect()
+        if document:
+            printer(self.render(document))
+
+    async def run(self, printer):
+        """ Emits a summary every window until cancelled. """
+        while True:
+            await asyncio.sleep(self.window)
+            try:
+                self.emit(printer)
+            except Exception as e:
+                logger.error("Unable to emit aggregate: %s", e)
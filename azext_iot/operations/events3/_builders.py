@@ -1,12 +1,63 @@
 import asyncio
+import os
 import uamqp
 from time import time
 
+from knack.log import get_logger
 from azext_iot.common.sas_token_auth import SasTokenAuthentication
 from azext_iot.common.utility import (parse_entity, unicode_binary_map, url_encode_str)
+from azext_iot.operations.events3._cache import get_cache_dir, load_json, safe_name, save_json
+
+logger = get_logger(__name__)
 
 DEBUG = True
 
+# Event Hub compatible endpoints rarely change, re-discover them at least daily
+ENDPOINT_CACHE_TTL_SEC = 24 * 60 * 60
+
+
+def _endpoint_cache_path(hub_host, cache_dir=None):
+    return os.path.join(cache_dir or get_cache_dir(), 'endpoints', '{}.json'.format(safe_name(hub_host)))
+
+
+def load_cached_endpoint(hub_host, ttl=ENDPOINT_CACHE_TTL_SEC, cache_dir=None):
+    """ Returns the cached Event Hub compatible endpoint of an IoT Hub host if not expired. """
+    cached = load_json(_endpoint_cache_path(hub_host, cache_dir))
+    if not isinstance(cached, dict) or time() - cached.get('cached_at', 0) > ttl:
+        return None
+    events = cached.get('events')
+    if not isinstance(events, dict) or not all(
+            events.get(key) for key in ('endpoint', 'path', 'address', 'partition_ids')):
+        return None
+    return events
+
+
+def cache_endpoint(hub_host, events, cache_dir=None):
+    save_json(_endpoint_cache_path(hub_host, cache_dir), {'cached_at': time(), 'events': events})
+
+
+def invalidate_cached_endpoint(hub_host, cache_dir=None):
+    path = _endpoint_cache_path(hub_host, cache_dir)
+    try:
+        os.remove(path)
+        logger.info('Invalidated cached Event Hub endpoint of %s', hub_host)
+    except OSError:
+        pass
+
+
+def build_auth_container(auth_spec):
+    """
+    Build a uamqp auth container from a plain dict spec.
+
+    Auth containers can't cross process boundaries, so event hub targets also carry
+    the spec used to create them. Specs hold either a shared access key or a pre-signed token.
+    """
+    if auth_spec.get('token'):
+        return uamqp.authentication.SASTokenAsync(audience=auth_spec['uri'], uri=auth_spec['uri'],
+                                                  expires_at=auth_spec['expiry'], token=auth_spec['token'])
+    return uamqp.authentication.SASTokenAsync.from_shared_access_key(auth_spec['uri'], auth_spec['policy'],
+                                                                     auth_spec['key'])
+
 
 class AmqpBuilder():
     @classmethod
@@ -27,16 +78,28 @@ class EventTargetBuilder():
     def build_iot_hub_target(self, target):
         return self.eventLoop.run_until_complete(self._build_iot_hub_target_async(target))
 
+    def build_iot_hub_targets(self, targets):
+        """ Builds the targets of several IoT Hubs, discovering their endpoints concurrently. """
+        return self.eventLoop.run_until_complete(
+            asyncio.gather(*[self._build_iot_hub_target_async(target) for target in targets])
+        )
+
     def build_central_event_hub_target(self, cmd, app_id):
         return self.eventLoop.run_until_complete(self._build_central_event_hub_target_async(cmd, app_id))
 
-    def _build_auth_container(self, target):
+    def _build_auth_spec(self, target):
         sas_uri = 'sb://{}/{}'.format(target['events']['endpoint'], target['events']['path'])
-        return uamqp.authentication.SASTokenAsync.from_shared_access_key(sas_uri, target['policy'], target['primarykey'])
+        return {'uri': sas_uri, 'policy': target['policy'], 'key': target['primarykey']}
 
-    def _build_auth_container_from_token(self, endpoint, path, token, tokenExpiry):
+    def _build_auth_spec_from_token(self, endpoint, path, token, tokenExpiry):
         sas_uri = 'sb://{}/{}'.format(endpoint, path)
-        return uamqp.authentication.SASTokenAsync(audience=sas_uri, uri=sas_uri, expires_at=tokenExpiry, token=token)
+        return {'uri': sas_uri, 'token': token, 'expiry': tokenExpiry}
+
+    def _build_auth_container(self, target):
+        return build_auth_container(self._build_auth_spec(target))
+
+    def _build_auth_container_from_token(self, endpoint, path, token, tokenExpiry):
+        return build_auth_container(self._build_auth_spec_from_token(endpoint, path, token, tokenExpiry))
 
     async def _query_meta_data(self, endpoint, path, auth):
         source = uamqp.address.Source(endpoint)
@@ -93,42 +156,53 @@ class EventTargetBuilder():
         for i in range(int(partition_count)):
             partition_ids.append(str(i))
         partitions = partition_ids
-        auth = self._build_auth_container_from_token(endpoint, path, eventHubToken['sasToken'], tokenExpiry)
+        auth_spec = self._build_auth_spec_from_token(endpoint, path, eventHubToken['sasToken'], tokenExpiry)
 
         eventHubTarget = {
             'endpoint': endpoint,
             'path': path,
-            'auth': auth,
+            'auth': build_auth_container(auth_spec),
+            'auth_spec': auth_spec,
             'partitions': partitions
         }
 
         return eventHubTarget
 
     async def _build_iot_hub_target_async(self, target):
+        cache_key = None
         if 'events' not in target:
-            endpoint = AmqpBuilder.build_iothub_amqp_endpoint_from_target(target)
-            _, update = await self._evaluate_redirect(endpoint)
-            target['events'] = update['events']
+            cache_key = target['entity']
+            cached = load_cached_endpoint(cache_key)
+            if cached:
+                target['events'] = cached
+            else:
+                endpoint = AmqpBuilder.build_iothub_amqp_endpoint_from_target(target)
+                _, update = await self._evaluate_redirect(endpoint)
+                target['events'] = update['events']
+                auth = self._build_auth_container(target)
+                meta_data = await self._query_meta_data(target['events']['address'], target['events']['path'], auth)
+                partition_count = meta_data[b'partition_count']
+                partition_ids = []
+                for i in range(int(partition_count)):
+                    partition_ids.append(str(i))
+                target['events']['partition_ids'] = partition_ids
+                cache_endpoint(cache_key, target['events'])
             endpoint = target['events']['endpoint']
             path = target['events']['path']
-            auth = self._build_auth_container(target)
-            meta_data = await self._query_meta_data(target['events']['address'], target['events']['path'], auth)
-            partition_count = meta_data[b'partition_count']
-            partition_ids = []
-            for i in range(int(partition_count)):
-                partition_ids.append(str(i))
-            target['events']['partition_ids'] = partition_ids
         else:
             endpoint = target['events']['endpoint']
             path = target['events']['path']
         partitions = target['events']['partition_ids']
-        auth = self._build_auth_container(target)
+        auth_spec = self._build_auth_spec(target)
 
         eventHubTarget = {
             'endpoint': endpoint,
             'path': path,
-            'auth': auth,
-            'partitions': partitions
+            'auth': build_auth_container(auth_spec),
+            'auth_spec': auth_spec,
+            'partitions': partitions,
+            'cache_key': cache_key,
+            'hub': target['entity'].split('.')[0]
         }
 
         return eventHubTarget
@@ -0,0 +1,184 @@
+# coding=utf-8
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+"""
+c2d: Cloud-to-device message building and pipelined batch sending.
+
+Batches are spread over a small pool of AMQP send clients. Each client queues a window
+of messages at once so transfers are pipelined over its link instead of waiting on the
+settlement of every message.
+"""
+
+import asyncio
+from collections import Counter
+from time import perf_counter
+from uuid import uuid4
+
+import uamqp
+
+from knack.log import get_logger
+from knack.util import CLIError
+from azext_iot.operations.events3._builders import AmqpBuilder
+
+logger = get_logger(__name__)
+
+DEBUG = True
+
+C2D_OPERATION = "/messages/devicebound"
+SEND_CLIENTS_DEFAULT = 1
+SEND_CLIENTS_MAX = 16
+# Messages queued on a send client before awaiting their settlement
+SEND_WINDOW = 256
+
+
+def build_c2d_message(
+    device_id, data, properties=None, correlation_id=None, ack=None, message_id=None
+):
+    """
+    Returns:
+        (msg_id, uamqp.Message)
+    """
+    app_props = {}
+    if properties:
+        app_props.update(properties)
+
+    app_props["iothub-ack"] = ack if ack else "none"
+
+    msg_props = uamqp.message.MessageProperties()
+    msg_props.to = "/devices/{}/messages/devicebound".format(device_id)
+    msg_id = message_id or str(uuid4())
+    msg_props.message_id = msg_id
+
+    if correlation_id:
+        msg_props.correlation_id = correlation_id
+
+    message = uamqp.Message(
+        str.encode(data), properties=msg_props, application_properties=app_props
+    )
+    return msg_id, message
+
+
+class C2DBatchSender(object):
+    """
+    Sends C2D message records over a pool of AMQP send clients.
+
+    Args:
+        target (dict): IoT Hub connection target.
+        clients (int): number of send clients, each with its own connection.
+        window (int): messages queued per client before awaiting their settlement.
+        token_duration (int): lifetime in seconds of the send client SAS tokens.
+        correlator (FeedbackCorrelator): when set, messages requesting an ack are expected on it.
+    """
+
+    def __init__(
+        self,
+        target,
+        clients=SEND_CLIENTS_DEFAULT,
+        window=SEND_WINDOW,
+        token_duration=3600,
+        correlator=None,
+    ):
+        self.target = target
+        self.clients = max(1, min(clients or SEND_CLIENTS_DEFAULT, SEND_CLIENTS_MAX))
+        self.window = window
+        self.token_duration = token_duration
+        self.correlator = correlator
+        self.elapsed = 0
+
+    def _build_client(self):
+        endpoint = AmqpBuilder.build_iothub_amqp_endpoint_from_target(
+            self.target, duration=self.token_duration
+        )
+        return uamqp.SendClientAsync("amqps://" + endpoint + C2D_OPERATION, debug=DEBUG)
+
+    async def send(self, records):
+        """
+        Sends message records, dicts with 'deviceId', 'data' and optional 'properties',
+        'correlationId', 'ack' and 'messageId'.
+
+        Returns:
+            results (list): per record message Id and final send state, in record order.
+        """
+        results = [None] * len(records)
+        pending = iter(enumerate(records))
+        start = perf_counter()
+        workers = [
+            asyncio.ensure_future(self._send_worker(pending, results))
+            for _ in range(min(self.clients, len(records)))
+        ]
+        if workers:
+            done, running = await asyncio.wait(workers, return_when=asyncio.FIRST_EXCEPTION)
+            if running:
+                # A worker failed, stop the others so their clients are closed before the error is raised
+                for worker in running:
+                    worker.cancel()
+                await asyncio.wait(running)
+            for worker in done:
+                worker.result()
+        self.elapsed = perf_counter() - start
+        return results
+
+    async def _send_worker(self, pending, results):
+        client = self._build_client()
+        try:
+            try:
+                await client.open_async()
+            except Exception as e:
+                raise CLIError("Opening a C2D send connection failed: {}".format(e))
+            while True:
+                window = []
+                for index, record in pending:
+                    window.append(self._queue(client, index, record, results))
+                    if len(window) == self.window:
+                        break
+                if not window:
+                    return
+                try:
+                    await client.send_all_messages_async(close_on_done=False)
+                except uamqp.errors.MessageException as e:
+                    logger.debug("C2D send window failed: %s", e)
+                for index, message in window:
+                    results[index]["state"] = message.state.name
+        finally:
+            await client.close_async()
+
+    def _queue(self, client, index, record, results):
+        ack = record.get("ack")
+        msg_id, message = build_c2d_message(
+            record["deviceId"],
+            record["data"],
+            properties=record.get("properties"),
+            correlation_id=record.get("correlationId"),
+            ack=ack,
+            message_id=record.get("messageId"),
+        )
+        results[index] = {"deviceId": record["deviceId"], "messageId": msg_id, "state": None}
+        if self.correlator and ack and ack != "none":
+            self.correlator.expect(msg_id)
+        client.queue_message(message)
+        return index, message
+
+
+def summarize_c2d_batch(results, elapsed, feedback=None):
+    """ Builds the send-batch report from per-message results and optional feedback results. """
+    states = Counter(result["state"] for result in results)
+    report = {
+        "messages": len(results),
+        "sent": states.get(uamqp.constants.MessageState.SendComplete.name, 0),
+        "failed": len(results) - states.get(uamqp.constants.MessageState.SendComplete.name, 0),
+        "elapsedSec": round(elapsed, 3),
+        "messagesPerSec": round(len(results) / elapsed, 1) if elapsed else None,
+    }
+    if feedback is not None:
+        by_id = {result["messageId"]: result for result in feedback}
+        for result in results:
+            outcome = by_id.get(result["messageId"])
+            if outcome:
+                result["feedback"] = outcome["outcome"]
+                result["feedbackLatencyMs"] = outcome["latencyMs"]
+        report["feedback"] = dict(Counter(result["outcome"] for result in feedback))
+    report["results"] = results
+    return report
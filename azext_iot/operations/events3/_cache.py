@@ -0,0 +1,66 @@
+# coding=utf-8
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+"""
+cache: Small local JSON caches kept by the event monitor between runs.
+
+Cache files live under the Azure CLI configuration directory and are always replaced
+atomically, so concurrent monitors never observe a partially written file.
+"""
+
+import json
+import os
+import re
+import tempfile
+
+from knack.log import get_logger
+
+logger = get_logger(__name__)
+
+CACHE_DIR_NAME = "azext_iot"
+
+_UNSAFE_PATH_CHARS = re.compile(r"[^A-Za-z0-9._-]")
+
+
+def safe_name(value):
+    """ Maps a value to a string usable as a file or directory name. """
+    return _UNSAFE_PATH_CHARS.sub("_", value)
+
+
+def get_cache_dir():
+    config_dir = os.environ.get("AZURE_CONFIG_DIR") or os.path.join("~", ".azure")
+    return os.path.join(os.path.abspath(os.path.expanduser(config_dir)), CACHE_DIR_NAME)
+
+
+def load_json(path):
+    """ Returns the JSON content of a cache file, or None if it is missing or unreadable. """
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (ValueError, OSError) as e:
+        logger.debug("Ignoring unreadable cache file %s: %s", path, e)
+        return None
+
+
+def save_json(path, content):
+    """ Atomically replaces a cache file. Failures are logged and ignored. """
+    temp_path = None
+    try:
+        directory, name = os.path.split(path)
+        os.makedirs(directory, exist_ok=True)
+        # Unique per process and call, so concurrent writers never share a temp file
+        fd, temp_path = tempfile.mkstemp(prefix="{}.{}.".format(name, os.getpid()), suffix=".tmp", dir=directory)
+        with os.fdopen(fd, "w") as f:
+            json.dump(content, f)
+        os.replace(temp_path, path)
+        return True
+    except OSError as e:
+        logger.debug("Unable to write cache file %s: %s", path, e)
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
@@ -0,0 +1,198 @@
+# coding=utf-8
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+"""
+capture: Raw event capture log for offline replay through the monitor pipeline.
+
+A capture file starts with CAPTURE_MAGIC followed by length-prefixed records:
+
+    record := uint32 length | uint32 header length | header (JSON) | body
+
+The JSON header holds the partition, receive time, annotations, system properties and
+application properties. Binary values are tagged so replayed messages are identical to
+received ones. Files ending in '.gz' are gzip compressed and files ending in '.zst'
+zstd compressed (requires the zstandard package). Compression is detected on read.
+"""
+
+import base64
+import gzip
+import io
+import json
+import os
+import struct
+from time import time
+
+from azext_iot.operations.events3._views import SYSTEM_PROPERTIES
+
+CAPTURE_MAGIC = b"AZIOTEV1"
+
+_LENGTH = struct.Struct(">I")
+_GZIP_MAGIC = b"\x1f\x8b"
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+_BYTES_TAG = "$b"
+
+
+def _encode(value):
+    if isinstance(value, bytes):
+        return {_BYTES_TAG: base64.b64encode(value).decode("ascii")}
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+def _decode(value):
+    if isinstance(value, dict) and _BYTES_TAG in value:
+        return base64.b64decode(value[_BYTES_TAG])
+    return value
+
+
+def _encode_map(target):
+    if not target:
+        return None
+    return [[_encode(k), _encode(v)] for k, v in target.items()]
+
+
+def _decode_map(pairs):
+    if not pairs:
+        return None
+    return {_decode(k): _decode(v) for k, v in pairs}
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError(
+            "zstd compressed captures require the 'zstandard' package. Use a '.gz' file instead."
+        )
+    return zstandard
+
+
+def _open_write(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "wb")
+    if path.endswith(".zst"):
+        raw = open(path, "wb")
+        return _zstandard().ZstdCompressor().stream_writer(raw)
+    return open(path, "wb")
+
+
+def _open_read(path):
+    with open(path, "rb") as f:
+        magic = f.read(len(_ZSTD_MAGIC))
+    if magic.startswith(_GZIP_MAGIC):
+        return gzip.open(path, "rb")
+    if magic == _ZSTD_MAGIC:
+        raw = open(path, "rb")
+        return io.BufferedReader(_zstandard().ZstdDecompressor().stream_reader(raw))
+    return open(path, "rb")
+
+
+class CaptureWriter(object):
+    """
+    Appends received messages to a capture file.
+
+    Args:
+        path (str): capture file, compression selected by its extension.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.count = 0
+        self._stream = _open_write(self.path)
+        self._stream.write(CAPTURE_MAGIC)
+
+    def write(self, partition, msg, received_ms=None):
+        properties = msg.properties
+        system = None
+        if properties:
+            system = {}
+            for name in SYSTEM_PROPERTIES:
+                value = getattr(properties, name, None)
+                if value is not None:
+                    system[name] = _encode(value)
+
+        body = b""
+        data = msg.get_data()
+        if data:
+            body = next(data, None) or b""
+
+        header = json.dumps(
+            {
+                "p": str(partition),
+                "t": received_ms if received_ms is not None else int(time() * 1000),
+                "a": _encode_map(msg.annotations),
+                "s": system,
+                "ap": _encode_map(msg.application_properties),
+            },
+            separators=(",", ":"),
+        ).encode("utf8")
+
+        self._stream.write(_LENGTH.pack(_LENGTH.size + len(header) + len(body)))
+        self._stream.write(_LENGTH.pack(len(header)))
+        self._stream.write(header)
+        self._stream.write(body)
+        self.count += 1
+
+    def close(self):
+        self._stream.close()
+
+
+class _ReplayProperties(object):
+    def __init__(self, values):
+        for name in SYSTEM_PROPERTIES:
+            setattr(self, name, values.get(name))
+
+
+class ReplayMessage(object):
+    """ Captured message exposing the parts of uamqp.Message read by the monitor pipeline. """
+
+    __slots__ = ("annotations", "properties", "application_properties", "body")
+
+    def __init__(self, body, annotations=None, properties=None, application_properties=None):
+        self.body = body
+        self.annotations = annotations or {}
+        self.properties = properties
+        self.application_properties = application_properties
+
+    def get_data(self):
+        return iter((self.body,))
+
+
+def read_capture(path):
+    """
+    Reads a capture file.
+
+    Yields:
+        (partition, received_ms, ReplayMessage)
+    """
+    with _open_read(os.path.abspath(os.path.expanduser(path))) as stream:
+        if stream.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError("'{}' is not an event capture file.".format(path))
+        while True:
+            prefix = stream.read(_LENGTH.size)
+            if len(prefix) < _LENGTH.size:
+                return
+            (length,) = _LENGTH.unpack(prefix)
+            record = stream.read(length)
+            if len(record) < length:
+                # Truncated trailing record, e.g. from an interrupted capture
+                return
+            (header_length,) = _LENGTH.unpack_from(record)
+            start = _LENGTH.size
+            header = json.loads(record[start:start + header_length].decode("utf8"))
+            body = record[start + header_length:]
+
+            system = header.get("s")
+            message = ReplayMessage(
+                body,
+                annotations=_decode_map(header.get("a")),
+                properties=_ReplayProperties(
+                    {k: _decode(v) for k, v in system.items()}
+                ) if system is not None else None,
+                application_properties=_decode_map(header.get("ap")),
+            )
+            yield header["p"], header["t"], message
@@ -0,0 +1,126 @@
+# coding=utf-8
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+"""
+checkpoints: Local store of the last received position per Event Hub partition.
+
+Checkpoints are kept per endpoint, path, consumer group and partition. Each partition
+has its own file so monitors running in separate worker processes never contend.
+"""
+
+import json
+import os
+from time import time
+
+from knack.log import get_logger
+from azext_iot.operations.events3._cache import safe_name, save_json
+
+logger = get_logger(__name__)
+
+CHECKPOINT_FLUSH_COUNT = 1000
+CHECKPOINT_FLUSH_INTERVAL_SEC = 5
+
+OFFSET_ANNOTATION = b"x-opt-offset"
+SEQUENCE_NUMBER_ANNOTATION = b"x-opt-sequence-number"
+
+
+class CheckpointStore(object):
+    """
+    Persists partition checkpoints under a local directory, flushed in batches.
+
+    Args:
+        checkpoint_dir (str): root directory of the store.
+        endpoint (str): Event Hub compatible endpoint host.
+        path (str): Event Hub compatible path.
+        consumer_group (str): consumer group the checkpoints belong to.
+        flush_count (int): number of updates after which pending checkpoints are written.
+        flush_interval (int): seconds after which pending checkpoints are written.
+    """
+
+    def __init__(
+        self,
+        checkpoint_dir,
+        endpoint,
+        path,
+        consumer_group,
+        flush_count=CHECKPOINT_FLUSH_COUNT,
+        flush_interval=CHECKPOINT_FLUSH_INTERVAL_SEC,
+    ):
+        self.root = os.path.join(
+            os.path.abspath(os.path.expanduser(checkpoint_dir)),
+            safe_name("{}_{}".format(endpoint, path)),
+            safe_name(consumer_group),
+        )
+        os.makedirs(self.root, exist_ok=True)
+        self.flush_count = flush_count
+        self.flush_interval = flush_interval
+
+        self._pending = {}
+        self._updates = 0
+        self._last_flush = time()
+
+    def _partition_path(self, partition):
+        return os.path.join(self.root, "{}.json".format(safe_name(str(partition))))
+
+    def load(self, partition):
+        """ Returns the stored checkpoint dict of a partition or None. """
+        path = self._partition_path(partition)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r") as f:
+                checkpoint = json.load(f)
+            if checkpoint.get("offset") is None:
+                return None
+            return checkpoint
+        except (ValueError, OSError) as e:
+            logger.warning("Ignoring unreadable checkpoint %s: %s", path, e)
+            return None
+
+    def update_from_message(self, partition, msg):
+        annotations = msg.annotations
+        if not annotations:
+            return
+        offset = annotations.get(OFFSET_ANNOTATION)
+        if offset is None:
+            return
+        if isinstance(offset, bytes):
+            offset = str(offset, "utf8")
+        self.update(partition, offset, annotations.get(SEQUENCE_NUMBER_ANNOTATION))
+
+    def update(self, partition, offset, sequence_number=None):
+        self._pending[partition] = {
+            "offset": str(offset),
+            "sequence_number": sequence_number,
+        }
+        self._updates += 1
+        if (
+            self._updates >= self.flush_count
+            or time() - self._last_flush >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        pending = self._pending
+        self._pending = {}
+        self._updates = 0
+        self._last_flush = time()
+
+        for partition, checkpoint in pending.items():
+            path = self._partition_path(partition)
+            if not save_json(path, checkpoint):
+                logger.warning("Unable to write checkpoint %s.", path)
+
+
+def build_source_filter(enqueuedtimeutc, checkpoint=None):
+    """ Builds the partition source filter, resuming after a checkpoint if one exists. """
+    if checkpoint:
+        return bytes(
+            "amqp.annotation.x-opt-offset > '{}'".format(checkpoint["offset"]), "utf8"
+        )
+    return bytes(
+        "amqp.annotation.x-opt-enqueuedtimeutc > " + str(enqueuedtimeutc), "utf8"
+    )
@@ -5,24 +5,36 @@
 # --------------------------------------------------------------------------------------------
 
 import asyncio
-import json
-import re
 import sys
+from functools import partial
+from time import perf_counter
 from uuid import uuid4
 import six
 
 import uamqp
-import yaml
 
 from azext_iot.constants import VERSION
-from azext_iot.common.utility import parse_entity, unicode_binary_map
 from knack.log import get_logger
-from azext_iot.operations.events3._builders import AmqpBuilder
+from azext_iot.operations.events3._aggregates import EventAggregator
+from azext_iot.operations.events3._builders import AmqpBuilder, invalidate_cached_endpoint
+from azext_iot.operations.events3._c2d import C2DBatchSender, build_c2d_message, summarize_c2d_batch
+from azext_iot.operations.events3._capture import CaptureWriter, read_capture
+from azext_iot.operations.events3._checkpoints import CheckpointStore, build_source_filter
+from azext_iot.operations.events3._feedback import FeedbackCorrelator
+from azext_iot.operations.events3._filters import compile_event_handler
+from azext_iot.operations.events3._metrics import MonitorMetrics
+from azext_iot.operations.events3._partitions import DevicePartitionMap, select_device_partitions
+from azext_iot.operations.events3._queues import OutputQueue, OUTPUT_QUEUE_SIZE, POLICY_BLOCK
+from azext_iot.operations.events3._sinks import build_sink, render_yaml, get_renderer
 
 logger = get_logger(__name__)
 
 DEBUG = True
 
+# Monitor failures that may come from a stale cached endpoint, detached links surface as RuntimeError.
+# OSError is left out, output failures such as a broken stdout pipe say nothing about the endpoint.
+ENDPOINT_ERRORS = (RuntimeError, uamqp.errors.AMQPError)
+
 
 def executor(
     target,
@@ -36,63 +48,398 @@ def executor(
     devices=None,
     interface_id=None,
     pnp_context=None,
+    workers=None,
+    checkpoint_dir=None,
+    prefetch=None,
+    batch_size=None,
+    output_file=None,
+    rotate_size=None,
+    compress=False,
+    aggregate=None,
+    aggregate_fields=None,
+    metrics=None,
+    metrics_file=None,
+    queue_size=None,
+    queue_policy=None,
+    record=None,
 ):
+    """
+    Monitors one Event Hub target, or a list of IoT Hub targets in one event loop.
+
+    Events of several targets share one output pipeline and are tagged with their source hub.
+    """
+    if isinstance(target, list):
+        if len(target) > 1:
+            return _execute_hubs(
+                target,
+                consumer_group=consumer_group,
+                enqueued_time=enqueued_time,
+                properties=properties,
+                timeout=timeout,
+                device_id=device_id,
+                output=output,
+                content_type=content_type,
+                devices=devices,
+                interface_id=interface_id,
+                pnp_context=pnp_context,
+                checkpoint_dir=checkpoint_dir,
+                prefetch=prefetch,
+                batch_size=batch_size,
+                output_file=output_file,
+                rotate_size=rotate_size,
+                compress=compress,
+                aggregate=aggregate,
+                aggregate_fields=aggregate_fields,
+                metrics=metrics,
+                metrics_file=metrics_file,
+                queue_size=queue_size,
+                queue_policy=queue_policy,
+                record=record,
+            )
+        target = target[0]
 
-    coroutines = []
-    coroutines.append(
-        initiate_event_monitor(
-            target,
-            consumer_group,
-            enqueued_time,
-            device_id,
-            properties,
-            timeout,
-            output,
-            content_type,
-            devices,
-            interface_id,
-            pnp_context,
+    device_filter_txt = None
+    if device_id:
+        device_filter_txt = " filtering on device: {},".format(device_id)
+
+    monitor_kwargs = {
+        "consumer_group": consumer_group,
+        "enqueued_time": enqueued_time,
+        "device_id": device_id,
+        "properties": properties,
+        "timeout": timeout,
+        "output": output,
+        "content_type": content_type,
+        "devices": devices,
+        "interface_id": interface_id,
+        "pnp_context": pnp_context,
+        "checkpoint_dir": checkpoint_dir,
+        "prefetch": prefetch,
+        "batch_size": batch_size,
+        "aggregate": aggregate,
+        "aggregate_fields": aggregate_fields,
+        "metrics": metrics,
+        "metrics_file": metrics_file,
+        "queue_size": queue_size,
+        "queue_policy": queue_policy,
+        "record": record,
+    }
+
+    partitions = select_device_partitions(target, device_id)
+    if len(partitions) < len(target["partitions"]):
+        target = dict(target, partitions=partitions)
+        device_filter_txt = " filtering on device: {} (partition {}),".format(
+            device_id, partitions[0]
+        )
+
+    sink = build_sink(output_file, rotate_size, compress)
+
+    if workers and workers > 1 and len(target["partitions"]) > 1:
+        from azext_iot.operations.events3._workers import partition_fanout
+
+        six.print_(
+            "Starting {}event monitor with {} workers,{} use ctrl-c to stop...".format(
+                "PnP " if pnp_context else "",
+                min(workers, len(target["partitions"])),
+                device_filter_txt if device_filter_txt else "",
+            )
         )
+        try:
+            partition_fanout(target, workers, printer=sink.write, **monitor_kwargs)
+        except RuntimeError as error:
+            _invalidate_endpoint(target, error)
+            raise
+        finally:
+            sink.close()
+        return
+
+    loop = _get_event_loop()
+    task = asyncio.ensure_future(
+        initiate_event_monitor(target, printer=sink.write, raise_errors=True, **monitor_kwargs), loop=loop
     )
 
+    six.print_(
+        "Starting {}event monitor,{} use ctrl-c to stop...".format(
+            "PnP " if pnp_context else "",
+            device_filter_txt if device_filter_txt else "",
+        )
+    )
+    try:
+        loop.run_until_complete(task)
+    except KeyboardInterrupt:
+        six.print_("Stopping event monitor...")
+        task.cancel()
+        loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+    except Exception as error:
+        _invalidate_endpoint(target, error)
+        logger.error(error)
+        raise RuntimeError(error)
+    finally:
+        sink.close()
+
+
+def _get_event_loop():
     loop = asyncio.get_event_loop()
     if loop.is_closed():
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
+    return loop
+
 
-    future = asyncio.gather(*coroutines, loop=loop, return_exceptions=True)
-    result = None
+def _execute_hubs(targets, output_file=None, rotate_size=None, compress=False, **monitor_kwargs):
+    device_id = monitor_kwargs["device_id"]
+    pnp_context = monitor_kwargs["pnp_context"]
+    targets = [
+        dict(target, partitions=select_device_partitions(target, device_id)) for target in targets
+    ]
 
+    sink = build_sink(output_file, rotate_size, compress)
+    loop = _get_event_loop()
+    task = asyncio.ensure_future(
+        monitor_hubs(targets, printer=sink.write, **monitor_kwargs), loop=loop
+    )
+
+    six.print_(
+        "Starting {}event monitor across {} hubs,{} use ctrl-c to stop...".format(
+            "PnP " if pnp_context else "",
+            len(targets),
+            " filtering on device: {},".format(device_id) if device_id else "",
+        )
+    )
     try:
-        device_filter_txt = None
-        if device_id:
-            device_filter_txt = " filtering on device: {},".format(device_id)
+        errors = loop.run_until_complete(task)
+    except KeyboardInterrupt:
+        six.print_("Stopping event monitor...")
+        task.cancel()
+        loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+        return
+    finally:
+        sink.close()
 
-        def stop_and_suppress_eloop():
-            try:
-                loop.stop()
-            except Exception:
-                pass
+    if errors:
+        for hub, error in errors:
+            logger.error("Monitor of hub %s failed: %s", hub, error)
+        raise RuntimeError(errors[0][1])
 
-        six.print_(
-            "Starting {}event monitor,{} use ctrl-c to stop...".format(
-                "PnP " if pnp_context else "",
-                device_filter_txt if device_filter_txt else "",
+
+async def monitor_hubs(
+    targets,
+    printer=None,
+    output=None,
+    content_type=None,
+    pnp_context=None,
+    aggregate=None,
+    aggregate_fields=None,
+    metrics=None,
+    metrics_file=None,
+    queue_size=None,
+    queue_policy=None,
+    record=None,
+    **monitor_kwargs
+):
+    """
+    Monitors several IoT Hub targets concurrently through one output pipeline.
+
+    A failing hub does not stop the others.
+
+    Returns:
+        errors (list): (hub, error) of every hub whose monitor failed.
+    """
+    if not printer:
+        printer = _print_event
+
+    pipeline = OutputPipeline(
+        printer,
+        output=output,
+        content_type=content_type,
+        pnp_context=pnp_context,
+        aggregate=aggregate,
+        aggregate_fields=aggregate_fields,
+        metrics=metrics,
+        metrics_file=metrics_file,
+        queue_size=queue_size,
+        queue_policy=queue_policy,
+    )
+    recorder = CaptureWriter(record) if record else None
+
+    pipeline.start()
+    try:
+        results = await asyncio.gather(
+            *[
+                initiate_event_monitor(
+                    target,
+                    printer=printer,
+                    output=output,
+                    content_type=content_type,
+                    pnp_context=pnp_context,
+                    pipeline=pipeline,
+                    recorder=recorder,
+                    hub=target["hub"],
+                    raise_errors=True,
+                    **monitor_kwargs
+                )
+                for target in targets
+            ],
+            return_exceptions=True
+        )
+    finally:
+        await pipeline.stop()
+        if recorder:
+            recorder.close()
+
+    errors = []
+    for target, result in zip(targets, results):
+        if isinstance(result, asyncio.CancelledError):
+            continue
+        if isinstance(result, BaseException):
+            _invalidate_endpoint(target, result)
+            errors.append((target["hub"], result))
+    return errors
+
+
+REPLAY_PACE_FAST = "fast"
+REPLAY_PACE_ORIGINAL = "original"
+
+# Events replayed between yields to the writer when nothing else suspends the replay
+REPLAY_YIELD_COUNT = 256
+
+
+def replay_executor(
+    replay_file,
+    pace=None,
+    properties=None,
+    device_id=None,
+    output=None,
+    content_type=None,
+    devices=None,
+    interface_id=None,
+    pnp_context=None,
+    output_file=None,
+    rotate_size=None,
+    compress=False,
+    aggregate=None,
+    aggregate_fields=None,
+    metrics=None,
+    metrics_file=None,
+    queue_size=None,
+    queue_policy=None,
+):
+    """ Replays a capture file through the monitor filter, decode and output pipeline. """
+    sink = build_sink(output_file, rotate_size, compress)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    six.print_(
+        "Replaying {}events from {}{}, use ctrl-c to stop...".format(
+            "PnP " if pnp_context else "",
+            replay_file,
+            " at original pace" if pace == REPLAY_PACE_ORIGINAL else "",
+        )
+    )
+    try:
+        loop.run_until_complete(
+            replay_events(
+                replay_file,
+                pace=pace,
+                printer=sink.write,
+                properties=properties,
+                device_id=device_id,
+                output=output,
+                content_type=content_type,
+                devices=devices,
+                interface_id=interface_id,
+                pnp_context=pnp_context,
+                aggregate=aggregate,
+                aggregate_fields=aggregate_fields,
+                metrics=metrics,
+                metrics_file=metrics_file,
+                queue_size=queue_size,
+                queue_policy=queue_policy,
             )
         )
-        future.add_done_callback(lambda future: stop_and_suppress_eloop())
-        result = loop.run_until_complete(future)
     except KeyboardInterrupt:
-        six.print_("Stopping event monitor...")
-        for t in asyncio.Task.all_tasks():
-            t.cancel()
-        loop.run_forever()
+        six.print_("Stopping event replay...")
+    finally:
+        sink.close()
+        loop.close()
+
+
+async def replay_events(
+    replay_file,
+    pace=None,
+    printer=None,
+    properties=None,
+    device_id=None,
+    output=None,
+    content_type=None,
+    devices=None,
+    interface_id=None,
+    pnp_context=None,
+    aggregate=None,
+    aggregate_fields=None,
+    metrics=None,
+    metrics_file=None,
+    queue_size=None,
+    queue_policy=None,
+):
+    if not printer:
+        printer = _print_event
+
+    pipeline = OutputPipeline(
+        printer,
+        output=output,
+        content_type=content_type,
+        pnp_context=pnp_context,
+        aggregate=aggregate,
+        aggregate_fields=aggregate_fields,
+        metrics=metrics,
+        metrics_file=metrics_file,
+        queue_size=queue_size,
+        queue_policy=queue_policy,
+    )
+    put = pipeline.output_queue.put
+    handlers = {}
+    loop = asyncio.get_event_loop()
+    first_ms = None
+    started = loop.time()
+
+    pipeline.start()
+    try:
+        for count, (partition, received_ms, msg) in enumerate(read_capture(replay_file), 1):
+            if pace == REPLAY_PACE_ORIGINAL:
+                if first_ms is None:
+                    first_ms = received_ms
+                delay = (received_ms - first_ms) / 1000 - (loop.time() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            elif count % REPLAY_YIELD_COUNT == 0:
+                await asyncio.sleep(0)
+
+            handle_msg = handlers.get(partition)
+            if handle_msg is None:
+                handle_msg = handlers[partition] = compile_event_handler(
+                    device_id=device_id,
+                    devices=devices,
+                    interface_id=interface_id,
+                    pnp_context=pnp_context,
+                    properties=properties,
+                    content_type=content_type,
+                    output=output,
+                    aggregator=pipeline.aggregator,
+                    metrics=pipeline.partition_metrics(partition),
+                )
+            # Lag is measured against the recorded receive time, not the time of the replay
+            dump = handle_msg(msg, received_ms)
+            if dump:
+                await put(dump)
     finally:
-        if result:
-            error = next(res for res in result if result)
-            if error:
-                logger.error(error)
-                raise RuntimeError(error)
+        await pipeline.stop()
+
+
+def _invalidate_endpoint(target, error):
+    # A link, connection or auth error may be caused by a stale cached endpoint, re-discover it next run
+    if target.get("cache_key") and isinstance(error, ENDPOINT_ERRORS):
+        invalidate_cached_endpoint(target["cache_key"])
 
 
 async def initiate_event_monitor(
@@ -107,7 +454,31 @@ async def initiate_event_monitor(
     devices=None,
     interface_id=None,
     pnp_context=None,
+    printer=None,
+    checkpoint_dir=None,
+    prefetch=None,
+    batch_size=None,
+    aggregate=None,
+    aggregate_fields=None,
+    metrics=None,
+    metrics_file=None,
+    queue_size=None,
+    queue_policy=None,
+    record=None,
+    pipeline=None,
+    recorder=None,
+    hub=None,
+    raise_errors=False,
 ):
+    """
+    Monitors every partition of an Event Hub target over one AMQP connection.
+
+    A pipeline and recorder shared with other targets may be provided, they are then
+    started and stopped by the caller. `hub` tags events and partition labels with their
+    source IoT Hub. With `raise_errors` the first partition failure is raised once every
+    partition has stopped, otherwise partition failures are ignored.
+    """
+
     def _get_conn_props():
         properties = {}
         properties["product"] = "az.cli.iot.extension"
@@ -120,6 +491,32 @@ async def initiate_event_monitor(
         logger.debug("No Event Hub partitions found to listen on.")
         return
 
+    checkpoints = None
+    if checkpoint_dir:
+        checkpoints = CheckpointStore(
+            checkpoint_dir, target["endpoint"], target["path"], consumer_group
+        )
+
+    if not printer:
+        printer = _print_event
+
+    owns_pipeline = pipeline is None
+    if owns_pipeline:
+        pipeline = OutputPipeline(
+            printer,
+            output=output,
+            content_type=content_type,
+            pnp_context=pnp_context,
+            aggregate=aggregate,
+            aggregate_fields=aggregate_fields,
+            metrics=metrics,
+            metrics_file=metrics_file,
+            queue_size=queue_size,
+            queue_policy=queue_policy,
+        )
+        recorder = CaptureWriter(record) if record else None
+    partition_map = DevicePartitionMap(target["endpoint"], target["path"])
+
     coroutines = []
 
     async with uamqp.ConnectionAsync(
@@ -147,9 +544,101 @@ async def initiate_event_monitor(
                     devices=devices,
                     interface_id=interface_id,
                     pnp_context=pnp_context,
+                    printer=printer,
+                    output_queue=pipeline.output_queue,
+                    observe=partition_map.observer(p),
+                    checkpoints=checkpoints,
+                    prefetch=prefetch,
+                    batch_size=batch_size,
+                    aggregator=pipeline.aggregator,
+                    metrics=pipeline.partition_metrics(_partition_label(hub, p)),
+                    recorder=recorder,
+                    hub=hub,
                 )
             )
-        await asyncio.gather(*coroutines, return_exceptions=True)
+        if owns_pipeline:
+            pipeline.start()
+        try:
+            results = await asyncio.gather(*coroutines, return_exceptions=True)
+            errors = [result for result in results if isinstance(result, Exception)]
+            if raise_errors and errors:
+                raise errors[0]
+        finally:
+            if owns_pipeline:
+                await pipeline.stop()
+                if recorder:
+                    recorder.close()
+            if checkpoints:
+                checkpoints.flush()
+            partition_map.save()
+
+
+def _partition_label(hub, partition):
+    return "{}/{}".format(hub, partition) if hub else partition
+
+
+class OutputPipeline(object):
+    """
+    Output stages shared by every partition of a monitor.
+
+    Owns the output queue and its writer, the optional aggregator and the optional
+    metrics registry, and starts and stops their background tasks together.
+    """
+
+    def __init__(
+        self,
+        printer,
+        output=None,
+        content_type=None,
+        pnp_context=None,
+        aggregate=None,
+        aggregate_fields=None,
+        metrics=None,
+        metrics_file=None,
+        queue_size=None,
+        queue_policy=None,
+    ):
+        self.printer = printer
+        self.output_queue = OutputQueue(
+            maxsize=queue_size or OUTPUT_QUEUE_SIZE, policy=queue_policy or POLICY_BLOCK
+        )
+        self.aggregator = None
+        if aggregate:
+            self.aggregator = EventAggregator(
+                aggregate,
+                fields=aggregate_fields,
+                per_interface=bool(pnp_context),
+                content_type=content_type,
+                render=get_renderer(output),
+            )
+        self.metrics = None
+        if metrics:
+            self.metrics = MonitorMetrics(metrics, metrics_file)
+            self.metrics.output_queue = self.output_queue
+
+        self._writer = None
+        self._tasks = []
+
+    def partition_metrics(self, partition):
+        return self.metrics.partition(partition) if self.metrics else None
+
+    def start(self):
+        self._writer = self.output_queue.start(self.printer)
+        if self.aggregator:
+            self._tasks.append(asyncio.ensure_future(self.aggregator.run(self.printer)))
+        if self.metrics:
+            self._tasks.append(asyncio.ensure_future(self.metrics.run()))
+
+    async def stop(self):
+        if self._writer and not self._writer.done():
+            await self.output_queue.close()
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self.aggregator:
+            self.aggregator.emit(self.printer)
+        if self.metrics:
+            self.metrics.report()
 
 
 async def monitor_events(
@@ -168,119 +657,107 @@ async def monitor_events(
     devices=None,
     interface_id=None,
     pnp_context=None,
+    printer=None,
+    checkpoints=None,
+    prefetch=None,
+    batch_size=None,
+    aggregator=None,
+    metrics=None,
+    output_queue=None,
+    observe=None,
+    recorder=None,
+    hub=None,
 ):
     source = uamqp.address.Source(
         "amqps://{}/{}/ConsumerGroups/{}/Partitions/{}".format(
             endpoint, path, consumer_group, partition
         )
     )
-    source.set_filter(
-        bytes("amqp.annotation.x-opt-enqueuedtimeutc > " + str(enqueuedtimeutc), "utf8")
+    checkpoint = checkpoints.load(partition) if checkpoints else None
+    if checkpoint:
+        logger.info(
+            "Resuming partition %s after offset %s", partition, checkpoint["offset"]
+        )
+    source.set_filter(build_source_filter(enqueuedtimeutc, checkpoint))
+
+    handle_msg = compile_event_handler(
+        device_id=device_id,
+        devices=devices,
+        interface_id=interface_id,
+        pnp_context=pnp_context,
+        properties=properties,
+        content_type=content_type,
+        output=output,
+        aggregator=aggregator,
+        metrics=metrics,
+        observe=observe,
+        hub=hub,
     )
-
-    def _output_msg_kpi(msg):
-        origin = str(msg.annotations.get(b"iothub-connection-device-id"), "utf8")
-        if device_id and device_id != origin:
-            if "*" in device_id or "?" in device_id:
-                regex = (
-                    re.escape(device_id).replace("\\*", ".*").replace("\\?", ".") + "$"
-                )
-                if not re.match(regex, origin):
-                    return
-            else:
-                return
-        if devices and origin not in devices:
-            return
-
-        if pnp_context:
-            msg_interface_id = str(
-                msg.annotations.get(b"iothub-interface-name"), "utf8"
-            )
-            if not msg_interface_id:
-                return
-
-            if interface_id:
-                if msg_interface_id != interface_id:
-                    return
-
-        event_source = {"event": {}}
-        event_source["event"]["origin"] = origin
-        payload = ""
-
-        data = msg.get_data()
-        if data:
-            payload = str(next(data), "utf8")
-
-        system_props = unicode_binary_map(parse_entity(msg.properties, True))
-
-        ct = content_type
-        if not ct:
-            ct = system_props["content_type"] if "content_type" in system_props else ""
-
-        if ct and ct.lower() == "application/json":
-            try:
-                payload = json.loads(
-                    re.compile(r"(\\r\\n)+|\\r+|\\n+").sub("", payload)
-                )
-            except Exception:
-                # We don't want to crash the monitor if JSON parsing fails
-                pass
-
-        event_source["event"]["payload"] = payload
-
-        if pnp_context:
-            event_source["event"]["interface"] = msg_interface_id
-
-            msg_schema = str(
-                msg.application_properties.get(b"iothub-message-schema"), "utf8"
-            )
-            interface_context = pnp_context["interface"].get(msg_interface_id)
-            if interface_context:
-                msg_schema_context = interface_context.get(msg_schema)
-                if msg_schema_context:
-                    msg_context_display = msg_schema_context.get("display")
-                    msg_context_unit = msg_schema_context.get("unit")
-
-                    if msg_context_display:
-                        event_source["event"]["payload"] = {}
-                        event_source["event"]["payload"][msg_context_display] = payload
-                        if msg_context_unit:
-                            event_source["event"]["payload"]["unit"] = msg_context_unit
-
-        if "anno" in properties or "all" in properties:
-            event_source["event"]["annotations"] = unicode_binary_map(msg.annotations)
-        if "sys" in properties or "all" in properties:
-            if not event_source["event"].get("properties"):
-                event_source["event"]["properties"] = {}
-            event_source["event"]["properties"]["system"] = system_props
-        if "app" in properties or "all" in properties:
-            if not event_source["event"].get("properties"):
-                event_source["event"]["properties"] = {}
-            app_prop = (
-                msg.application_properties if msg.application_properties else None
-            )
-
-            if app_prop:
-                event_source["event"]["properties"]["application"] = unicode_binary_map(
-                    app_prop
-                )
-        if output.lower() == "json":
-            dump = json.dumps(event_source, indent=4)
-        else:
-            dump = yaml.safe_dump(event_source, default_flow_style=False)
-        six.print_(dump, flush=True)
+    label = _partition_label(hub, partition)
+    if not printer:
+        printer = _print_event
+
+    if output_queue:
+        put = output_queue.put
+    else:
+
+        async def put(dump):
+            printer(dump)
+
+    if metrics:
+        enqueue = put
+
+        async def put(dump):
+            start = perf_counter()
+            await enqueue(dump)
+            metrics.add_time("output", perf_counter() - start)
+
+    def _process_batch(batch):
+        dumps = []
+        for msg in batch:
+            if recorder:
+                recorder.write(label, msg)
+            dump = handle_msg(msg)
+            if dump:
+                dumps.append(dump)
+            if checkpoints:
+                checkpoints.update_from_message(partition, msg)
+        return "\n".join(dumps) if dumps else None
 
     exp_cancelled = False
-    receive_client = uamqp.ReceiveClientAsync(
-        source, auth=auth, timeout=timeout, prefetch=0, debug=DEBUG
-    )
+    if batch_size:
+        # Idle timeout is applied per batch request rather than by the client
+        receive_client = uamqp.ReceiveClientAsync(
+            source, auth=auth, timeout=0, prefetch=prefetch or batch_size, debug=DEBUG
+        )
+    else:
+        receive_client = uamqp.ReceiveClientAsync(
+            source, auth=auth, timeout=timeout, prefetch=prefetch or 0, debug=DEBUG
+        )
 
     try:
         if connection:
             await receive_client.open_async(connection=connection)
 
-        async for msg in receive_client.receive_messages_iter_async():
-            _output_msg_kpi(msg)
+        if batch_size:
+            while True:
+                batch = await receive_client.receive_message_batch_async(
+                    max_batch_size=batch_size, timeout=timeout
+                )
+                if not batch:
+                    break
+                dumps = _process_batch(batch)
+                if dumps:
+                    await put(dumps)
+        else:
+            async for msg in receive_client.receive_messages_iter_async():
+                if recorder:
+                    recorder.write(label, msg)
+                dump = handle_msg(msg)
+                if dump:
+                    await put(dump)
+                if checkpoints:
+                    checkpoints.update_from_message(partition, msg)
 
     except asyncio.CancelledError:
         exp_cancelled = True
@@ -300,27 +777,20 @@ async def monitor_events(
         logger.info("Closed monitor on partition %s", partition)
 
 
-def send_c2d_message(
-    target, device_id, data, properties=None, correlation_id=None, ack=None
-):
-    app_props = {}
-    if properties:
-        app_props.update(properties)
-
-    app_props["iothub-ack"] = ack if ack else "none"
-
-    msg_props = uamqp.message.MessageProperties()
-    msg_props.to = "/devices/{}/messages/devicebound".format(device_id)
-    msg_id = str(uuid4())
-    msg_props.message_id = msg_id
-
-    if correlation_id:
-        msg_props.correlation_id = correlation_id
+def _print_event(dump):
+    six.print_(dump, flush=True)
 
-    msg_content = str.encode(data)
 
-    message = uamqp.Message(
-        msg_content, properties=msg_props, application_properties=app_props
+def send_c2d_message(
+    target, device_id, data, properties=None, correlation_id=None, ack=None, message_id=None
+):
+    msg_id, message = build_c2d_message(
+        device_id,
+        data,
+        properties=properties,
+        correlation_id=correlation_id,
+        ack=ack,
+        message_id=message_id,
     )
 
     operation = "/messages/devicebound"
@@ -333,32 +803,113 @@ def send_c2d_message(
     return msg_id, errors
 
 
-def monitor_feedback(target, device_id, wait_on_id=None, token_duration=3600):
-    def handle_msg(msg):
-        payload = next(msg.get_data())
-        if isinstance(payload, bytes):
-            payload = str(payload, "utf8")
-        # assume json [] based on spec
-        payload = json.loads(payload)
-        for p in payload:
-            if (
-                device_id
-                and p.get("deviceId")
-                and p["deviceId"].lower() != device_id.lower()
-            ):
-                return None
-            six.print_(yaml.dump({"feedback": p}, default_flow_style=False), flush=True)
-            if wait_on_id:
-                msg_id = p["originalMessageId"]
-                if msg_id == wait_on_id:
-                    return msg_id
-        return None
-
-    operation = "/messages/servicebound/feedback"
-    endpoint = AmqpBuilder.build_iothub_amqp_endpoint_from_target(
-        target, duration=token_duration
+def send_c2d_batch(target, records, clients=None, wait_on_feedback=False, timeout=None):
+    """
+    Sends C2D message records over pooled send clients, optionally waiting on their feedback.
+
+    Returns:
+        report (dict): send totals, throughput and per-message state and feedback outcome.
+    """
+    correlator = FeedbackCorrelator(target) if wait_on_feedback else None
+    sender = C2DBatchSender(target, clients=clients, correlator=correlator)
+
+    six.print_(
+        "Sending {} C2D messages over {} connection(s){}...".format(
+            len(records),
+            sender.clients,
+            ", waiting on feedback" if correlator else "",
+        )
     )
-    endpoint = endpoint + operation
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        results, feedback = loop.run_until_complete(
+            _send_c2d_batch(sender, records, correlator, timeout)
+        )
+    finally:
+        loop.close()
+    return summarize_c2d_batch(results, sender.elapsed, feedback)
+
+
+async def _send_c2d_batch(sender, records, correlator, timeout):
+    if not correlator:
+        return await sender.send(records), None
+
+    await correlator.open()
+    try:
+        results = await sender.send(records)
+        return results, await correlator.wait(timeout)
+    finally:
+        await correlator.close()
+
+
+def send_c2d_message_wait_feedback(
+    target, device_id, data, properties=None, correlation_id=None, ack=None, timeout=None
+):
+    """
+    Sends a C2D message and waits on its feedback. The feedback link is opened before sending.
+
+    Returns:
+        (msg_id, errors, result): result holds the feedback outcome and latency of the message.
+    """
+    correlator = FeedbackCorrelator(target, device_id)
+    msg_id = str(uuid4())
+    errors = []
+
+    async def send():
+        correlator.expect(msg_id)
+        # The send client is synchronous, keep the loop free for the feedback receiver
+        _, send_errors = await asyncio.get_event_loop().run_in_executor(
+            None,
+            partial(
+                send_c2d_message,
+                target,
+                device_id,
+                data,
+                properties=properties,
+                correlation_id=correlation_id,
+                ack=ack,
+                message_id=msg_id,
+            ),
+        )
+        errors.extend(send_errors)
+        return not send_errors
+
+    six.print_("Waiting on feedback of message {}, use ctrl-c to stop...".format(msg_id))
+    results = _run_feedback(correlator, wait=True, timeout=timeout, send=send)
+    return msg_id, errors, results[0] if results else None
+
+
+def monitor_feedback(
+    target,
+    device_id,
+    wait_on_id=None,
+    token_duration=3600,
+    output=None,
+    output_file=None,
+    rotate_size=None,
+    compress=False,
+    timeout=None,
+):
+    """
+    Prints C2D feedback records, optionally until feedback of every `wait_on_id` arrived.
+
+    Returns:
+        results (list): outcome of every waited on message Id, None when not waiting.
+    """
+    render = get_renderer(output) if output else render_yaml
+    sink = build_sink(output_file, rotate_size, compress)
+
+    wait_on_ids = [wait_on_id] if isinstance(wait_on_id, str) else list(wait_on_id or [])
+    correlator = FeedbackCorrelator(
+        target,
+        device_id,
+        token_duration=token_duration,
+        on_record=lambda record: sink.write(render({"feedback": record})),
+    )
+    for msg_id in wait_on_ids:
+        # Send time is unknown, so no latency is reported
+        correlator.expect(msg_id, sent_at=None)
 
     device_filter_txt = None
     if device_id:
@@ -371,15 +922,35 @@ def monitor_feedback(target, device_id, wait_on_id=None, token_duration=3600):
     )
 
     try:
-        client = uamqp.ReceiveClient("amqps://" + endpoint, debug=DEBUG)
-        message_generator = client.receive_messages_iter()
-        for msg in message_generator:
-            match = handle_msg(msg)
-            if match:
-                logger.info("requested msg id has been matched...")
-                msg.accept()
-                return match
+        return _run_feedback(correlator, wait=bool(wait_on_ids), timeout=timeout)
+    finally:
+        sink.close()
+
+
+def _run_feedback(correlator, wait, timeout=None, send=None):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(
+            _correlate_feedback(correlator, wait, timeout=timeout, send=send)
+        )
+    except KeyboardInterrupt:
+        six.print_("Stopping C2D feedback monitor...")
+        loop.run_until_complete(correlator.close())
+    finally:
+        loop.close()
+
+
+async def _correlate_feedback(correlator, wait, timeout=None, send=None):
+    try:
+        await correlator.open()
+        if send is not None and not await send():
+            return None
+        if not wait:
+            await correlator.run()
+            return None
+        return await correlator.wait(timeout)
     except uamqp.errors.AMQPConnectionError:
         logger.debug("amqp connection has expired...")
     finally:
-        client.close()
+        await correlator.close()
@@ -0,0 +1,173 @@
+# coding=utf-8
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+"""
+feedback: Correlates cloud-to-device feedback records with sent message Ids.
+
+The feedback link is opened before messages are sent, so every record of an expected
+message is seen. Any number of outstanding messages are resolved over the one link.
+"""
+
+import asyncio
+import json
+from time import perf_counter
+
+import uamqp
+
+from knack.log import get_logger
+from azext_iot.operations.events3._builders import AmqpBuilder
+
+logger = get_logger(__name__)
+
+DEBUG = True
+
+FEEDBACK_OPERATION = "/messages/servicebound/feedback"
+FEEDBACK_BATCH_SIZE = 100
+# Upper bound a receive call blocks for, so a closing correlator is noticed promptly
+FEEDBACK_RECEIVE_TIMEOUT_MS = 1000
+
+OUTCOME_TIMEOUT = "Timeout"
+
+_UNSET = object()
+
+
+def parse_feedback(msg):
+    """ Returns the feedback records of a feedback message, a JSON array per the service spec. """
+    data = msg.get_data()
+    payload = next(data, None) if data else None
+    if not payload:
+        return []
+    if isinstance(payload, (bytes, bytearray, memoryview)):
+        payload = str(payload, "utf8")
+    records = json.loads(payload)
+    return records if isinstance(records, list) else [records]
+
+
+class FeedbackCorrelator(object):
+    """
+    Resolves outstanding C2D message Ids as their feedback records arrive.
+
+    Args:
+        target (dict): IoT Hub connection target.
+        device_id (str): only records of this device are considered.
+        token_duration (int): lifetime in seconds of the feedback link SAS token.
+        on_record (callable): called with every considered feedback record.
+    """
+
+    def __init__(self, target, device_id=None, token_duration=3600, on_record=None):
+        self.target = target
+        self.device_id = device_id.lower() if device_id else None
+        self.token_duration = token_duration
+        self.on_record = on_record
+        self.results = {}
+        self._outstanding = {}
+        self._resolved = None
+        self._client = None
+        self._receiver = None
+
+    @property
+    def outstanding(self):
+        return len(self._outstanding)
+
+    def expect(self, msg_id, sent_at=_UNSET):
+        """
+        Registers a message Id to correlate. Latency is measured from `sent_at`, a
+        perf_counter() value defaulting to now. Pass None when the send time is unknown.
+        """
+        self._outstanding[msg_id] = perf_counter() if sent_at is _UNSET else sent_at
+        if self._resolved:
+            self._resolved.clear()
+
+    def handle(self, msg):
+        now = perf_counter()
+        for record in parse_feedback(msg):
+            if self.device_id and record.get("deviceId") and record["deviceId"].lower() != self.device_id:
+                continue
+            if self.on_record:
+                self.on_record(record)
+            self._resolve(record, now)
+
+    def _resolve(self, record, now):
+        msg_id = record.get("originalMessageId")
+        sent_at = self._outstanding.pop(msg_id, _UNSET)
+        if sent_at is _UNSET:
+            return
+        self.results[msg_id] = {
+            "messageId": msg_id,
+            "deviceId": record.get("deviceId"),
+            "outcome": record.get("statusCode"),
+            "description": record.get("description"),
+            "latencyMs": round((now - sent_at) * 1000, 1) if sent_at is not None else None,
+        }
+        if not self._outstanding and self._resolved:
+            self._resolved.set()
+
+    async def open(self):
+        """ Opens the feedback link and starts receiving. """
+        endpoint = AmqpBuilder.build_iothub_amqp_endpoint_from_target(
+            self.target, duration=self.token_duration
+        )
+        self._resolved = asyncio.Event()
+        if not self._outstanding:
+            self._resolved.set()
+        self._client = uamqp.ReceiveClientAsync(
+            "amqps://" + endpoint + FEEDBACK_OPERATION,
+            prefetch=FEEDBACK_BATCH_SIZE,
+            debug=DEBUG,
+        )
+        await self._client.open_async()
+        self._receiver = asyncio.ensure_future(self._receive())
+
+    async def _receive(self):
+        while True:
+            batch = await self._client.receive_message_batch_async(
+                max_batch_size=FEEDBACK_BATCH_SIZE, timeout=FEEDBACK_RECEIVE_TIMEOUT_MS
+            )
+            for msg in batch:
+                try:
+                    self.handle(msg)
+                except ValueError as e:
+                    logger.debug("Ignoring unparsable feedback message: %s", e)
+
+    async def wait(self, timeout=None):
+        """
+        Waits until every expected message is resolved, the link fails or `timeout` seconds pass.
+
+        Returns:
+            results (list): per message Id outcome, 'Timeout' for unresolved messages.
+        """
+        if self._outstanding:
+            resolved = asyncio.ensure_future(self._resolved.wait())
+            done, _ = await asyncio.wait(
+                [resolved, self._receiver], timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            resolved.cancel()
+            if self._receiver in done:
+                self._receiver.result()
+
+        for msg_id in list(self._outstanding):
+            self.results[msg_id] = {
+                "messageId": msg_id,
+                "deviceId": None,
+                "outcome": OUTCOME_TIMEOUT,
+                "description": None,
+                "latencyMs": None,
+            }
+        self._outstanding = {}
+        return list(self.results.values())
+
+    async def run(self):
+        """ Receives until the link is closed or fails. """
+        await self._receiver
+
+    async def close(self):
+        if self._receiver:
+            self._receiver.cancel()
+            await asyncio.gather(self._receiver, return_exceptions=True)
+            self._receiver = None
+        if self._client:
+            await self._client.close_async()
+            self._client = None
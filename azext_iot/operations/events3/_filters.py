@@ -0,0 +1,267 @@
+# coding=utf-8
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+"""
+filters: Compile monitor filter and projection options once per monitor.
+
+The resulting predicate and projector are applied to every received message,
+so anything that only depends on user input is resolved up front.
+"""
+
+import json
+import re
+from time import perf_counter
+
+from azext_iot.operations.events3._pnp import compile_pnp_decoders
+from azext_iot.operations.events3._sinks import get_renderer
+from azext_iot.operations.events3._views import EventView
+
+NEWLINE_PATTERN = re.compile(r"(\\r\\n)+|\\r+|\\n+")
+
+MESSAGE_SCHEMA_PROPERTY = b"iothub-message-schema"
+
+
+def compile_device_pattern(device_id):
+    """ Compiles a device Id containing '*' or '?' wildcards. Returns None for literal Ids. """
+    if not device_id or ("*" not in device_id and "?" not in device_id):
+        return None
+    return re.compile(
+        re.escape(device_id).replace("\\*", ".*").replace("\\?", ".") + "$"
+    )
+
+
+def _accept(_):
+    return True
+
+
+class EventFilter(object):
+    """
+    Precompiled predicate over the origin device and PnP interface of an event.
+
+    Args:
+        device_id (str): literal or wildcard device Id.
+        devices (dict, set): device Ids resolved from a device query.
+        interface_id (str): PnP interface the event must originate from.
+        pnp_context (dict): when set, only events carrying an interface name are accepted.
+    """
+
+    def __init__(self, device_id=None, devices=None, interface_id=None, pnp_context=None):
+        checks = []
+        pattern = compile_device_pattern(device_id)
+        if pattern:
+            literal = device_id
+            match = pattern.match
+            # Events without a device Id annotation never match a wildcard
+            checks.append(lambda origin: origin is not None and (origin == literal or match(origin) is not None))
+        elif device_id:
+            checks.append(lambda origin: origin == device_id)
+        if devices:
+            checks.append(devices.__contains__)
+
+        self._origin_checks = tuple(checks)
+        if not checks:
+            self.match_origin = _accept
+        elif len(checks) == 1:
+            self.match_origin = checks[0]
+
+        self.require_interface = bool(pnp_context)
+        self.interface_id = interface_id
+
+    def match_origin(self, origin):
+        for check in self._origin_checks:
+            if not check(origin):
+                return False
+        return True
+
+    def match_interface(self, interface):
+        if not self.require_interface:
+            return True
+        if not interface:
+            return False
+        return not self.interface_id or interface == self.interface_id
+
+
+class EventProjector(object):
+    """
+    Precompiled projection of a message into the monitor output document.
+
+    Args:
+        properties (set): lower-cased property selections, any of 'sys', 'app', 'anno', 'all'.
+        content_type (str): content type override for payload parsing.
+        pnp_context (dict): PnP interface telemetry context, compiled into telemetry decoders.
+        output (str): output rendering, one of 'json', 'ndjson' or 'yaml'.
+        hub (str): source IoT Hub name added to every event, when monitoring several hubs.
+    """
+
+    def __init__(self, properties=None, content_type=None, pnp_context=None, output=None, hub=None):
+        properties = properties or set()
+        select_all = "all" in properties
+        self.annotations = select_all or "anno" in properties
+        self.system = select_all or "sys" in properties
+        self.application = select_all or "app" in properties
+
+        self.content_type = content_type.lower() if content_type else None
+        self.pnp = bool(pnp_context)
+        self.pnp_decoders = compile_pnp_decoders(pnp_context)
+        self.hub = hub
+
+        self.render = get_renderer(output)
+
+    def project(self, view):
+        event = {"origin": view.origin}
+        if self.hub:
+            event["hub"] = self.hub
+        payload = view.text()
+
+        ct = self.content_type or view.content_type
+        if ct == "application/json":
+            try:
+                if "\\" in payload:
+                    payload = NEWLINE_PATTERN.sub("", payload)
+                payload = json.loads(payload)
+            except Exception:
+                # We don't want to crash the monitor if JSON parsing fails
+                pass
+
+        event["payload"] = payload
+
+        if self.pnp:
+            interface = view.interface
+            event["interface"] = interface
+            if self.pnp_decoders:
+                decode = self.pnp_decoders.get(
+                    (interface, view.application_property(MESSAGE_SCHEMA_PROPERTY))
+                )
+                if decode:
+                    event["payload"] = decode(payload)
+
+        if self.annotations:
+            event["annotations"] = view.annotations()
+        if self.system or self.application:
+            event["properties"] = {}
+            if self.system:
+                event["properties"]["system"] = view.system_properties()
+            if self.application:
+                application = view.application_properties()
+                if application:
+                    event["properties"]["application"] = application
+
+        return {"event": event}
+
+
+def compile_event_handler(
+    device_id=None,
+    devices=None,
+    interface_id=None,
+    pnp_context=None,
+    properties=None,
+    content_type=None,
+    output=None,
+    aggregator=None,
+    metrics=None,
+    observe=None,
+    hub=None,
+):
+    """
+    Compiles monitor options into a single message handler.
+
+    When an aggregator is provided, accepted events are added to its rollups
+    instead of being rendered. When partition metrics are provided, the handler
+    also records every event and the time spent filtering, decoding and rendering.
+    An observer, if any, is called with the origin of every event before filtering.
+
+    Returns:
+        handler (callable): takes a uamqp.Message and returns the rendered
+            event, or None when the message is filtered out or aggregated. An optional
+            second argument gives the receive time in epoch ms that enqueue lag is
+            measured against, the current time by default.
+    """
+    event_filter = EventFilter(
+        device_id=device_id,
+        devices=devices,
+        interface_id=interface_id,
+        pnp_context=pnp_context,
+    )
+    projector = EventProjector(
+        properties=properties,
+        content_type=content_type,
+        pnp_context=pnp_context,
+        output=output,
+        hub=hub,
+    )
+    match_origin = event_filter.match_origin
+    match_interface = event_filter.match_interface
+    require_interface = event_filter.require_interface
+    project = projector.project
+    render = projector.render
+
+    if metrics:
+        return _instrument(
+            metrics, match_origin, match_interface, require_interface, project, render, aggregator, observe
+        )
+
+    if aggregator:
+        aggregate = aggregator.add
+
+        def handle_aggregate(msg, received_ms=None):
+            view = EventView(msg)
+            if observe:
+                observe(view.origin)
+            if not match_origin(view.origin):
+                return None
+            if require_interface and not match_interface(view.interface):
+                return None
+            aggregate(view)
+
+        return handle_aggregate
+
+    def handle(msg, received_ms=None):
+        view = EventView(msg)
+        if observe:
+            observe(view.origin)
+        if not match_origin(view.origin):
+            return None
+        if require_interface and not match_interface(view.interface):
+            return None
+
+        return render(project(view))
+
+    return handle
+
+
+def _instrument(metrics, match_origin, match_interface, require_interface, project, render, aggregator, observe):
+    record = metrics.record
+    add_time = metrics.add_time
+    aggregate = aggregator.add if aggregator else None
+
+    def handle_instrumented(msg, received_ms=None):
+        view = EventView(msg)
+        record(view, received_ms)
+        if observe:
+            observe(view.origin)
+
+        start = perf_counter()
+        accepted = match_origin(view.origin) and (
+            not require_interface or match_interface(view.interface)
+        )
+        filtered = perf_counter()
+        add_time("filter", filtered - start)
+        if not accepted:
+            return None
+
+        if aggregate:
+            aggregate(view)
+            add_time("decode", perf_counter() - filtered)
+            return None
+
+        document = project(view)
+        projected = perf_counter()
+        add_time("decode", projected - filtered)
+        dump = render(document)
+        add_time("output", perf_counter() - projected)
+        return dump
+
+    return handle_instrumented
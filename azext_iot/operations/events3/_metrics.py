@@ -0,0 +1,230 @@
+# coding=utf-8
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+"""
+metrics: Per-partition throughput, lag and stage timing of event monitors.
+
+Counters are updated by the message handler of each partition and periodically written
+to stderr or to a Prometheus text exposition file.
+"""
+
+import asyncio
+import os
+import sys
+from collections import deque
+from datetime import datetime
+from time import time
+
+import six
+
+from knack.log import get_logger
+from azext_iot.common.utility import percentiles
+
+logger = get_logger(__name__)
+
+ENQUEUED_TIME_ANNOTATION = b"x-opt-enqueuedtimeutc"
+
+# Enqueue lag samples kept per partition and interval for percentile estimation
+METRICS_LAG_SAMPLE_SIZE = 4096
+
+STAGES = ("filter", "decode", "output")
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _enqueued_ms(value):
+    if isinstance(value, datetime):
+        return (value.replace(tzinfo=None) - _EPOCH).total_seconds() * 1000
+    return value
+
+
+class PartitionMetrics(object):
+    """
+    Counters of a single partition. Interval counters reset on every snapshot.
+    """
+
+    __slots__ = (
+        "partition",
+        "messages",
+        "bytes",
+        "total_messages",
+        "total_bytes",
+        "lags",
+        "stage_sec",
+        "total_stage_sec",
+    )
+
+    def __init__(self, partition):
+        self.partition = partition
+        self.messages = 0
+        self.bytes = 0
+        self.total_messages = 0
+        self.total_bytes = 0
+        self.lags = deque(maxlen=METRICS_LAG_SAMPLE_SIZE)
+        self.stage_sec = dict.fromkeys(STAGES, 0.0)
+        self.total_stage_sec = dict.fromkeys(STAGES, 0.0)
+
+    def record(self, view, received_ms=None):
+        """ Records a received event from its EventView. """
+        self.messages += 1
+        body = view.body
+        if body is not None:
+            self.bytes += len(body)
+        enqueued = view.raw_annotations.get(ENQUEUED_TIME_ANNOTATION)
+        if enqueued is not None:
+            received_ms = received_ms if received_ms is not None else time() * 1000
+            self.lags.append(max(0.0, (received_ms - _enqueued_ms(enqueued)) / 1000))
+
+    def add_time(self, stage, seconds):
+        self.stage_sec[stage] += seconds
+
+    def snapshot(self, elapsed):
+        """ Returns the interval summary and starts a new interval. """
+        # Lags stay in unrounded seconds
+        lags = percentiles(self.lags, points=(50, 99), scale=1, ndigits=None)
+        self.lags.clear()
+        self.total_messages += self.messages
+        self.total_bytes += self.bytes
+        for stage in STAGES:
+            self.total_stage_sec[stage] += self.stage_sec[stage]
+
+        result = {
+            "partition": self.partition,
+            "messages": self.messages,
+            "bytes": self.bytes,
+            "total_messages": self.total_messages,
+            "total_bytes": self.total_bytes,
+            "messages_per_sec": self.messages / elapsed if elapsed else 0.0,
+            "bytes_per_sec": self.bytes / elapsed if elapsed else 0.0,
+            "lag_p50": lags["p50"] if lags else None,
+            "lag_p99": lags["p99"] if lags else None,
+            "stage_sec": dict(self.stage_sec),
+            "total_stage_sec": dict(self.total_stage_sec),
+        }
+
+        self.messages = 0
+        self.bytes = 0
+        self.stage_sec = dict.fromkeys(STAGES, 0.0)
+        return result
+
+
+def format_snapshot(snapshot):
+    def _lag(value):
+        return "{:.2f}s".format(value) if value is not None else "n/a"
+
+    stage_sec = snapshot["stage_sec"]
+    return (
+        "partition {partition}: {rate:.1f} msg/s, {kbytes:.1f} KiB/s, lag p50 {p50} p99 {p99}, "
+        "filter {filter:.3f}s decode {decode:.3f}s output {output:.3f}s".format(
+            partition=snapshot["partition"],
+            rate=snapshot["messages_per_sec"],
+            kbytes=snapshot["bytes_per_sec"] / 1024,
+            p50=_lag(snapshot["lag_p50"]),
+            p99=_lag(snapshot["lag_p99"]),
+            **stage_sec
+        )
+    )
+
+
+def format_queue_stats(stats):
+    return (
+        "output queue ({policy}): depth {depth}, max depth {high_watermark}, "
+        "queued {queued}, dropped {dropped}, written {written}".format(**stats)
+    )
+
+
+def format_prometheus(snapshots, queue_stats=None):
+    lines = []
+
+    def _family(name, kind, doc, samples):
+        lines.append("# HELP azext_iot_monitor_{} {}".format(name, doc))
+        lines.append("# TYPE azext_iot_monitor_{} {}".format(name, kind))
+        for labels, value in samples:
+            if value is None:
+                continue
+            label_text = ",".join('{}="{}"'.format(k, v) for k, v in labels)
+            lines.append("azext_iot_monitor_{}{{{}}} {}".format(name, label_text, value))
+
+    _family("messages_total", "counter", "Events received.",
+            [((("partition", s["partition"]),), s["total_messages"]) for s in snapshots])
+    _family("bytes_total", "counter", "Event body bytes received.",
+            [((("partition", s["partition"]),), s["total_bytes"]) for s in snapshots])
+    _family("messages_per_second", "gauge", "Events received per second over the last interval.",
+            [((("partition", s["partition"]),), s["messages_per_sec"]) for s in snapshots])
+    _family("bytes_per_second", "gauge", "Event body bytes received per second over the last interval.",
+            [((("partition", s["partition"]),), s["bytes_per_sec"]) for s in snapshots])
+    _family("enqueue_lag_seconds", "gauge", "Enqueue to receive lag over the last interval.",
+            [((("partition", s["partition"]), ("quantile", q)), s[key])
+             for s in snapshots for q, key in (("0.5", "lag_p50"), ("0.99", "lag_p99"))])
+    _family("stage_seconds_total", "counter", "Time spent per processing stage.",
+            [((("partition", s["partition"]), ("stage", stage)), s["total_stage_sec"][stage])
+             for s in snapshots for stage in STAGES])
+    if queue_stats:
+        policy = (("policy", queue_stats["policy"]),)
+        _family("output_queue_depth", "gauge", "Rendered events waiting to be written.",
+                [(policy, queue_stats["depth"])])
+        _family("output_queue_queued_total", "counter", "Rendered events queued for output.",
+                [(policy, queue_stats["queued"])])
+        _family("output_queue_dropped_total", "counter", "Rendered events dropped by the queue policy.",
+                [(policy, queue_stats["dropped"])])
+    return "\n".join(lines) + "\n"
+
+
+class MonitorMetrics(object):
+    """
+    Registry of partition metrics of a monitor with periodic reporting.
+
+    Args:
+        interval (int): reporting interval in seconds.
+        metrics_file (str): Prometheus text file to rewrite every interval. Reports go to stderr
+            when not provided.
+    """
+
+    def __init__(self, interval, metrics_file=None):
+        self.interval = interval
+        self.metrics_file = (
+            os.path.abspath(os.path.expanduser(metrics_file)) if metrics_file else None
+        )
+        self.output_queue = None
+        self._partitions = {}
+        self._last_report = time()
+
+    def partition(self, partition):
+        metrics = self._partitions.get(partition)
+        if metrics is None:
+            metrics = self._partitions[partition] = PartitionMetrics(partition)
+        return metrics
+
+    def report(self):
+        now = time()
+        elapsed = now - self._last_report
+        self._last_report = now
+        snapshots = [
+            self._partitions[p].snapshot(elapsed) for p in sorted(self._partitions)
+        ]
+        if not snapshots:
+            return
+        queue_stats = self.output_queue.stats() if self.output_queue else None
+
+        if self.metrics_file:
+            temp_path = "{}.tmp".format(self.metrics_file)
+            with open(temp_path, "w") as f:
+                f.write(format_prometheus(snapshots, queue_stats))
+            os.replace(temp_path, self.metrics_file)
+        else:
+            for snapshot in snapshots:
+                six.print_(format_snapshot(snapshot), file=sys.stderr, flush=True)
+            if queue_stats:
+                six.print_(format_queue_stats(queue_stats), file=sys.stderr, flush=True)
+
+    async def run(self):
+        """ Reports every interval until cancelled. """
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.report()
+            except Exception as e:
+                logger.error("Unable to report monitor metrics: %s", e)
@@ -0,0 +1,116 @@
+# coding=utf-8
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+"""
+partitions: Learned map of the Event Hub partition each device sends to.
+
+IoT Hub assigns a device to a partition by hashing its Id, so the partition an event
+arrived on is stable for the lifetime of the hub. Monitors record what they observe
+and later single device monitors open only that partition.
+"""
+
+import os
+from collections import OrderedDict
+
+from knack.log import get_logger
+from azext_iot.operations.events3._cache import get_cache_dir, load_json, safe_name, save_json
+
+logger = get_logger(__name__)
+
+DEVICE_MAP_MAX_SIZE = 10000
+
+
+class DevicePartitionMap(object):
+    """
+    Device Id to partition Id map of an Event Hub, persisted in the local cache.
+
+    Args:
+        endpoint (str): Event Hub compatible endpoint host.
+        path (str): Event Hub compatible path.
+        cache_dir (str): cache directory, the extension cache directory by default.
+        max_devices (int): most recently observed devices kept in the map.
+    """
+
+    def __init__(self, endpoint, path, cache_dir=None, max_devices=DEVICE_MAP_MAX_SIZE):
+        self.path = os.path.join(
+            cache_dir or get_cache_dir(),
+            "partitions",
+            "{}.json".format(safe_name("{}_{}".format(endpoint, path))),
+        )
+        self.max_devices = max_devices
+        self._devices = None
+        self._observed = OrderedDict()
+
+    def _load(self):
+        if self._devices is None:
+            content = load_json(self.path)
+            devices = content.get("devices") if isinstance(content, dict) else None
+            self._devices = OrderedDict(devices) if isinstance(devices, (dict, list)) else OrderedDict()
+        return self._devices
+
+    def lookup(self, device_id):
+        """ Returns the partition Id a device was last seen on, or None. """
+        partition = self._observed.get(device_id)
+        if partition is None:
+            partition = self._load().get(device_id)
+        return partition
+
+    def observer(self, partition):
+        """
+        Returns a callable recording that an origin device was seen on `partition`.
+        Observations are bounded to the `max_devices` most recently seen devices.
+        """
+        partition = str(partition)
+        observed = self._observed
+        max_devices = self.max_devices
+
+        def observe(origin):
+            if not origin:
+                return
+            observed[origin] = partition
+            observed.move_to_end(origin)
+            if len(observed) > max_devices:
+                observed.popitem(last=False)
+
+        return observe
+
+    def save(self):
+        """ Merges observations into the cache file, keeping the most recently observed devices. """
+        if not self._observed:
+            return
+        # Re-read so observations of concurrent monitors are kept
+        self._devices = None
+        devices = self._load()
+        for device_id, partition in self._observed.items():
+            devices.pop(device_id, None)
+            devices[device_id] = partition
+        while len(devices) > self.max_devices:
+            devices.popitem(last=False)
+
+        save_json(self.path, {"devices": list(devices.items())})
+        # Cleared in place, observers hold on to this map
+        self._observed.clear()
+
+
+def select_device_partitions(target, device_id, partition_map=None):
+    """
+    Narrows the partitions of a target to the known partition of a literal device Id.
+
+    Returns:
+        partitions (list): the single learned partition, or all target partitions on a miss.
+    """
+    partitions = target["partitions"]
+    if not device_id or "*" in device_id or "?" in device_id or len(partitions) < 2:
+        return partitions
+
+    partition_map = partition_map or DevicePartitionMap(target["endpoint"], target["path"])
+    known = partition_map.lookup(device_id)
+    if known is not None:
+        for partition in partitions:
+            if str(partition) == known:
+                logger.info("Device %s was last seen on partition %s", device_id, partition)
+                return [partition]
+    return partitions
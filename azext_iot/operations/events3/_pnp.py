@@ -0,0 +1,149 @@
+# coding=utf-8
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+"""
+pnp: Precompiled PnP telemetry decoders.
+
+Telemetry definitions of every monitored interface are compiled once into a decoder per
+(interface, telemetry schema name) pair, so a message is decoded with a single dictionary
+lookup on its interface name and 'iothub-message-schema' application property.
+"""
+
+INTEGER_SCHEMAS = frozenset(["integer", "long"])
+FLOAT_SCHEMAS = frozenset(["double", "float"])
+BOOLEAN_SCHEMA = "boolean"
+ENUM_TYPE = "enum"
+
+_BOOLEAN_VALUES = {"true": True, "false": False}
+
+
+def _parse_integer(value):
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            return float(value)
+    return value
+
+
+def _parse_float(value):
+    if isinstance(value, str):
+        return float(value)
+    return value
+
+
+def _parse_boolean(value):
+    if isinstance(value, str):
+        return _BOOLEAN_VALUES[value.lower()]
+    return value
+
+
+def _enum_parser(schema):
+    names = {}
+    for enum_value in schema.get("enumValues") or []:
+        value = enum_value.get("enumValue")
+        name = enum_value.get("name") or enum_value.get("displayName")
+        if value is not None and name:
+            names[value] = name
+            names[str(value)] = name
+
+    def parse(value):
+        return names.get(value, value)
+
+    return parse
+
+
+def compile_value_parser(schema):
+    """
+    Returns a callable converting a telemetry value to its schema type, or None when the
+    schema has no typed representation. Values that fail to parse are kept unchanged.
+    """
+    if isinstance(schema, dict):
+        schema_type = schema.get("@type")
+        if isinstance(schema_type, list):
+            schema_type = next((t for t in schema_type if t.lower() == ENUM_TYPE), None)
+        if not schema_type or schema_type.lower() != ENUM_TYPE:
+            return None
+        return _enum_parser(schema)
+    if not isinstance(schema, str):
+        return None
+
+    schema = schema.lower()
+    if schema in INTEGER_SCHEMAS:
+        return _parse_integer
+    if schema in FLOAT_SCHEMAS:
+        return _parse_float
+    if schema == BOOLEAN_SCHEMA:
+        return _parse_boolean
+    return None
+
+
+def compile_telemetry_decoder(name, display=None, unit=None, parse=None):
+    """
+    Compiles the decoder of one telemetry definition.
+
+    Returns:
+        decoder (callable): takes the decoded payload and returns the output payload,
+            or None when the definition changes nothing.
+    """
+    if not display and not parse:
+        return None
+
+    def parse_payload(payload):
+        if parse is None:
+            return payload
+        try:
+            if isinstance(payload, dict):
+                if name in payload:
+                    payload = dict(payload)
+                    payload[name] = parse(payload[name])
+                return payload
+            return parse(payload)
+        except (ValueError, KeyError, TypeError):
+            return payload
+
+    if not display:
+        return parse_payload
+
+    if unit:
+
+        def decode(payload):
+            return {display: parse_payload(payload), "unit": unit}
+
+    else:
+
+        def decode(payload):
+            return {display: parse_payload(payload)}
+
+    return decode
+
+
+def compile_pnp_decoders(pnp_context):
+    """
+    Compiles the telemetry definitions of a PnP monitor context.
+
+    Context telemetry entries hold the 'display' name, 'unit' and optionally the telemetry
+    'schema'. Schemas are only applied when the context enables 'typed' parsing.
+
+    Returns:
+        decoders (dict): (interface, telemetry name) to decoder callable.
+    """
+    decoders = {}
+    if not pnp_context:
+        return decoders
+
+    typed = pnp_context.get("typed", False)
+    for interface, telemetry in (pnp_context.get("interface") or {}).items():
+        for name, definition in telemetry.items():
+            decoder = compile_telemetry_decoder(
+                name,
+                display=definition.get("display"),
+                unit=definition.get("unit"),
+                parse=compile_value_parser(definition.get("schema")) if typed else None,
+            )
+            if decoder:
+                decoders[(interface, name)] = decoder
+    return decoders
@@ -0,0 +1,166 @@
+# coding=utf-8
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+"""
+queues: Bounded hand-off between partition receivers and the output writer.
+
+Receivers put rendered events on the queue and a single writer task drains it,
+performing the (possibly blocking) writes on a thread so a slow consumer of the
+output does not stall the event loop and with it every partition link.
+"""
+
+import asyncio
+
+from knack.log import get_logger
+
+logger = get_logger(__name__)
+
+OUTPUT_QUEUE_SIZE = 1024
+OUTPUT_QUEUE_WRITE_BATCH = 256
+OUTPUT_QUEUE_SAMPLE_RATE = 10
+
+POLICY_BLOCK = "block"
+POLICY_DROP_OLDEST = "drop-oldest"
+POLICY_SAMPLE = "sample"
+QUEUE_POLICIES = (POLICY_BLOCK, POLICY_DROP_OLDEST, POLICY_SAMPLE)
+
+_STOP = object()
+
+
+class OutputQueue(object):
+    """
+    Bounded queue of rendered events with an overflow policy.
+
+    Policies:
+        block: receivers wait for room, which stops granting link credit upstream.
+        drop-oldest: the oldest queued event is discarded to make room.
+        sample: once the queue is half full only every `sample_rate`-th event is kept,
+            and events arriving at a full queue are discarded.
+
+    Args:
+        maxsize (int): maximum number of queued events.
+        policy (str): overflow policy, one of QUEUE_POLICIES.
+        sample_rate (int): 1 in N events kept under pressure by the sample policy.
+    """
+
+    def __init__(self, maxsize=OUTPUT_QUEUE_SIZE, policy=POLICY_BLOCK, sample_rate=OUTPUT_QUEUE_SAMPLE_RATE):
+        if policy not in QUEUE_POLICIES:
+            raise ValueError("Unknown output queue policy '{}'".format(policy))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.sample_rate = sample_rate
+
+        self.queued = 0
+        self.dropped = 0
+        self.written = 0
+        self.high_watermark = 0
+
+        self._queue = asyncio.Queue(maxsize=maxsize)
+        self._pressure = 0
+        self._writer = None
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    def _full(self):
+        return self._queue.full()
+
+    def _accepted(self):
+        self.queued += 1
+        depth = self._queue.qsize()
+        if depth > self.high_watermark:
+            self.high_watermark = depth
+
+    def _check_writer(self):
+        """ Raises the error of a writer that stopped while events are still being queued. """
+        writer = self._writer
+        if writer is None or not writer.done():
+            return
+        error = None if writer.cancelled() else writer.exception()
+        raise error or RuntimeError("Output writer stopped.")
+
+    async def put(self, dump):
+        self._check_writer()
+        if self.policy == POLICY_BLOCK:
+            if self._full() and self._writer:
+                # Waiting for room only makes sense while the writer is draining the queue
+                put = asyncio.ensure_future(self._queue.put(dump))
+                try:
+                    await asyncio.wait([put, self._writer], return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    if not put.done():
+                        put.cancel()
+                if put.cancelled():
+                    self._check_writer()
+            else:
+                await self._queue.put(dump)
+            self._accepted()
+            return
+
+        if self.policy == POLICY_DROP_OLDEST:
+            if self._full():
+                self._queue.get_nowait()
+                self.dropped += 1
+        elif self._queue.qsize() * 2 >= self.maxsize:
+            self._pressure += 1
+            if self._full() or self._pressure % self.sample_rate:
+                self.dropped += 1
+                return
+        else:
+            self._pressure = 0
+
+        self._queue.put_nowait(dump)
+        self._accepted()
+
+    async def _write(self, printer):
+        loop = asyncio.get_event_loop()
+        queue = self._queue
+        while True:
+            dump = await queue.get()
+            if dump is _STOP:
+                return
+
+            dumps = [dump]
+            stop = False
+            while len(dumps) < OUTPUT_QUEUE_WRITE_BATCH and not queue.empty():
+                dump = queue.get_nowait()
+                if dump is _STOP:
+                    stop = True
+                    break
+                dumps.append(dump)
+
+            await loop.run_in_executor(None, printer, "\n".join(dumps))
+            self.written += len(dumps)
+            if stop:
+                return
+
+    def start(self, printer):
+        """ Starts the writer task draining the queue into printer. """
+        self._writer = asyncio.ensure_future(self._write(printer))
+        return self._writer
+
+    async def close(self):
+        """ Writes out every queued event and stops the writer. """
+        if not self._writer:
+            return
+        await self._queue.put(_STOP)
+        await self._writer
+        self._writer = None
+        if self.dropped:
+            logger.warning(
+                "Output queue dropped %s events (policy: %s).", self.dropped, self.policy
+            )
+
+    def stats(self):
+        return {
+            "policy": self.policy,
+            "depth": self.depth,
+            "high_watermark": self.high_watermark,
+            "queued": self.queued,
+            "dropped": self.dropped,
+            "written": self.written,
+        }
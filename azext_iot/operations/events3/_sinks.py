@@ -0,0 +1,191 @@
+# coding=utf-8
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+"""
+sinks: Rendering and buffered output of monitor documents.
+
+Renderers turn an event dict into text. Sinks accept rendered text and write it to
+stdout or a rotating (optionally gzip compressed) file with a size/time flush policy.
+"""
+
+import gzip
+import json
+import os
+import sys
+import threading
+
+import yaml
+
+from knack.log import get_logger
+
+logger = get_logger(__name__)
+
+try:
+    from yaml import CSafeDumper as _YamlDumper
+except ImportError:
+    from yaml import SafeDumper as _YamlDumper
+
+SINK_FLUSH_BYTES = 64 * 1024
+SINK_FLUSH_INTERVAL_SEC = 1
+SINK_ROTATE_BACKUP_COUNT = 5
+
+OUTPUT_NDJSON = "ndjson"
+
+
+def render_json(document):
+    return json.dumps(document, indent=4)
+
+
+def render_ndjson(document):
+    return json.dumps(document, separators=(",", ":"))
+
+
+def render_yaml(document):
+    return yaml.dump(document, Dumper=_YamlDumper, default_flow_style=False)
+
+
+def get_renderer(output=None):
+    """ Returns the document renderer of an output format, 'json' when not specified. """
+    output = output.lower() if output else "json"
+    if output == "json":
+        return render_json
+    if output == OUTPUT_NDJSON:
+        return render_ndjson
+    return render_yaml
+
+
+class OutputSink(object):
+    """
+    Buffered writer of rendered documents, one document per line group.
+
+    Buffered text is written once it exceeds `flush_bytes` or `flush_interval` seconds have
+    passed since the last flush. Writes to an interactive terminal are flushed immediately.
+
+    Args:
+        path (str): target file. Output goes to stdout when not provided.
+        rotate_bytes (int): rotate the target file after this many (uncompressed) bytes.
+        compress (bool): gzip compress the target file.
+        flush_bytes (int): buffered size that triggers a flush.
+        flush_interval (float): maximum seconds buffered text is held.
+    """
+
+    def __init__(
+        self,
+        path=None,
+        rotate_bytes=None,
+        compress=False,
+        flush_bytes=SINK_FLUSH_BYTES,
+        flush_interval=SINK_FLUSH_INTERVAL_SEC,
+    ):
+        self.path = None
+        self.compress = compress
+        self.rotate_bytes = rotate_bytes
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._buffered = 0
+        self._written = 0
+        self._stream = None
+        self._owns_stream = False
+
+        if path:
+            path = os.path.abspath(os.path.expanduser(path))
+            if compress and not path.endswith(".gz"):
+                path = "{}.gz".format(path)
+            self.path = path
+            self._open()
+            self._immediate = False
+        else:
+            self._stream = sys.stdout
+            isatty = getattr(self._stream, "isatty", None)
+            self._immediate = bool(isatty and isatty())
+
+        self._closed = threading.Event()
+        self._flusher = None
+        if not self._immediate and flush_interval:
+            self._flusher = threading.Thread(target=self._flush_periodically)
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def _open(self):
+        # Owned files are written as utf8 bytes so rotation counts bytes, not characters
+        if self.compress:
+            self._stream = gzip.open(self.path, "ab")
+            self._written = 0
+        else:
+            self._stream = open(self.path, "ab")
+            self._written = self._stream.tell()
+        self._owns_stream = True
+
+    def _rotated_path(self, index):
+        if self.compress:
+            return "{}.{}.gz".format(self.path[: -len(".gz")], index)
+        return "{}.{}".format(self.path, index)
+
+    def _rotate(self):
+        self._stream.close()
+        for index in range(SINK_ROTATE_BACKUP_COUNT - 1, 0, -1):
+            source = self._rotated_path(index)
+            if os.path.exists(source):
+                os.replace(source, self._rotated_path(index + 1))
+        os.replace(self.path, self._rotated_path(1))
+        self._open()
+
+    def write(self, text):
+        with self._lock:
+            self._buffer.append(text)
+            self._buffer.append("\n")
+            self._buffered += len(text) + 1
+            if self._immediate or self._buffered >= self.flush_bytes:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            chunk = "".join(self._buffer)
+            self._buffer = []
+            self._buffered = 0
+            if self._owns_stream:
+                data = chunk.encode("utf8")
+                self._stream.write(data)
+                self._written += len(data)
+            else:
+                self._stream.write(chunk)
+        self._stream.flush()
+        if self.rotate_bytes and self._owns_stream and self._written >= self.rotate_bytes:
+            self._rotate()
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.debug("Periodic output flush failed: %s", e)
+
+    def close(self):
+        self._closed.set()
+        self.flush()
+        if self._owns_stream:
+            with self._lock:
+                self._stream.close()
+
+
+def build_sink(output_file=None, rotate_size=None, compress=False):
+    """
+    Builds the output sink of a monitor.
+
+    Args:
+        output_file (str): target file, stdout when not provided.
+        rotate_size (int): rotation threshold in MiB.
+        compress (bool): gzip compress the output file.
+    """
+    rotate_bytes = rotate_size * 1024 * 1024 if rotate_size else None
+    return OutputSink(path=output_file, rotate_bytes=rotate_bytes, compress=compress)
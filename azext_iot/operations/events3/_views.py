@@ -0,0 +1,151 @@
+# coding=utf-8
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+"""
+views: Lazy read-only view over a received uamqp.Message.
+
+Every part of the message is decoded on first access and cached, so the monitor only
+pays for the annotations, properties and body the active filter and projection read.
+"""
+
+from azext_iot.common.utility import unicode_binary_map
+
+DEVICE_ID_ANNOTATION = b"iothub-connection-device-id"
+INTERFACE_NAME_ANNOTATION = b"iothub-interface-name"
+
+# Public attributes of uamqp.message.MessageProperties
+SYSTEM_PROPERTIES = (
+    "absolute_expiry_time",
+    "content_encoding",
+    "content_type",
+    "correlation_id",
+    "creation_time",
+    "group_id",
+    "group_sequence",
+    "message_id",
+    "reply_to",
+    "reply_to_group_id",
+    "subject",
+    "to",
+    "user_id",
+)
+
+_UNSET = object()
+
+
+def _decode(value):
+    if isinstance(value, bytes):
+        return str(value, "utf8")
+    return value
+
+
+class EventView(object):
+    """
+    Lazily decoded view of an event.
+
+    Args:
+        msg (uamqp.Message): received message.
+    """
+
+    __slots__ = (
+        "msg",
+        "_annotations",
+        "_origin",
+        "_interface",
+        "_content_type",
+        "_system_properties",
+        "_application_properties",
+        "_body",
+    )
+
+    def __init__(self, msg):
+        self.msg = msg
+        self._annotations = _UNSET
+        self._origin = _UNSET
+        self._interface = _UNSET
+        self._content_type = _UNSET
+        self._system_properties = None
+        self._application_properties = _UNSET
+        self._body = _UNSET
+
+    @property
+    def raw_annotations(self):
+        if self._annotations is _UNSET:
+            self._annotations = self.msg.annotations or {}
+        return self._annotations
+
+    @property
+    def origin(self):
+        if self._origin is _UNSET:
+            self._origin = _decode(self.raw_annotations.get(DEVICE_ID_ANNOTATION))
+        return self._origin
+
+    @property
+    def interface(self):
+        if self._interface is _UNSET:
+            self._interface = _decode(self.raw_annotations.get(INTERFACE_NAME_ANNOTATION))
+        return self._interface
+
+    @property
+    def content_type(self):
+        """ Lower-cased content type system property, without decoding the other properties. """
+        if self._content_type is _UNSET:
+            properties = self.msg.properties
+            content_type = _decode(properties.content_type) if properties else None
+            self._content_type = content_type.lower() if content_type else ""
+        return self._content_type
+
+    @property
+    def raw_application_properties(self):
+        if self._application_properties is _UNSET:
+            self._application_properties = self.msg.application_properties
+        return self._application_properties
+
+    def application_property(self, key):
+        properties = self.raw_application_properties
+        if not properties:
+            return None
+        return _decode(properties.get(key))
+
+    @property
+    def body(self):
+        """ Memoryview over the first body data section, or None for an empty body. """
+        if self._body is _UNSET:
+            self._body = None
+            data = self.msg.get_data()
+            if data:
+                section = next(data, None)
+                if section is not None:
+                    self._body = memoryview(section)
+        return self._body
+
+    def text(self):
+        """ Body decoded as UTF-8. Undecodable binary bytes are replaced rather than failing the monitor. """
+        body = self.body
+        if body is None:
+            return ""
+        return str(body, "utf8", "replace")
+
+    def annotations(self):
+        return unicode_binary_map(self.raw_annotations)
+
+    def system_properties(self):
+        if self._system_properties is None:
+            result = {}
+            properties = self.msg.properties
+            if properties:
+                for name in SYSTEM_PROPERTIES:
+                    value = getattr(properties, name, None)
+                    if value:
+                        result[name] = _decode(value)
+            self._system_properties = result
+        return self._system_properties
+
+    def application_properties(self):
+        properties = self.raw_application_properties
+        if not properties:
+            return None
+        return unicode_binary_map(properties)
@@ -0,0 +1,159 @@
+# coding=utf-8
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+import asyncio
+import multiprocessing
+import os
+import signal
+from six.moves import queue
+import six
+
+from knack.log import get_logger
+from azext_iot.operations.events3._builders import build_auth_container
+from azext_iot.operations.events3._events import initiate_event_monitor
+
+logger = get_logger(__name__)
+
+# Upper bound of rendered events in flight between workers and the writer.
+# A full channel blocks the producing worker, which in turn stops granting link credit.
+WORKER_CHANNEL_SIZE = 4096
+WORKER_SHUTDOWN_SEC = 5
+
+_EVENT = 0
+_ERROR = 1
+_DONE = 2
+
+# Monitor options naming files that every worker writes on its own
+WORKER_FILE_OPTIONS = ("metrics_file",)
+
+
+def partition_fanout(target, workers, printer=None, **monitor_kwargs):
+    """
+    Spread the partitions of an event hub target across a pool of worker processes.
+
+    Each worker opens its own AMQP connection and renders the events of its partitions.
+    Rendered events are sent back to this process which is the single writer of the output
+    stream, so documents from different partitions never interleave.
+
+    Args:
+        target (dict): event hub target including its auth spec.
+        workers (int): maximum number of worker processes.
+        printer (callable): writer of rendered events, stdout when not provided.
+        monitor_kwargs: options forwarded to initiate_event_monitor in each worker.
+    """
+    if not printer:
+        printer = _print_event
+
+    partitions = target["partitions"]
+    workers = min(workers, len(partitions))
+    context = multiprocessing.get_context("spawn")
+    channel = context.Queue(maxsize=WORKER_CHANNEL_SIZE)
+
+    target_spec = {
+        "endpoint": target["endpoint"],
+        "path": target["path"],
+        "auth_spec": target["auth_spec"],
+    }
+
+    procs = []
+    for i in range(workers):
+        worker_kwargs = dict(monitor_kwargs)
+        for option in WORKER_FILE_OPTIONS:
+            if monitor_kwargs.get(option):
+                worker_kwargs[option] = worker_file_path(monitor_kwargs[option], i)
+        proc = context.Process(
+            target=_monitor_worker,
+            args=(target_spec, partitions[i::workers], worker_kwargs, channel),
+        )
+        proc.daemon = True
+        proc.start()
+        procs.append(proc)
+
+    errors = []
+    active = len(procs)
+    try:
+        while active:
+            try:
+                kind, payload = channel.get(timeout=1)
+            except queue.Empty:
+                if not any(proc.is_alive() for proc in procs):
+                    break
+                continue
+
+            if kind == _EVENT:
+                printer(payload)
+            elif kind == _ERROR:
+                errors.append(payload)
+            else:
+                active -= 1
+    except KeyboardInterrupt:
+        six.print_("Stopping event monitor...")
+    finally:
+        for proc in procs:
+            if proc.is_alive():
+                proc.terminate()
+        for proc in procs:
+            proc.join(WORKER_SHUTDOWN_SEC)
+            if proc.is_alive():
+                proc.kill()
+
+    if errors:
+        logger.error(errors[0])
+        raise RuntimeError(errors[0])
+
+
+def worker_file_path(path, index):
+    """ Per worker variant of an output file, so workers never overwrite each other. """
+    root, ext = os.path.splitext(path)
+    if ext in (".gz", ".zst"):
+        root, inner = os.path.splitext(root)
+        ext = inner + ext
+    return "{}.{}{}".format(root, index, ext)
+
+
+def _print_event(dump):
+    six.print_(dump, flush=True)
+
+
+def _monitor_worker(target_spec, partitions, monitor_kwargs, channel):
+    # The parent owns ctrl-c handling and terminates workers on interrupt
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    monitor = loop.create_task(
+        initiate_event_monitor(
+            _build_worker_target(target_spec, partitions),
+            printer=lambda dump: channel.put((_EVENT, dump)),
+            raise_errors=True,
+            **monitor_kwargs
+        )
+    )
+    try:
+        # Cancel gracefully on terminate so pending state such as checkpoints is flushed
+        loop.add_signal_handler(signal.SIGTERM, monitor.cancel)
+    except NotImplementedError:
+        pass
+
+    try:
+        loop.run_until_complete(monitor)
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        channel.put((_ERROR, str(e)))
+    finally:
+        channel.put((_DONE, None))
+        loop.close()
+
+
+def _build_worker_target(target_spec, partitions):
+    return {
+        "endpoint": target_spec["endpoint"],
+        "path": target_spec["path"],
+        "auth": build_auth_container(target_spec["auth_spec"]),
+        "partitions": partitions,
+    }
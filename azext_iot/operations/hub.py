@@ -4,27 +4,29 @@
 # Licensed under the MIT License. See License.txt in the project root for license information.
 # --------------------------------------------------------------------------------------------
 
+from collections import OrderedDict
 from os.path import exists, basename
 from time import time, sleep
 import six
 from knack.log import get_logger
 from knack.util import CLIError
 from azure.cli.core.util import read_file_content
-from azext_iot.constants import (EXTENSION_ROOT,
-                                 BASE_API_VERSION,
-                                 DEVICE_DEVICESCOPE_PREFIX,
+from azext_iot.constants import (DEVICE_DEVICESCOPE_PREFIX,
                                  TRACING_PROPERTY,
                                  TRACING_ALLOWED_FOR_LOCATION,
                                  TRACING_ALLOWED_FOR_SKU)
 from azext_iot.common.sas_token_auth import SasTokenAuthentication
 from azext_iot.common.shared import (DeviceAuthType,
                                      SdkType,
-                                     MetricType)
+                                     MetricType,
+                                     AckType)
 from azext_iot.common._azure import get_iot_hub_connection_string
 from azext_iot.common.utility import (shell_safe_json_parse,
-                                      validate_key_value_pairs, url_encode_dict,
+                                      validate_key_value_pairs,
                                       evaluate_literal, unpack_msrest_error,
-                                      init_monitoring)
+                                      init_monitoring, validate_monitor_output,
+                                      validate_monitor_aggregate, validate_monitor_metrics,
+                                      validate_monitor_queue, validate_monitor_capture)
 from azext_iot._factory import _bind_sdk
 from azext_iot.operations.generic import _execute_query, _process_top
 
@@ -1048,35 +1050,62 @@ def iot_get_module_connection_string(cmd, device_id, module_id, hub_name=None, k
 # Messaging
 
 def iot_device_send_message(cmd, device_id, hub_name=None, data='Ping from Az CLI IoT Extension',
-                            properties=None, msg_count=1, resource_group_name=None, login=None):
+                            properties=None, msg_count=1, max_inflight=None, template=None,
+                            protocol_type='mqtt', batch_size=None, resource_group_name=None, login=None):
     target = get_iot_hub_connection_string(cmd, hub_name, resource_group_name, login=login)
-    return _iot_device_send_message(target, device_id, data, properties, msg_count)
-
-
-def _iot_device_send_message(target, device_id, data, properties=None, msg_count=1):
-    import paho.mqtt.publish as publish
-    from paho.mqtt import client as mqtt
-    import ssl
-    import os
-
-    msgs = []
+    return _iot_device_send_message(target, device_id, data, properties, msg_count, max_inflight, template,
+                                    protocol_type, batch_size)
+
+
+def _iot_device_send_message(target, device_id, data, properties=None, msg_count=1, max_inflight=None,
+                             template=None, protocol_type='mqtt', batch_size=None):
+    from itertools import repeat
+    from azext_iot.operations._d2c import MqttD2CSender, D2C_MAX_INFLIGHT_DEFAULT
+
+    if msg_count < 1:
+        raise CLIError('msg count must be at least 1')
+    if max_inflight is not None and max_inflight < 1:
+        raise CLIError('Max in-flight messages must be 1 or greater.')
+    if batch_size is not None and batch_size < 1:
+        raise CLIError('batch size must be at least 1')
+    if protocol_type == 'mqtt' and batch_size is not None:
+        raise CLIError('batch size is only supported with the http protocol')
+    if protocol_type == 'http' and max_inflight is not None:
+        raise CLIError('max in-flight messages is only supported with the mqtt protocol')
     if properties:
         properties = validate_key_value_pairs(properties)
 
-    sas = SasTokenAuthentication(target['entity'], target['policy'], target['primarykey'], time() + 360).generate_sas_token()
-    cwd = EXTENSION_ROOT
-    cert_path = os.path.join(cwd, 'digicert.pem')
-    auth = {'username': '{}/{}/api-version={}'.format(target['entity'], device_id, BASE_API_VERSION), 'password': sas}
-    tls = {'ca_certs': cert_path, 'tls_version': ssl.PROTOCOL_SSLv23}
-    topic = 'devices/{}/messages/events/{}'.format(device_id, url_encode_dict(properties) if properties else '')
-    for _ in range(msg_count):
-        msgs.append({'topic': topic, 'payload': data})
+    messages = _load_payload_template(template).render(msg_count, device_id) if template else repeat(data, msg_count)
+    if protocol_type == 'http':
+        return _iot_device_send_message_batched(target, device_id, messages, properties, batch_size)
+
+    sender = MqttD2CSender(target, device_id, properties=properties,
+                           max_inflight=max_inflight or D2C_MAX_INFLIGHT_DEFAULT)
     try:
-        publish.multiple(msgs, client_id=device_id, hostname=target['entity'],
-                         auth=auth, port=8883, protocol=mqtt.MQTTv311, tls=tls)
-        return
+        report = sender.send(messages)
     except Exception as x:
         raise CLIError(x)
+    if report['messagesAcked'] != msg_count:
+        raise CLIError('{} of {} messages were acknowledged ({} sent, {} unacknowledged, {} failed to publish).'.format(
+            report['messagesAcked'], msg_count, report['messagesSent'], report['unacked'], report['publishFailures']))
+    return report
+
+
+def _iot_device_send_message_batched(target, device_id, messages, properties=None, batch_size=None):
+    from contextlib import ExitStack
+    from azext_iot.operations._d2c import HttpD2CBatchSender
+
+    auth = _device_session_auth(target, device_id)
+    with ExitStack() as sessions:
+        sdk = _bind_sdk(target, SdkType.device_sdk, device_id, auth=auth, sessions=sessions)
+        sender = HttpD2CBatchSender(sdk, device_id, properties=properties, max_messages=batch_size,
+                                    renew=lambda: _renew_device_session_auth(auth))
+        try:
+            return sender.send(messages)
+        except sdk[1].CloudError as e:
+            raise CLIError(unpack_msrest_error(e))
+        except Exception as x:
+            raise CLIError(x)
 
 
 def iot_device_send_message_http(cmd, device_id, data, hub_name=None, msg_id=None,
@@ -1086,8 +1115,8 @@ def iot_device_send_message_http(cmd, device_id, data, hub_name=None, msg_id=Non
 
 
 def _iot_device_send_message_http(target, device_id, data, msg_id=None,
-                                  corr_id=None, user_id=None):
-    device_sdk, errors = _bind_sdk(target, SdkType.device_sdk, device_id)
+                                  corr_id=None, user_id=None, sdk=None):
+    device_sdk, errors = sdk or _bind_sdk(target, SdkType.device_sdk, device_id)
 
     headers = {}
 
@@ -1109,8 +1138,8 @@ def iot_c2d_message_complete(cmd, device_id, etag, hub_name=None, resource_group
     return _iot_c2d_message_complete(target, device_id, etag)
 
 
-def _iot_c2d_message_complete(target, device_id, etag):
-    device_sdk, errors = _bind_sdk(target, SdkType.device_sdk, device_id)
+def _iot_c2d_message_complete(target, device_id, etag, sdk=None):
+    device_sdk, errors = sdk or _bind_sdk(target, SdkType.device_sdk, device_id)
     try:
         return device_sdk.complete_or_reject_device_bound_notification(device_id, etag)
     except errors.CloudError as e:
@@ -1122,8 +1151,8 @@ def iot_c2d_message_reject(cmd, device_id, etag, hub_name=None, resource_group_n
     return _iot_c2d_message_reject(target, device_id, etag)
 
 
-def _iot_c2d_message_reject(target, device_id, etag):
-    device_sdk, errors = _bind_sdk(target, SdkType.device_sdk, device_id)
+def _iot_c2d_message_reject(target, device_id, etag, sdk=None):
+    device_sdk, errors = sdk or _bind_sdk(target, SdkType.device_sdk, device_id)
     try:
         return device_sdk.complete_or_reject_device_bound_notification(device_id, etag, '')
     except errors.CloudError as e:
@@ -1135,8 +1164,8 @@ def iot_c2d_message_abandon(cmd, device_id, etag, hub_name=None, resource_group_
     return _iot_c2d_message_abandon(target, device_id, etag)
 
 
-def _iot_c2d_message_abandon(target, device_id, etag):
-    device_sdk, errors = _bind_sdk(target, SdkType.device_sdk, device_id)
+def _iot_c2d_message_abandon(target, device_id, etag, sdk=None):
+    device_sdk, errors = sdk or _bind_sdk(target, SdkType.device_sdk, device_id)
     try:
         return device_sdk.abandon_device_bound_notification(device_id, etag)
     except errors.CloudError as e:
@@ -1148,8 +1177,8 @@ def iot_c2d_message_receive(cmd, device_id, hub_name=None, lock_timeout=60, reso
     return _iot_c2d_message_receive(target, device_id, lock_timeout)
 
 
-def _iot_c2d_message_receive(target, device_id, lock_timeout=60):
-    device_sdk, errors = _bind_sdk(target, SdkType.device_sdk, device_id)
+def _iot_c2d_message_receive(target, device_id, lock_timeout=60, sdk=None):
+    device_sdk, errors = sdk or _bind_sdk(target, SdkType.device_sdk, device_id)
     request_headers = {}
     if lock_timeout:
         request_headers['IotHub-MessageLockTimeout'] = str(lock_timeout)
@@ -1205,92 +1234,421 @@ def _iot_c2d_message_send(target, device_id, data, properties=None,
         properties = validate_key_value_pairs(properties)
 
     events3 = importlib.import_module('azext_iot.operations.events3._events')
+    if wait:
+        # Listen on feedback before sending so the acknowledgement can't be missed
+        _, errors, result = events3.send_c2d_message_wait_feedback(target=target, device_id=device_id, data=data,
+                                                                   properties=properties,
+                                                                   correlation_id=correlation_id, ack=ack)
+        if errors:
+            raise CLIError('Error: {}, use --debug for more details.'.format(errors))
+        return result
+
     msg_id, errors = events3.send_c2d_message(target=target, device_id=device_id, data=data,
                                               properties=properties, correlation_id=correlation_id, ack=ack)
     if errors:
         raise CLIError('Error: {}, use --debug for more details.'.format(errors))
 
-    if wait:
-        _iot_hub_monitor_feedback(target=target, device_id=device_id, wait_on_id=msg_id)
+
+def iot_c2d_message_send_batch(cmd, input_file, hub_name=None, clients=None, wait_on_feedback=False, timeout=None,
+                               yes=False, repair=False, resource_group_name=None, login=None):
+    import importlib
+    from azext_iot.common.deps import ensure_uamqp
+    from azext_iot.common.utility import validate_min_python_version
+
+    validate_min_python_version(3, 5)
+
+    if clients is not None and clients < 1:
+        raise CLIError('Send clients must be 1 or greater.')
+    if timeout is not None and timeout < 1:
+        raise CLIError('Feedback timeout must be 1 second or greater.')
+
+    records = _load_c2d_batch(input_file)
+    if wait_on_feedback and not any(r.get('ack') not in (None, 'none') for r in records):
+        raise CLIError('To wait on device feedback, records must set "ack" to "full", "negative" or "positive"')
+
+    config = cmd.cli_ctx.config
+    ensure_uamqp(config, yes, repair)
+
+    target = get_iot_hub_connection_string(cmd, hub_name, resource_group_name, login=login)
+    events3 = importlib.import_module('azext_iot.operations.events3._events')
+    return events3.send_c2d_batch(target, records, clients=clients, wait_on_feedback=wait_on_feedback,
+                                  timeout=timeout)
+
+
+def _load_c2d_batch(input_file):
+    """ Reads C2D message records from a newline delimited JSON file. """
+    import json
+
+    if not exists(input_file):
+        raise CLIError('Input file "{}" does not exist.'.format(input_file))
+
+    ack_values = [ack.value for ack in AckType] + ['none']
+    records = []
+    with open(input_file, 'r') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                raise CLIError('Line {}: invalid JSON: {}'.format(line_number, e))
+            if not isinstance(record, dict) or not record.get('deviceId'):
+                raise CLIError('Line {}: each record must be an object with a "deviceId".'.format(line_number))
+
+            data = record.get('data', 'Ping from Az CLI IoT Extension')
+            if not isinstance(data, str):
+                data = json.dumps(data)
+            properties = record.get('properties')
+            if properties is not None and not isinstance(properties, dict):
+                raise CLIError('Line {}: "properties" must be an object.'.format(line_number))
+            ack = record.get('ack')
+            if ack is not None and ack not in ack_values:
+                raise CLIError('Line {}: "ack" must be one of {}.'.format(line_number, ', '.join(ack_values)))
+
+            records.append({
+                'deviceId': record['deviceId'],
+                'data': data,
+                'properties': {k: str(v) for k, v in properties.items()} if properties else None,
+                'correlationId': record.get('correlationId'),
+                'ack': ack,
+                'messageId': record.get('messageId'),
+            })
+    if not records:
+        raise CLIError('Input file "{}" contains no message records.'.format(input_file))
+    return records
+
+
+# Bounded worker pool size for fleet wide C2D purges
+PURGE_WORKERS_DEFAULT = 8
+PURGE_WORKERS_MAX = 32
+PURGE_MAX_RETRIES = 6
+PURGE_BACKOFF_SEC = 1
+PURGE_BACKOFF_MAX_SEC = 60
+PURGE_PROGRESS_INTERVAL_SEC = 2
+
+
+def iot_c2d_message_purge(cmd, device_id=None, device_query=None, id_file=None, workers=None, hub_name=None,
+                          resource_group_name=None, login=None):
+    if len([x for x in (device_id, device_query, id_file) if x]) != 1:
+        raise CLIError('Provide exactly one of --device-id, --device-query or --id-file.')
+    if workers is not None and not 1 <= workers <= PURGE_WORKERS_MAX:
+        raise CLIError('Purge workers must be between 1 and {}.'.format(PURGE_WORKERS_MAX))
+
+    target = get_iot_hub_connection_string(cmd, hub_name, resource_group_name, login=login)
+    if device_id:
+        device_ids = [device_id]
+    elif id_file:
+        device_ids = _load_device_ids(id_file)
+    else:
+        device_ids = [device['deviceId'] for device in
+                      iot_query(cmd, device_query, hub_name, -1, resource_group_name, login=login) or []
+                      if device.get('deviceId')]
+
+    return _iot_c2d_message_purge(target, device_ids, workers or PURGE_WORKERS_DEFAULT)
+
+
+def _load_device_ids(id_file):
+    """ Reads device Ids from a file with one Id per line. Blank lines and # comments are skipped. """
+    if not exists(id_file):
+        raise CLIError('Device Id file "{}" does not exist.'.format(id_file))
+    with open(id_file, 'r') as f:
+        device_ids = [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+    # Keep the file order but purge every device once
+    return list(OrderedDict.fromkeys(device_ids))
+
+
+def _iot_c2d_message_purge(target, device_ids, workers=PURGE_WORKERS_DEFAULT):
+    """
+    Purges the C2D queues of devices over a bounded pool of worker threads.
+
+    Throttled requests pause every worker until the throttle backoff has passed.
+    Progress is streamed to stderr.
+    """
+    import sys
+    import threading
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    clients = threading.local()
+    throttle = _ThrottleGate()
+
+    def purge(device_id):
+        try:
+            if not hasattr(clients, 'sdk'):
+                clients.sdk, clients.errors = _bind_sdk(target, SdkType.service_sdk)
+            for attempt in range(PURGE_MAX_RETRIES + 1):
+                throttle.wait()
+                try:
+                    result = clients.sdk.purge_command_queue(device_id)
+                    return device_id, (result.total_messages_purged or 0) if result else 0, None
+                except clients.errors.CloudError as e:
+                    status = e.response.status_code if e.response is not None else None
+                    if status == 429 and attempt < PURGE_MAX_RETRIES:
+                        throttle.backoff(e.response.headers.get('Retry-After'), attempt)
+                        continue
+                    return device_id, 0, unpack_msrest_error(e)
+        except Exception as x:
+            # Connection resets, timeouts or auth failures only fail this device, the fleet purge goes on
+            return device_id, 0, str(x)
+
+    summary = {'devices': len(device_ids), 'purgedDevices': 0, 'purgedMessages': 0, 'failedDevices': []}
+    start = time()
+    last_progress = start
+    with ThreadPoolExecutor(max_workers=min(workers, max(len(device_ids), 1))) as pool:
+        futures = [pool.submit(purge, d) for d in device_ids]
+        for completed, future in enumerate(as_completed(futures), 1):
+            device_id, purged, error = future.result()
+            if error:
+                summary['failedDevices'].append({'deviceId': device_id, 'error': error})
+            else:
+                summary['purgedDevices'] += 1
+                summary['purgedMessages'] += purged
+
+            now = time()
+            if now - last_progress >= PURGE_PROGRESS_INTERVAL_SEC or completed == len(futures):
+                last_progress = now
+                six.print_('Purged {}/{} devices, {} messages, {} failed, {} throttled'.format(
+                    completed, len(futures), summary['purgedMessages'], len(summary['failedDevices']),
+                    throttle.count), file=sys.stderr, flush=True)
+
+    summary['throttled'] = throttle.count
+    summary['elapsedSec'] = round(time() - start, 3)
+    return summary
+
+
+class _ThrottleGate(object):
+    """ Pauses every worker after a throttled request until its backoff has passed. """
+
+    def __init__(self):
+        import threading
+
+        self.count = 0
+        self._lock = threading.Lock()
+        self._resume_at = 0
+
+    def backoff(self, retry_after, attempt):
+        from random import uniform
+
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = min(PURGE_BACKOFF_SEC * 2 ** attempt, PURGE_BACKOFF_MAX_SEC)
+        delay += uniform(0, delay / 2)
+        with self._lock:
+            self.count += 1
+            self._resume_at = max(self._resume_at, time() + delay)
+
+    def wait(self):
+        with self._lock:
+            remaining = self._resume_at - time()
+        if remaining > 0:
+            sleep(remaining)
 
 
 def iot_simulate_device(cmd, device_id, hub_name=None, receive_settle='complete',
                         data='Ping from Az CLI IoT Extension', msg_count=100,
-                        msg_interval=3, protocol_type='mqtt', resource_group_name=None, login=None):
+                        msg_interval=None, protocol_type='mqtt', msg_rate=None, burst=1, ramp_up=0,
+                        template=None, batch_size=None, resource_group_name=None, login=None):
     import sys
-    import uuid
-    import datetime
-    import json
     from azext_iot.operations._mqtt import mqtt_client_wrap
-    from azext_iot.common.utility import execute_onthread
-    from azext_iot.constants import MIN_SIM_MSG_INTERVAL, MIN_SIM_MSG_COUNT, SIM_RECEIVE_SLEEP_SEC
+    from azext_iot.common.payload_template import default_template
+    from azext_iot.common.scheduler import RateSchedule
+    from azext_iot.constants import MIN_SIM_MSG_COUNT, SIM_MSG_INTERVAL_DEFAULT
 
     if protocol_type == 'mqtt':
         if receive_settle != 'complete':
             raise CLIError('mqtt protocol only supports settle type of "complete"')
 
-    if msg_interval < MIN_SIM_MSG_INTERVAL:
-        raise CLIError('msg interval must be at least {}'.format(MIN_SIM_MSG_INTERVAL))
+    if msg_interval is not None and msg_rate is not None:
+        raise CLIError('Provide either --msg-interval or --msg-rate, not both.')
+
+    if msg_interval is not None and msg_interval <= 0:
+        raise CLIError('msg interval must be greater than 0')
+
+    if msg_rate is not None and msg_rate <= 0:
+        raise CLIError('msg rate must be greater than 0')
 
     if msg_count < MIN_SIM_MSG_COUNT:
         raise CLIError('msg count must be at least {}'.format(MIN_SIM_MSG_COUNT))
 
-    target = get_iot_hub_connection_string(cmd, hub_name, resource_group_name, login=login)
-    token = None
+    if burst < 1:
+        raise CLIError('burst must be at least 1')
 
-    class generator(object):
-        def __init__(self):
-            self.calls = 0
+    if ramp_up < 0:
+        raise CLIError('ramp up must not be negative')
 
-        def generate(self, jsonify=True):
-            self.calls += 1
-            payload = {'id': str(uuid.uuid4()), 'timestamp': str(datetime.datetime.utcnow()),
-                       'data': str(data + ' #{}'.format(self.calls))}
-            return json.dumps(payload) if jsonify else payload
+    if batch_size is not None:
+        if protocol_type != 'http':
+            raise CLIError('batch size is only supported with the http protocol')
+        if batch_size < 1:
+            raise CLIError('batch size must be at least 1')
 
-    def http_wrap(target, device_id, generator):
-        d = generator.generate(False)
-        _iot_device_send_message_http(target, device_id, d)
-        six.print_('.', end='', flush=True)
+    schedule = RateSchedule(msg_rate or 1.0 / (msg_interval or SIM_MSG_INTERVAL_DEFAULT), burst=burst, ramp=ramp_up)
+    payload_template = _load_payload_template(template) if template else default_template(data)
+    target = get_iot_hub_connection_string(cmd, hub_name, resource_group_name, login=login)
 
     try:
         if protocol_type == 'mqtt':
             wrap = mqtt_client_wrap(target, device_id)
-            wrap.execute(generator(), publish_delay=msg_interval, msg_count=msg_count)
-        else:
-            six.print_('Sending and receiving events via https')
-            token, op = execute_onthread(method=http_wrap,
-                                         args=[target, device_id, generator()],
-                                         interval=msg_interval, max_runs=msg_count,
-                                         return_handle=True)
-            while True and op.is_alive():
-                _handle_c2d_msg(target, device_id, receive_settle)
-                sleep(SIM_RECEIVE_SLEEP_SEC)
+            return wrap.execute(payload_template.render(msg_count, device_id), msg_count=msg_count, schedule=schedule)
 
+        return _simulate_device_http(target, device_id, receive_settle, payload_template.renderer(device_id),
+                                     msg_count, schedule, batch_size)
     except KeyboardInterrupt:
         sys.exit()
     except Exception as x:
         raise CLIError(x)
-    finally:
-        if token:
-            token.set()
 
 
-def _handle_c2d_msg(target, device_id, receive_settle):
-    result = _iot_c2d_message_receive(target, device_id)
+def _simulate_device_http(target, device_id, receive_settle, render, msg_count, schedule, batch_size=None):
+    import json
+    from contextlib import ExitStack
+    from azext_iot.common.utility import execute_onthread
+    from azext_iot.operations._d2c import HttpD2CBatchSender
+    from azext_iot.constants import SIM_RECEIVE_MIN_SLEEP_SEC, SIM_RECEIVE_MAX_SLEEP_SEC
+
+    # One signed token and one keep-alive session per direction for the whole simulation
+    auth = _device_session_auth(target, device_id)
+
+    def renew():
+        _renew_device_session_auth(auth)
+
+    def http_wrap(target, device_id, sdk):
+        d = render()
+        try:
+            d = json.loads(d)
+        except ValueError:
+            d = d.decode('utf8')
+        renew()
+        _iot_device_send_message_http(target, device_id, d, sdk=sdk)
+        six.print_('.', end='', flush=True)
+
+    def http_batch_wrap(sender):
+        # Messages are buffered as they fall due and sent once a batch fills up
+        batches = sender.batches
+        _send_d2c_batch(sender, sender.add, render())
+        if sender.batches > batches:
+            six.print_('.', end='', flush=True)
+
+    token = None
+    with ExitStack() as sessions:
+        send_sdk = _bind_sdk(target, SdkType.device_sdk, device_id, auth=auth, sessions=sessions)
+        receive_sdk = _bind_sdk(target, SdkType.device_sdk, device_id, auth=auth, sessions=sessions)
+        sender = None
+        if batch_size:
+            sender = HttpD2CBatchSender(send_sdk, device_id, max_messages=batch_size, renew=renew)
+            method, args = http_batch_wrap, [sender]
+        else:
+            method, args = http_wrap, [target, device_id, send_sdk]
+        try:
+            six.print_('Sending and receiving events via https')
+            token, op = execute_onthread(method=method, args=args,
+                                         schedule=schedule, max_runs=msg_count,
+                                         return_handle=True)
+            # Drain queued C2D messages back to back, back off while the queue is empty
+            poll_sleep = SIM_RECEIVE_MIN_SLEEP_SEC
+            while op.is_alive():
+                renew()
+                if _handle_c2d_msg(target, device_id, receive_settle, sdk=receive_sdk):
+                    poll_sleep = SIM_RECEIVE_MIN_SLEEP_SEC
+                    continue
+                op.join(poll_sleep)
+                poll_sleep = min(poll_sleep * 2, SIM_RECEIVE_MAX_SLEEP_SEC)
+            report = schedule.report()
+            if sender:
+                _send_d2c_batch(sender, sender.flush)
+                batches = sender.report()
+                report.update({key: batches[key] for key in ('batches', 'messagesPerBatch', 'batchLatencyMs')})
+            return report
+        finally:
+            if token:
+                token.set()
+
+
+def _send_d2c_batch(sender, method, *args):
+    try:
+        method(*args)
+    except sender.sdk[1].CloudError as e:
+        raise CLIError(unpack_msrest_error(e))
+
+
+def _device_session_auth(target, device_id):
+    """ Device scoped token shared by the requests of a long running session. """
+    from azext_iot.constants import SIM_HTTP_TOKEN_DURATION_SEC
+
+    return SasTokenAuthentication('{}/devices/{}'.format(target['entity'], device_id), target['policy'],
+                                  target['primarykey'], time() + SIM_HTTP_TOKEN_DURATION_SEC)
+
+
+def _renew_device_session_auth(auth):
+    from azext_iot.constants import SIM_HTTP_TOKEN_DURATION_SEC, SIM_HTTP_TOKEN_RENEW_MARGIN_SEC
+
+    auth.renew(SIM_HTTP_TOKEN_DURATION_SEC, SIM_HTTP_TOKEN_RENEW_MARGIN_SEC)
+
+
+def _load_payload_template(template):
+    from azext_iot.common.payload_template import compile_template
+
+    if exists(template):
+        template = str(read_file_content(template))
+    try:
+        return compile_template(template)
+    except ValueError as e:
+        raise CLIError(e)
+
+
+def iot_simulate_fleet(cmd, hub_name=None, device_query=None, device_ids=None, device_prefix=None, device_count=None,
+                       data='Ping from Az CLI IoT Extension', msg_count=100, msg_interval=3,
+                       connect_concurrency=None, template=None, resource_group_name=None, login=None):
+    from azext_iot.operations._fleet import FleetSimulator, FLEET_CONNECT_CONCURRENCY
+    from azext_iot.common.payload_template import default_template
+    from azext_iot.constants import MIN_SIM_MSG_COUNT
+
+    if len([x for x in (device_query, device_ids, device_prefix) if x]) != 1:
+        raise CLIError('Provide exactly one of --device-query, --device-ids or --device-prefix.')
+    if device_prefix and (not device_count or device_count < 1):
+        raise CLIError('--device-prefix requires a --device-count of 1 or greater.')
+    if device_count and not device_prefix:
+        raise CLIError('--device-count can only be used with --device-prefix.')
+    if msg_count < MIN_SIM_MSG_COUNT:
+        raise CLIError('msg count must be at least {}'.format(MIN_SIM_MSG_COUNT))
+    if msg_interval <= 0:
+        raise CLIError('msg interval must be greater than 0')
+    if connect_concurrency is not None and connect_concurrency < 1:
+        raise CLIError('Connect concurrency must be 1 or greater.')
+
+    payload_template = _load_payload_template(template) if template else default_template(data, device_id=True)
+    target = get_iot_hub_connection_string(cmd, hub_name, resource_group_name, login=login)
+    if device_prefix:
+        device_ids = ['{}{}'.format(device_prefix, i) for i in range(device_count)]
+    elif device_query:
+        device_ids = [device['deviceId'] for device in
+                      iot_query(cmd, device_query, hub_name, -1, resource_group_name, login=login) or []
+                      if device.get('deviceId')]
+    device_ids = list(OrderedDict.fromkeys(device_ids))
+    if not device_ids:
+        raise CLIError('No devices to simulate.')
+
+    simulator = FleetSimulator(target, device_ids, payload_template, msg_count, msg_interval,
+                               connect_concurrency=connect_concurrency or FLEET_CONNECT_CONCURRENCY)
+    return simulator.run()
+
+
+def _handle_c2d_msg(target, device_id, receive_settle, sdk=None):
+    result = _iot_c2d_message_receive(target, device_id, sdk=sdk)
     if result:
         six.print_()
         six.print_('__Received C2D Message__')
         six.print_(result)
         if receive_settle == 'reject':
             six.print_('__Rejecting message__')
-            _iot_c2d_message_reject(target, device_id, result['etag'])
+            _iot_c2d_message_reject(target, device_id, result['etag'], sdk=sdk)
         elif receive_settle == 'abandon':
             six.print_('__Abandoning message__')
-            _iot_c2d_message_abandon(target, device_id, result['etag'])
+            _iot_c2d_message_abandon(target, device_id, result['etag'], sdk=sdk)
         else:
             six.print_('__Completing message__')
-            _iot_c2d_message_complete(target, device_id, result['etag'])
+            _iot_c2d_message_complete(target, device_id, result['etag'], sdk=sdk)
         return True
     return False
 
@@ -1333,26 +1691,62 @@ def iot_device_upload_file(cmd, device_id, file_path, content_type, hub_name=Non
 
 def iot_hub_monitor_events(cmd, hub_name=None, device_id=None, consumer_group='$Default', timeout=300,
                            enqueued_time=None, resource_group_name=None, yes=False, properties=None, repair=False,
-                           login=None, content_type=None, device_query=None):
+                           login=None, content_type=None, device_query=None, workers=None, checkpoint_dir=None,
+                           prefetch=None, batch_size=None, ndjson=False, output_file=None, rotate_size=None,
+                           compress=False, aggregate=None, aggregate_fields=None, metrics=None,
+                           metrics_file=None, queue_size=None, queue_policy=None, record=None, replay=None,
+                           replay_pace=None, hubs=None):
+    if workers is not None and workers < 1:
+        raise CLIError('Monitor workers must be 1 or greater.')
+    if workers and workers > 1:
+        # Every worker aggregates and records on its own, windows and captures would be split per worker
+        if aggregate:
+            raise CLIError('--aggregate cannot be used with more than one monitor worker.')
+        if record:
+            raise CLIError('--record cannot be used with more than one monitor worker.')
+    if prefetch is not None and prefetch < 0:
+        raise CLIError('Monitor prefetch must be 0 or greater.')
+    if batch_size is not None:
+        if batch_size < 1:
+            raise CLIError('Monitor batch size must be 1 or greater.')
+        if prefetch and batch_size > prefetch:
+            raise CLIError('Monitor batch size cannot be greater than prefetch.')
+    if hubs:
+        if workers and workers > 1:
+            raise CLIError('Monitor workers cannot be used when monitoring several hubs.')
+        if replay:
+            raise CLIError('--hubs cannot be used with --replay.')
+
     _iot_hub_monitor_events(cmd, interface=None, pnp_context=None, hub_name=hub_name, device_id=device_id,
                             consumer_group=consumer_group, timeout=timeout, enqueued_time=enqueued_time,
                             resource_group_name=resource_group_name, yes=yes, properties=properties,
-                            repair=repair, login=login, content_type=content_type, device_query=device_query)
+                            repair=repair, login=login, content_type=content_type, device_query=device_query,
+                            workers=workers, checkpoint_dir=checkpoint_dir, prefetch=prefetch, batch_size=batch_size,
+                            ndjson=ndjson, output_file=output_file, rotate_size=rotate_size, compress=compress,
+                            aggregate=aggregate, aggregate_fields=aggregate_fields, metrics=metrics,
+                            metrics_file=metrics_file, queue_size=queue_size, queue_policy=queue_policy,
+                            record=record, replay=replay, replay_pace=replay_pace, hubs=hubs)
 
 
 def iot_hub_monitor_feedback(cmd, hub_name=None, device_id=None, yes=False,
-                             wait_on_id=None, repair=False, resource_group_name=None, login=None):
+                             wait_on_id=None, repair=False, resource_group_name=None, login=None,
+                             ndjson=False, output_file=None, rotate_size=None, compress=False, timeout=None):
     from azext_iot.common.deps import ensure_uamqp
     from azext_iot.common.utility import validate_min_python_version
 
     validate_min_python_version(3, 4)
+    validate_monitor_output(output_file, rotate_size, compress)
+    if timeout is not None and timeout < 1:
+        raise CLIError('Feedback timeout must be 1 second or greater.')
 
     config = cmd.cli_ctx.config
     ensure_uamqp(config, yes, repair)
 
     target = get_iot_hub_connection_string(cmd, hub_name, resource_group_name, login=login)
 
-    return _iot_hub_monitor_feedback(target=target, device_id=device_id, wait_on_id=wait_on_id)
+    return _iot_hub_monitor_feedback(target=target, device_id=device_id, wait_on_id=wait_on_id,
+                                     output='ndjson' if ndjson else None, output_file=output_file,
+                                     rotate_size=rotate_size, compress=compress, timeout=timeout)
 
 
 def iot_hub_distributed_tracing_show(cmd, hub_name, device_id, resource_group_name=None):
@@ -1364,24 +1758,68 @@ def iot_hub_distributed_tracing_show(cmd, hub_name, device_id, resource_group_na
 def _iot_hub_monitor_events(cmd, interface=None, pnp_context=None,
                             hub_name=None, device_id=None, consumer_group='$Default', timeout=300,
                             enqueued_time=None, resource_group_name=None, yes=False, properties=None, repair=False,
-                            login=None, content_type=None, device_query=None):
+                            login=None, content_type=None, device_query=None, workers=None, checkpoint_dir=None,
+                            prefetch=None, batch_size=None, ndjson=False, output_file=None, rotate_size=None,
+                            compress=False, aggregate=None, aggregate_fields=None, metrics=None,
+                            metrics_file=None, queue_size=None, queue_policy=None, record=None, replay=None,
+                            replay_pace=None, hubs=None):
     import importlib
 
+    validate_monitor_output(output_file, rotate_size, compress)
+    validate_monitor_aggregate(aggregate, aggregate_fields)
+    validate_monitor_metrics(metrics, metrics_file)
+    validate_monitor_queue(queue_size)
+    validate_monitor_capture(record, replay, replay_pace)
     (enqueued_time, properties, timeout, output) = init_monitoring(cmd, timeout, properties, enqueued_time, repair, yes)
+    if ndjson:
+        output = 'ndjson'
 
     events3 = importlib.import_module('azext_iot.operations.events3._events')
     builders = importlib.import_module('azext_iot.operations.events3._builders')
 
+    hub_logins = [(hub_name, resource_group_name, login)]
+    for hub in hubs or []:
+        # Additional hubs are looked up across the subscription
+        if 'hostname=' in hub.lower():
+            hub_logins.append((None, None, hub))
+        else:
+            hub_logins.append((hub, None, None))
+
     device_ids = {}
     if device_query:
-        devices_result = iot_query(cmd, device_query, hub_name, None, resource_group_name, login=login)
-        if devices_result:
-            for device_result in devices_result:
-                device_ids[device_result['deviceId']] = True
+        for (name, group, hub_login) in hub_logins:
+            devices_result = iot_query(cmd, device_query, name, None, group, login=hub_login)
+            if devices_result:
+                for device_result in devices_result:
+                    device_ids[device_result['deviceId']] = True
+
+    if replay:
+        events3.replay_executor(replay,
+                                pace=replay_pace,
+                                properties=properties,
+                                device_id=device_id,
+                                output=output,
+                                content_type=content_type,
+                                devices=device_ids,
+                                interface_id=interface,
+                                pnp_context=pnp_context,
+                                output_file=output_file,
+                                rotate_size=rotate_size,
+                                compress=compress,
+                                aggregate=aggregate,
+                                aggregate_fields=aggregate_fields,
+                                metrics=metrics,
+                                metrics_file=metrics_file,
+                                queue_size=queue_size,
+                                queue_policy=queue_policy)
+        return
 
-    target = get_iot_hub_connection_string(cmd, hub_name, resource_group_name, include_events=True, login=login)
+    targets = [get_iot_hub_connection_string(cmd, name, group, include_events=True, login=hub_login)
+               for (name, group, hub_login) in hub_logins]
+    if len({target['entity'] for target in targets}) < len(targets):
+        raise CLIError('Each hub can only be monitored once.')
 
-    eventHubTarget = builders.EventTargetBuilder().build_iot_hub_target(target)
+    eventHubTarget = builders.EventTargetBuilder().build_iot_hub_targets(targets)
 
     events3.executor(eventHubTarget,
                      consumer_group=consumer_group,
@@ -1393,7 +1831,21 @@ def _iot_hub_monitor_events(cmd, interface=None, pnp_context=None,
                      content_type=content_type,
                      devices=device_ids,
                      interface_id=interface,
-                     pnp_context=pnp_context)
+                     pnp_context=pnp_context,
+                     workers=workers,
+                     checkpoint_dir=checkpoint_dir,
+                     prefetch=prefetch,
+                     batch_size=batch_size,
+                     output_file=output_file,
+                     rotate_size=rotate_size,
+                     compress=compress,
+                     aggregate=aggregate,
+                     aggregate_fields=aggregate_fields,
+                     metrics=metrics,
+                     metrics_file=metrics_file,
+                     queue_size=queue_size,
+                     queue_policy=queue_policy,
+                     record=record)
 
 
 def iot_hub_distributed_tracing_update(cmd, hub_name, device_id, sampling_mode, sampling_rate,
@@ -1410,11 +1862,14 @@ def iot_hub_distributed_tracing_update(cmd, hub_name, device_id, sampling_mode,
                                             result.properties.reported)
 
 
-def _iot_hub_monitor_feedback(target, device_id, wait_on_id):
+def _iot_hub_monitor_feedback(target, device_id, wait_on_id, output=None, output_file=None,
+                              rotate_size=None, compress=False, timeout=None):
     import importlib
 
     events3 = importlib.import_module('azext_iot.operations.events3._events')
-    events3.monitor_feedback(target=target, device_id=device_id, wait_on_id=wait_on_id, token_duration=3600)
+    return events3.monitor_feedback(target=target, device_id=device_id, wait_on_id=wait_on_id, token_duration=3600,
+                                    output=output, output_file=output_file, rotate_size=rotate_size,
+                                    compress=compress, timeout=timeout)
 
 
 def _iot_hub_distributed_tracing_show(cmd, hub_name, device_id, resource_group_name=None):
@@ -70,6 +70,14 @@ class IotHubGatewayDeviceAPIs(object):
         self._serialize = Serializer(client_models)
         self._deserialize = Deserializer(client_models)
 
+    # Added to keep connections alive across requests made within the context
+    def __enter__(self):
+        self._client.__enter__()
+        return self
+
+    def __exit__(self, *exc_details):
+        self._client.__exit__(*exc_details)
+
     # @digimaun - Altered to support request body parameter of object
     def send_device_event(
             self, id, message, custom_headers=None, raw=False, **operation_config):
@@ -124,6 +132,59 @@ class IotHubGatewayDeviceAPIs(object):
             return client_raw_response
     send_device_event.metadata = {'url': '/devices/{id}/messages/events'}
 
+    # Added to send batches of device events serialized by the caller
+    def send_device_event_batch(
+            self, id, batch, custom_headers=None, raw=False, **operation_config):
+        """Send a batch of device-to-cloud messages in one request.
+
+        :param id: Device ID.
+        :type id: str
+        :param bytes batch: JSON array of messages in the IoT Hub batch format,
+         objects with 'body', 'base64Encoded' and 'properties'.
+        :param dict custom_headers: headers that will be added to the request
+        :param bool raw: returns the direct response alongside the
+         deserialized response
+        :param operation_config: :ref:`Operation configuration
+         overrides<msrest:optionsforoperations>`.
+        :return: None or ClientRawResponse if raw=true
+        :rtype: None or ~msrest.pipeline.ClientRawResponse
+        :raises: :class:`CloudError<msrestazure.azure_exceptions.CloudError>`
+        """
+        # Construct URL
+        url = self.send_device_event_batch.metadata['url']
+        path_format_arguments = {
+            'id': self._serialize.url("id", id, 'str')
+        }
+        url = self._client.format_url(url, **path_format_arguments)
+
+        # Construct parameters
+        query_parameters = {}
+        query_parameters['api-version'] = self._serialize.query("self.api_version", self.api_version, 'str')
+
+        # Construct headers
+        header_parameters = {}
+        header_parameters['Content-Type'] = 'application/vnd.microsoft.iothub.json'
+        if self.config.generate_client_request_id:
+            header_parameters['x-ms-client-request-id'] = str(uuid.uuid1())
+        if custom_headers:
+            header_parameters.update(custom_headers)
+        if self.config.accept_language is not None:
+            header_parameters['accept-language'] = self._serialize.header("self.config.accept_language", self.config.accept_language, 'str')
+
+        # Construct and send request
+        request = self._client.post(url, query_parameters)
+        response = self._client.send(request, header_parameters, batch, stream=False, **operation_config)
+
+        if response.status_code not in [204]:
+            exp = CloudError(response)
+            exp.request_id = response.headers.get('x-ms-request-id')
+            raise exp
+
+        if raw:
+            client_raw_response = ClientRawResponse(None, response)
+            return client_raw_response
+    send_device_event_batch.metadata = {'url': '/devices/{id}/messages/events'}
+
     def receive_device_bound_notification(
             self, id, custom_headers=None, raw=False, **operation_config):
         """This method is used to retrieve a cloud-to-device message.
@@ -0,0 +1,436 @@
+# coding=utf-8
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+"""
+Micro-benchmarks for the event monitor message handling path.
+
+Not collected by pytest. Run locally with:
+
+    python -m azext_iot.tests.bench_events [filters] [prefetch] [pipeline] [--count N]
+        [--save results.json] [--compare results.json] [--tolerance 0.1]
+
+Results are single core messages/s, so they are comparable across machines only loosely.
+Save results on a known good tree and compare against them on the same machine to catch
+regressions.
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import re
+import sys
+import tracemalloc
+from collections import deque
+from time import perf_counter
+
+import uamqp
+import yaml
+
+from azext_iot.common.utility import parse_entity, unicode_binary_map
+from azext_iot.operations.events3 import _events
+from azext_iot.operations.events3._filters import compile_event_handler
+
+DEFAULT_MESSAGE_COUNT = 20000
+DEVICE_COUNT = 100
+ALLOCATION_SAMPLE_SIZE = 200
+DEFAULT_TOLERANCE = 0.1
+
+INTERFACE_ID = "urn:contoso:interfaces:environmentalsensor:1"
+
+
+def build_messages(count, device_count=DEVICE_COUNT):
+    messages = []
+    for i in range(count):
+        device = "device-{}".format(i % device_count)
+        body = json.dumps({"temperature": 20 + (i % 10), "humidity": 40, "seq": i})
+        props = uamqp.message.MessageProperties(
+            content_type="application/json", message_id=str(i)
+        )
+        messages.append(
+            uamqp.Message(
+                body.encode("utf8"),
+                properties=props,
+                application_properties={b"sensor": b"bme280"},
+                annotations={
+                    b"iothub-connection-device-id": device.encode("utf8"),
+                    b"x-opt-sequence-number": i,
+                },
+            )
+        )
+    return messages
+
+
+def _build_message(i, body, content_type, application_properties=None, interface=None):
+    annotations = {
+        b"iothub-connection-device-id": "device-{}".format(i % DEVICE_COUNT).encode("utf8"),
+        b"iothub-enqueuedtime": 1577836800000 + i,
+        b"x-opt-sequence-number": i,
+        b"x-opt-offset": str(i * 512).encode("utf8"),
+        b"x-opt-enqueuedtimeutc": 1577836800000 + i,
+    }
+    if interface:
+        annotations[b"iothub-interface-name"] = interface.encode("utf8")
+    props = uamqp.message.MessageProperties(
+        content_type=content_type, content_encoding="utf-8", message_id=str(i)
+    )
+    return uamqp.Message(
+        body,
+        properties=props,
+        application_properties=application_properties,
+        annotations=annotations,
+    )
+
+
+def build_json_messages(count):
+    return [
+        _build_message(
+            i,
+            json.dumps({"temperature": 20 + (i % 10), "humidity": 40, "seq": i}).encode("utf8"),
+            "application/json",
+            {b"sensor": b"bme280"},
+        )
+        for i in range(count)
+    ]
+
+
+def build_binary_messages(count):
+    payload = bytes(range(256))
+    return [
+        _build_message(i, payload, "application/octet-stream", {b"sensor": b"camera"})
+        for i in range(count)
+    ]
+
+
+def build_pnp_messages(count):
+    return [
+        _build_message(
+            i,
+            json.dumps({"temp": 20 + (i % 10)}).encode("utf8"),
+            "application/json",
+            {b"iothub-message-schema": b"temp"},
+            interface=INTERFACE_ID,
+        )
+        for i in range(count)
+    ]
+
+
+def build_large_property_messages(count, property_count=64):
+    properties = {
+        "property{}".format(n).encode("utf8"): "value{}".format(n).encode("utf8")
+        for n in range(property_count)
+    }
+    return [
+        _build_message(
+            i,
+            json.dumps({"temperature": 20 + (i % 10)}).encode("utf8"),
+            "application/json",
+            dict(properties),
+        )
+        for i in range(count)
+    ]
+
+
+PAYLOADS = [
+    ("json", build_json_messages, {}),
+    ("binary", build_binary_messages, {}),
+    (
+        "pnp",
+        build_pnp_messages,
+        {
+            "interface_id": INTERFACE_ID,
+            "pnp_context": {
+                "interface": {INTERFACE_ID: {"temp": {"display": "Temperature", "unit": "C"}}}
+            },
+        },
+    ),
+    ("large app props", build_large_property_messages, {}),
+]
+
+OUTPUTS = ["json", "ndjson", "yaml"]
+
+PROPERTY_SELECTIONS = [
+    ("none", set()),
+    ("sys", {"sys"}),
+    ("app", {"app"}),
+    ("anno", {"anno"}),
+    ("all", {"all"}),
+]
+
+
+def legacy_handler(device_id=None, devices=None, properties=None, content_type=None, output="json"):
+    """ Per-message filter and projection as implemented before filter compilation. """
+    properties = properties or set()
+
+    def handle(msg):
+        origin = str(msg.annotations.get(b"iothub-connection-device-id"), "utf8")
+        if device_id and device_id != origin:
+            if "*" in device_id or "?" in device_id:
+                regex = re.escape(device_id).replace("\\*", ".*").replace("\\?", ".") + "$"
+                if not re.match(regex, origin):
+                    return None
+            else:
+                return None
+        if devices and origin not in devices:
+            return None
+
+        event_source = {"event": {}}
+        event_source["event"]["origin"] = origin
+        payload = ""
+        data = msg.get_data()
+        if data:
+            payload = str(next(data), "utf8")
+        system_props = unicode_binary_map(parse_entity(msg.properties, True))
+        ct = content_type
+        if not ct:
+            ct = system_props["content_type"] if "content_type" in system_props else ""
+        if ct and ct.lower() == "application/json":
+            try:
+                payload = json.loads(re.compile(r"(\\r\\n)+|\\r+|\\n+").sub("", payload))
+            except Exception:
+                pass
+        event_source["event"]["payload"] = payload
+        if "anno" in properties or "all" in properties:
+            event_source["event"]["annotations"] = unicode_binary_map(msg.annotations)
+        if "sys" in properties or "all" in properties:
+            if not event_source["event"].get("properties"):
+                event_source["event"]["properties"] = {}
+            event_source["event"]["properties"]["system"] = system_props
+        if "app" in properties or "all" in properties:
+            if not event_source["event"].get("properties"):
+                event_source["event"]["properties"] = {}
+            if msg.application_properties:
+                event_source["event"]["properties"]["application"] = unicode_binary_map(
+                    msg.application_properties
+                )
+        if output.lower() == "json":
+            return json.dumps(event_source, indent=4)
+        return yaml.safe_dump(event_source, default_flow_style=False)
+
+    return handle
+
+
+SCENARIOS = [
+    ("no filter", {}),
+    ("literal device", {"device_id": "device-7"}),
+    ("wildcard device", {"device_id": "device-1*"}),
+    ("device query", {"devices": {"device-{}".format(i): True for i in range(0, DEVICE_COUNT, 2)}}),
+    ("wildcard + all props", {"device_id": "device-1*", "properties": {"all"}}),
+]
+
+
+def measure(handler, messages):
+    start = perf_counter()
+    for msg in messages:
+        handler(msg)
+    elapsed = perf_counter() - start
+    return len(messages) / elapsed if elapsed else float("inf")
+
+
+def measure_allocations(handler, messages):
+    """
+    Average bytes allocated while handling one message.
+
+    CPython has no allocation counter, so this is the traced memory peak reached while
+    handling each message, which counts every transient object and buffer of the message.
+    """
+    if not hasattr(tracemalloc, "reset_peak"):
+        return None
+    sample = messages[:ALLOCATION_SAMPLE_SIZE]
+    gc.collect()
+    tracemalloc.start()
+    try:
+        total = 0
+        for msg in sample:
+            base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            handler(msg)
+            total += tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+    return total / len(sample)
+
+
+def bench_filters(count):
+    messages = build_messages(count)
+    results = {}
+
+    print("{:<24}{:>14}{:>14}{:>10}".format("scenario", "before msg/s", "after msg/s", "speedup"))
+    for name, options in SCENARIOS:
+        before = measure(legacy_handler(**options), messages)
+        after = measure(compile_event_handler(output="json", **options), messages)
+        results[name] = after
+        print("{:<24}{:>14.0f}{:>14.0f}{:>9.2f}x".format(name, before, after, after / before))
+    return results
+
+
+def bench_pipeline(count):
+    results = {}
+
+    print("{:<18}{:<8}{:<7}{:>12}{:>14}".format("payload", "output", "props", "msg/s", "alloc B/msg"))
+    for payload, builder, options in PAYLOADS:
+        messages = builder(count)
+        for output in OUTPUTS:
+            for selection, properties in PROPERTY_SELECTIONS:
+                handler = compile_event_handler(output=output, properties=properties, **options)
+                rate = measure(handler, messages)
+                allocated = measure_allocations(handler, messages)
+                results["{}/{}/{}".format(payload, output, selection)] = rate
+                print(
+                    "{:<18}{:<8}{:<7}{:>12.0f}{:>14}".format(
+                        payload,
+                        output,
+                        selection,
+                        rate,
+                        "{:.0f}".format(allocated) if allocated is not None else "n/a",
+                    )
+                )
+    return results
+
+
+class StandInReceiveClient(object):
+    """
+    Local stand-in for uamqp.ReceiveClientAsync modelling link credit.
+
+    Every time the receiver runs out of buffered messages it issues more credit, which costs
+    one round trip and delivers up to `prefetch` messages. A prefetch of 0 grants one credit
+    per message, as the monitor did before batch receive.
+    """
+
+    messages = []
+    round_trip_sec = 0.002
+
+    def __init__(self, source, auth=None, timeout=0, prefetch=300, debug=False, **kwargs):
+        self._credit = max(prefetch, 1)
+        self._pending = iter(self.messages)
+        self._buffer = deque()
+
+    async def _refill(self):
+        await asyncio.sleep(self.round_trip_sec)
+        for _ in range(self._credit):
+            msg = next(self._pending, None)
+            if msg is None:
+                break
+            self._buffer.append(msg)
+
+    async def receive_message_batch_async(self, max_batch_size=None, timeout=0):
+        if not self._buffer:
+            await self._refill()
+        batch = []
+        while self._buffer and len(batch) < max_batch_size:
+            batch.append(self._buffer.popleft())
+        return batch
+
+    async def receive_messages_iter_async(self):
+        while True:
+            if not self._buffer:
+                await self._refill()
+                if not self._buffer:
+                    return
+            yield self._buffer.popleft()
+
+    async def open_async(self, connection=None):
+        pass
+
+    async def close_async(self):
+        pass
+
+
+PREFETCH_SCENARIOS = [
+    ("iterate, prefetch 0", {}),
+    ("iterate, prefetch 50", {"prefetch": 50}),
+    ("batch 10, prefetch 10", {"batch_size": 10}),
+    ("batch 100, prefetch 100", {"batch_size": 100}),
+    ("batch 100, prefetch 300", {"batch_size": 100, "prefetch": 300}),
+    ("batch 300, prefetch 300", {"batch_size": 300}),
+]
+
+
+def bench_prefetch(count):
+    StandInReceiveClient.messages = build_messages(count)
+    loop = asyncio.new_event_loop()
+    original_client = _events.uamqp.ReceiveClientAsync
+    _events.uamqp.ReceiveClientAsync = StandInReceiveClient
+    results = {}
+
+    print("stand-in link round trip: {:.1f} ms".format(StandInReceiveClient.round_trip_sec * 1000))
+    print("{:<28}{:>14}".format("scenario", "msg/s"))
+    try:
+        for name, options in PREFETCH_SCENARIOS:
+            start = perf_counter()
+            loop.run_until_complete(
+                _events.monitor_events(
+                    endpoint="standin",
+                    connection=None,
+                    path="standin",
+                    auth=None,
+                    partition="0",
+                    consumer_group="$Default",
+                    enqueuedtimeutc=0,
+                    properties=set(),
+                    output="json",
+                    printer=lambda dump: None,
+                    **options
+                )
+            )
+            elapsed = perf_counter() - start
+            results[name] = count / elapsed
+            print("{:<28}{:>14.0f}".format(name, count / elapsed))
+    finally:
+        _events.uamqp.ReceiveClientAsync = original_client
+        loop.close()
+    return results
+
+
+BENCHMARKS = {"filters": bench_filters, "prefetch": bench_prefetch, "pipeline": bench_pipeline}
+
+
+def compare(results, baseline, tolerance):
+    """ Prints scenarios slower than the baseline by more than tolerance. Returns their count. """
+    regressions = 0
+    for benchmark, scenarios in sorted(results.items()):
+        for name, rate in sorted(scenarios.items()):
+            previous = baseline.get(benchmark, {}).get(name)
+            if previous and rate < previous * (1 - tolerance):
+                regressions += 1
+                print(
+                    "REGRESSION {}: {}: {:.0f} msg/s, baseline {:.0f} msg/s ({:+.1%})".format(
+                        benchmark, name, rate, previous, rate / previous - 1
+                    )
+                )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Event monitor micro-benchmarks.")
+    parser.add_argument("benchmarks", nargs="*", help="one or more of: {}".format(", ".join(sorted(BENCHMARKS))))
+    parser.add_argument("--count", type=int, default=DEFAULT_MESSAGE_COUNT)
+    parser.add_argument("--save", help="write msg/s results to this JSON file")
+    parser.add_argument("--compare", help="compare msg/s results to a file written by --save")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args(argv if argv is not None else sys.argv[1:])
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error("unknown benchmark: {}".format(", ".join(unknown)))
+
+    results = {}
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        print("== {} ==".format(name))
+        results[name] = BENCHMARKS[name](args.count)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare and os.path.exists(args.compare):
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1188 @@
+# coding=utf-8
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+import pytest
+import json
+import os
+from knack.util import CLIError
+from azext_iot.common.utility import validate_min_python_version
+
+pytestmark = pytest.mark.skipif(
+    not validate_min_python_version(3, 5, exit_on_fail=False),
+    reason="minimum python version not satisfied",
+)
+
+device_id = "mydevice"
+interface_id = "urn:example:interfaces:sensor:1"
+
+
+def build_message(
+    origin=device_id,
+    body='{"temperature": 20}',
+    content_type="application/json",
+    interface=None,
+    app_props=None,
+):
+    import uamqp
+
+    annotations = {b"iothub-connection-device-id": origin.encode("utf8")}
+    if interface:
+        annotations[b"iothub-interface-name"] = interface.encode("utf8")
+    props = uamqp.message.MessageProperties(content_type=content_type, message_id="1")
+    return uamqp.Message(
+        body.encode("utf8"),
+        properties=props,
+        application_properties=app_props,
+        annotations=annotations,
+    )
+
+
+class TestEventFilter:
+    @pytest.mark.parametrize(
+        "target, devices, origin, expected",
+        [
+            (None, None, "anything", True),
+            (device_id, None, device_id, True),
+            (device_id, None, "otherdevice", False),
+            ("my*", None, device_id, True),
+            ("my?evice", None, device_id, True),
+            ("your*", None, device_id, False),
+            (None, {device_id: True}, device_id, True),
+            (None, {device_id: True}, "otherdevice", False),
+            ("my*", {"mydevice2": True}, device_id, False),
+            ("*", None, None, False),
+            ("my?evice", None, None, False),
+            (device_id, None, None, False),
+        ],
+    )
+    def test_match_origin(self, target, devices, origin, expected):
+        from azext_iot.operations.events3._filters import EventFilter
+
+        event_filter = EventFilter(device_id=target, devices=devices)
+        assert event_filter.match_origin(origin) == expected
+
+    @pytest.mark.parametrize(
+        "target, interface, expected",
+        [
+            (None, interface_id, True),
+            (None, None, False),
+            (interface_id, interface_id, True),
+            (interface_id, "urn:example:interfaces:other:1", False),
+        ],
+    )
+    def test_match_interface(self, target, interface, expected):
+        from azext_iot.operations.events3._filters import EventFilter
+
+        event_filter = EventFilter(interface_id=target, pnp_context={"interface": {}})
+        assert event_filter.match_interface(interface) == expected
+
+
+class TestEventHandler:
+    @pytest.mark.parametrize(
+        "properties, expected_keys",
+        [
+            (set(), {"origin", "payload"}),
+            ({"anno"}, {"origin", "payload", "annotations"}),
+            ({"sys", "app"}, {"origin", "payload", "properties"}),
+            ({"all"}, {"origin", "payload", "annotations", "properties"}),
+        ],
+    )
+    def test_projection(self, properties, expected_keys):
+        from azext_iot.operations.events3._filters import compile_event_handler
+
+        handler = compile_event_handler(properties=properties, output="json")
+        event = json.loads(handler(build_message(app_props={b"k": b"v"})))["event"]
+
+        assert set(event.keys()) == expected_keys
+        assert event["origin"] == device_id
+        assert event["payload"] == {"temperature": 20}
+
+    def test_filtered_out(self):
+        from azext_iot.operations.events3._filters import compile_event_handler
+
+        handler = compile_event_handler(device_id="other*")
+        assert handler(build_message()) is None
+
+    def test_pnp_display_mapping(self):
+        from azext_iot.operations.events3._filters import compile_event_handler
+
+        pnp_context = {
+            "interface": {interface_id: {"temp": {"display": "Temperature", "unit": "C"}}}
+        }
+        handler = compile_event_handler(
+            pnp_context=pnp_context, interface_id=interface_id, output="json"
+        )
+        msg = build_message(
+            interface=interface_id, app_props={b"iothub-message-schema": b"temp"}
+        )
+        event = json.loads(handler(msg))["event"]
+
+        assert event["interface"] == interface_id
+        assert event["payload"] == {"Temperature": {"temperature": 20}, "unit": "C"}
+        assert handler(build_message()) is None
+
+
+class TestPnpDecoders:
+    @pytest.mark.parametrize(
+        "schema, payload, expected",
+        [
+            ("double", "21.5", 21.5),
+            ("integer", {"temp": "7", "other": "1"}, {"temp": 7, "other": "1"}),
+            ("boolean", "TRUE", True),
+            ("double", "not a number", "not a number"),
+            (
+                {"@type": "Enum", "enumValues": [{"name": "on", "enumValue": 1}]},
+                {"temp": 1},
+                {"temp": "on"},
+            ),
+        ],
+    )
+    def test_typed_parsing(self, schema, payload, expected):
+        from azext_iot.operations.events3._pnp import compile_pnp_decoders
+
+        context = {"typed": True, "interface": {interface_id: {"temp": {"schema": schema}}}}
+        decoders = compile_pnp_decoders(context)
+        assert decoders[(interface_id, "temp")](payload) == expected
+
+        context["typed"] = False
+        assert compile_pnp_decoders(context) == {}
+
+    def test_display_dispatch(self):
+        from azext_iot.operations.events3._filters import compile_event_handler
+
+        pnp_context = {
+            "typed": True,
+            "interface": {
+                interface_id: {
+                    "temp": {"display": "Temperature", "unit": "C", "schema": "integer"},
+                    "status": {"schema": "string"},
+                }
+            },
+        }
+        handler = compile_event_handler(pnp_context=pnp_context, output="json")
+
+        msg = build_message(
+            body='"20"', interface=interface_id, app_props={b"iothub-message-schema": b"temp"}
+        )
+        assert json.loads(handler(msg))["event"]["payload"] == {"Temperature": 20, "unit": "C"}
+
+        msg = build_message(
+            body='"ok"', interface=interface_id, app_props={b"iothub-message-schema": b"status"}
+        )
+        assert json.loads(handler(msg))["event"]["payload"] == "ok"
+
+
+class TestEventView:
+    def test_lazy_decoding(self):
+        from azext_iot.operations.events3._views import EventView
+
+        view = EventView(
+            build_message(interface=interface_id, app_props={b"k": b"v"})
+        )
+        assert view.origin == device_id
+        assert view.interface == interface_id
+        assert view.content_type == "application/json"
+        assert view._system_properties is None
+
+        assert isinstance(view.body, memoryview)
+        assert view.text() == '{"temperature": 20}'
+        assert view.system_properties() == {
+            "content_type": "application/json",
+            "message_id": "1",
+        }
+        assert view.application_property(b"k") == "v"
+        assert view.application_properties() == {"k": "v"}
+
+    def test_empty_parts(self):
+        import uamqp
+        from azext_iot.operations.events3._views import EventView
+
+        view = EventView(uamqp.Message(b""))
+        assert view.origin is None
+        assert view.content_type == ""
+        assert view.text() == ""
+        assert view.system_properties() == {}
+        assert view.application_properties() is None
+
+    def test_binary_body(self):
+        import uamqp
+        from azext_iot.operations.events3._filters import compile_event_handler
+
+        msg = uamqp.Message(
+            b"\xff\xfeok",
+            annotations={b"iothub-connection-device-id": device_id.encode("utf8")},
+        )
+        result = compile_event_handler(output="ndjson")(msg)
+        assert json.loads(result)["event"]["payload"] == "\ufffd\ufffdok"
+
+
+class TestEventAggregator:
+    def test_device_rollup(self):
+        from azext_iot.operations.events3._aggregates import EventAggregator
+        from azext_iot.operations.events3._filters import compile_event_handler
+
+        aggregator = EventAggregator(60)
+        handler = compile_event_handler(device_id="my*", aggregator=aggregator)
+        for body in ['{"temperature": 20, "ok": true}', '{"temperature": 30}', "not json"]:
+            assert handler(build_message(body=body)) is None
+        handler(build_message(origin="otherdevice"))
+
+        document = aggregator.collect()["aggregate"]
+        assert document["window"] == 60
+        assert document["devices"] == {
+            device_id: {
+                "count": 3,
+                "bytes": 58,
+                "fields": {"temperature": {"count": 2, "min": 20, "max": 30, "mean": 25.0}},
+            }
+        }
+        assert aggregator.collect() is None
+
+    def test_selected_fields_per_interface(self):
+        from azext_iot.operations.events3._aggregates import EventAggregator
+        from azext_iot.operations.events3._views import EventView
+
+        aggregator = EventAggregator(
+            10, fields=["env.temp", "missing"], per_interface=True
+        )
+        for value in (1, 3):
+            msg = build_message(
+                body='{"env": {"temp": %d}, "humidity": 5}' % value, interface=interface_id
+            )
+            aggregator.add(EventView(msg))
+
+        device = aggregator.collect()["aggregate"]["devices"][device_id]
+        assert device["count"] == 2
+        assert device["interfaces"][interface_id]["fields"] == {
+            "env.temp": {"count": 2, "min": 1, "max": 3, "mean": 2.0}
+        }
+
+
+class TestMonitorMetrics:
+    def test_instrumented_handler(self):
+        from azext_iot.operations.events3._filters import compile_event_handler
+        from azext_iot.operations.events3._metrics import PartitionMetrics, STAGES
+
+        metrics = PartitionMetrics("0")
+        handler = compile_event_handler(device_id=device_id, output="json", metrics=metrics)
+        assert json.loads(handler(build_message()))["event"]["origin"] == device_id
+        assert handler(build_message(origin="otherdevice")) is None
+
+        snapshot = metrics.snapshot(2)
+        assert snapshot["messages"] == 2
+        assert snapshot["messages_per_sec"] == 1
+        assert snapshot["bytes"] == 38
+        assert set(snapshot["stage_sec"]) == set(STAGES)
+        assert metrics.snapshot(1)["messages"] == 0
+        assert metrics.total_messages == 2
+
+    def test_lag_percentiles(self):
+        from azext_iot.operations.events3._metrics import PartitionMetrics
+        from azext_iot.operations.events3._views import EventView
+
+        metrics = PartitionMetrics("1")
+        for lag_ms in range(1, 101):
+            msg = build_message()
+            msg.annotations[b"x-opt-enqueuedtimeutc"] = 100000 - lag_ms * 1000
+            metrics.record(EventView(msg), received_ms=100000)
+
+        snapshot = metrics.snapshot(1)
+        # Same nearest rank percentiles as the simulation reports
+        assert snapshot["lag_p50"] == 50
+        assert snapshot["lag_p99"] == 99
+
+        # Sub-millisecond lag is not quantized
+        metrics.record(EventView(msg), received_ms=100000 - lag_ms * 1000 + 0.25)
+        assert metrics.snapshot(1)["lag_p50"] == 0.00025
+
+    def test_prometheus_file(self, tmpdir):
+        from azext_iot.operations.events3._metrics import MonitorMetrics
+        from azext_iot.operations.events3._views import EventView
+
+        path = tmpdir.join("monitor.prom")
+        monitor_metrics = MonitorMetrics(10, str(path))
+        monitor_metrics.partition("0").record(EventView(build_message()))
+        monitor_metrics.report()
+
+        text = path.read()
+        assert 'azext_iot_monitor_messages_total{partition="0"} 1' in text
+        assert 'azext_iot_monitor_stage_seconds_total{partition="0",stage="decode"} 0.0' in text
+        assert "enqueue_lag_seconds{" not in text
+
+    @pytest.mark.parametrize(
+        "path, expected",
+        [
+            ("metrics/monitor.prom", "metrics/monitor.2.prom"),
+            ("events.cap.gz", "events.2.cap.gz"),
+        ],
+    )
+    def test_worker_file_path(self, path, expected):
+        from azext_iot.operations.events3._workers import worker_file_path
+
+        assert worker_file_path(path, 2) == expected
+
+
+class TestPartitionFanout:
+    @pytest.fixture()
+    def fanout(self, mocker):
+        from six.moves import queue
+        from azext_iot.operations.events3 import _workers
+
+        class StandInProcess(object):
+            def __init__(self, target, args):
+                self.target = target
+                self.args = args
+                self.alive = False
+                self.terminated = False
+                self.killed = False
+                self.hangs = False
+                processes.append(self)
+
+            def start(self):
+                self.alive = True
+                self.target(*self.args)
+                self.alive = self.hangs
+
+            def is_alive(self):
+                return self.alive
+
+            def terminate(self):
+                self.terminated = True
+
+            def join(self, timeout=None):
+                pass
+
+            def kill(self):
+                self.killed = True
+                self.alive = False
+
+        class StandInContext(object):
+            def Queue(self, maxsize=0):
+                return queue.Queue()
+
+            def Process(self, target, args):
+                return StandInProcess(target, args)
+
+        processes = []
+        mocker.patch.object(_workers.multiprocessing, "get_context", return_value=StandInContext())
+        return _workers, processes
+
+    def build_target(self, partitions=5):
+        return {
+            "endpoint": "hub.servicebus.windows.net",
+            "path": "hub",
+            "auth_spec": {},
+            "partitions": [str(p) for p in range(partitions)],
+        }
+
+    def test_partition_assignment(self, fanout, mocker):
+        _workers, processes = fanout
+        worker = mocker.patch.object(_workers, "_monitor_worker")
+        worker.side_effect = lambda spec, partitions, kwargs, channel: channel.put((_workers._DONE, None))
+
+        _workers.partition_fanout(
+            self.build_target(), 2, printer=lambda dump: None, consumer_group="$Default", metrics_file="m.prom"
+        )
+
+        assert [call[0][1] for call in worker.call_args_list] == [["0", "2", "4"], ["1", "3"]]
+        assert [call[0][2]["metrics_file"] for call in worker.call_args_list] == ["m.0.prom", "m.1.prom"]
+        assert all(call[0][2]["consumer_group"] == "$Default" for call in worker.call_args_list)
+        # Never more workers than partitions
+        _workers.partition_fanout(self.build_target(2), 8, printer=lambda dump: None)
+        assert len(processes) == 4
+
+    def test_merged_output(self, fanout, mocker):
+        _workers, _ = fanout
+
+        def worker(spec, partitions, kwargs, channel):
+            for p in partitions:
+                channel.put((_workers._EVENT, "event {}".format(p)))
+            channel.put((_workers._DONE, None))
+
+        mocker.patch.object(_workers, "_monitor_worker", worker)
+        written = []
+        _workers.partition_fanout(self.build_target(), 3, printer=written.append)
+
+        assert sorted(written) == ["event {}".format(p) for p in range(5)]
+
+    def test_worker_error(self, fanout, mocker):
+        _workers, processes = fanout
+
+        async def initiate_event_monitor(target, printer=None, raise_errors=False, **kwargs):
+            assert raise_errors
+            printer("event {}".format(target["partitions"][0]))
+            if "1" in target["partitions"]:
+                raise RuntimeError("partition 1 detached")
+
+        mocker.patch.object(_workers, "initiate_event_monitor", initiate_event_monitor)
+        mocker.patch.object(_workers, "build_auth_container")
+        # Workers run in this process here, keep its signal handlers
+        mocker.patch.object(_workers.signal, "signal")
+        written = []
+        with pytest.raises(RuntimeError) as e:
+            _workers.partition_fanout(self.build_target(4), 2, printer=written.append)
+
+        assert str(e.value) == "partition 1 detached"
+        assert sorted(written) == ["event 0", "event 1"]
+
+    def test_terminate(self, fanout, mocker):
+        _workers, processes = fanout
+
+        def worker(spec, partitions, kwargs, channel):
+            if partitions[0] == "0":
+                processes[-1].hangs = True
+                channel.put((_workers._EVENT, "event 0"))
+                return
+            channel.put((_workers._DONE, None))
+
+        def interrupt(dump):
+            raise KeyboardInterrupt()
+
+        mocker.patch.object(_workers, "_monitor_worker", worker)
+        _workers.partition_fanout(self.build_target(2), 2, printer=interrupt)
+
+        # A worker still running once the monitor stops is terminated, then killed
+        assert processes[0].terminated and processes[0].killed
+        assert not processes[1].terminated
+
+    def test_initiate_event_monitor_errors(self, mocker):
+        import asyncio
+        from azext_iot.operations.events3 import _events
+
+        class StandInConnection(object):
+            def __init__(self, *args, **kwargs):
+                pass
+
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *args):
+                pass
+
+        async def monitor_events(partition, **kwargs):
+            if partition == "1":
+                raise RuntimeError("partition 1 detached")
+
+        mocker.patch.object(_events.uamqp, "ConnectionAsync", StandInConnection)
+        mocker.patch.object(_events, "monitor_events", monitor_events)
+        mocker.patch.object(_events, "DevicePartitionMap")
+        target = {"endpoint": "hub.servicebus.windows.net", "path": "hub", "auth": None, "partitions": ["0", "1"]}
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(_events.initiate_event_monitor(target, "$Default", 0, printer=print))
+            with pytest.raises(RuntimeError):
+                loop.run_until_complete(
+                    _events.initiate_event_monitor(target, "$Default", 0, printer=print, raise_errors=True)
+                )
+        finally:
+            loop.close()
+
+
+class TestOutputQueue:
+    def run(self, coroutine):
+        import asyncio
+
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    @pytest.mark.parametrize(
+        "policy, expected_dumps, expected_dropped",
+        [
+            ("block", [str(i) for i in range(20)], 0),
+            ("drop-oldest", [str(i) for i in range(16, 20)], 16),
+            ("sample", ["0", "1", "11"], 17),
+        ],
+    )
+    def test_policies(self, policy, expected_dumps, expected_dropped):
+        from azext_iot.operations.events3._queues import OutputQueue
+
+        written = []
+
+        async def produce():
+            output_queue = OutputQueue(maxsize=4, policy=policy, sample_rate=10)
+            if policy == "block":
+                output_queue.start(written.append)
+            for i in range(20):
+                await output_queue.put(str(i))
+            if policy != "block":
+                output_queue.start(written.append)
+            await output_queue.close()
+            return output_queue
+
+        output_queue = self.run(produce())
+
+        assert "\n".join(written).split("\n") == expected_dumps
+        assert output_queue.dropped == expected_dropped
+        assert output_queue.written == len(expected_dumps)
+        assert output_queue.depth == 0
+        assert output_queue.high_watermark <= 4
+
+    def test_writer_failure(self):
+        import asyncio
+        from azext_iot.operations.events3._queues import OutputQueue
+
+        def printer(dump):
+            raise BrokenPipeError()
+
+        async def produce():
+            output_queue = OutputQueue(maxsize=2, policy="block")
+            output_queue.start(printer)
+            for i in range(10):
+                await output_queue.put(str(i))
+
+        # Producers blocked on a full queue see the writer error instead of waiting forever
+        with pytest.raises(BrokenPipeError):
+            self.run(asyncio.wait_for(produce(), 5))
+
+    def test_unknown_policy(self):
+        from azext_iot.operations.events3._queues import OutputQueue
+
+        with pytest.raises(ValueError):
+            OutputQueue(policy="unknown")
+
+
+class TestDevicePartitionMap:
+    endpoint = "myhub.servicebus.windows.net"
+
+    def build_map(self, path, max_devices=100):
+        from azext_iot.operations.events3._partitions import DevicePartitionMap
+
+        return DevicePartitionMap(
+            self.endpoint, "myhub", cache_dir=str(path), max_devices=max_devices
+        )
+
+    def test_learn_and_select(self, tmpdir):
+        from azext_iot.operations.events3._filters import compile_event_handler
+        from azext_iot.operations.events3._partitions import select_device_partitions
+
+        partition_map = self.build_map(tmpdir)
+        handler = compile_event_handler(
+            device_id="otherdevice", observe=partition_map.observer(3)
+        )
+        assert handler(build_message()) is None
+        partition_map.save()
+
+        target = {"endpoint": self.endpoint, "path": "myhub", "partitions": ["0", "1", "2", "3"]}
+        learned = self.build_map(tmpdir)
+        assert learned.lookup(device_id) == "3"
+        assert select_device_partitions(target, device_id, learned) == ["3"]
+        assert select_device_partitions(target, "unknown", learned) == target["partitions"]
+        assert select_device_partitions(target, "my*", learned) == target["partitions"]
+
+    def test_merge_and_bound(self, tmpdir):
+        first = self.build_map(tmpdir, max_devices=2)
+        second = self.build_map(tmpdir, max_devices=2)
+
+        first.observer(0)("device1")
+        first.save()
+        second.observer(1)("device2")
+        second.observer(1)("device3")
+        second.save()
+
+        merged = self.build_map(tmpdir)
+        assert merged.lookup("device1") is None
+        assert merged.lookup("device2") == "1"
+        assert merged.lookup("device3") == "1"
+
+    def test_observed_bound(self, tmpdir):
+        partition_map = self.build_map(tmpdir, max_devices=3)
+        observe = partition_map.observer(0)
+        for device in ("device1", "device2", "device3", "device1", "device4", "device5"):
+            observe(device)
+
+        # Only the most recently seen devices are held between saves
+        assert list(partition_map._observed) == ["device1", "device4", "device5"]
+        partition_map.save()
+        observe("device6")
+        assert list(partition_map._observed) == ["device6"]
+
+
+class TestEndpointCache:
+    hub_host = "myhub.azure-devices.net"
+    events = {
+        "endpoint": "ihsuprodbyres001dednamespace.servicebus.windows.net",
+        "path": "iothub-ehub-myhub-1234-abcd",
+        "address": "amqps://ihsuprodbyres001dednamespace.servicebus.windows.net/iothub-ehub-myhub-1234-abcd/$management",
+        "partition_ids": ["0", "1"],
+    }
+
+    def test_ttl_and_invalidation(self, tmpdir):
+        from azext_iot.operations.events3._builders import (
+            cache_endpoint,
+            invalidate_cached_endpoint,
+            load_cached_endpoint,
+        )
+
+        cache_dir = str(tmpdir)
+        assert load_cached_endpoint(self.hub_host, cache_dir=cache_dir) is None
+
+        cache_endpoint(self.hub_host, self.events, cache_dir=cache_dir)
+        assert load_cached_endpoint(self.hub_host, cache_dir=cache_dir) == self.events
+        assert load_cached_endpoint(self.hub_host, ttl=-1, cache_dir=cache_dir) is None
+
+        invalidate_cached_endpoint(self.hub_host, cache_dir=cache_dir)
+        assert load_cached_endpoint(self.hub_host, cache_dir=cache_dir) is None
+
+    def test_target_from_cache(self, tmpdir, mocker):
+        from azext_iot.operations.events3 import _builders
+
+        mocker.patch.dict("os.environ", {"AZURE_CONFIG_DIR": str(tmpdir)})
+        _builders.cache_endpoint(self.hub_host, self.events)
+        redirect = mocker.patch.object(_builders.EventTargetBuilder, "_evaluate_redirect")
+
+        target = {"entity": self.hub_host, "policy": "iothubowner", "primarykey": "c2VjcmV0"}
+        event_hub_target = _builders.EventTargetBuilder().build_iot_hub_target(target)
+
+        assert not redirect.called
+        assert event_hub_target["endpoint"] == self.events["endpoint"]
+        assert event_hub_target["path"] == self.events["path"]
+        assert event_hub_target["partitions"] == ["0", "1"]
+        assert event_hub_target["cache_key"] == self.hub_host
+
+    @pytest.mark.parametrize(
+        "error, evicted",
+        [
+            (RuntimeError("partition 1 detached"), True),
+            (ValueError("bad"), False),
+            (BrokenPipeError(), False),
+        ],
+    )
+    def test_executor_evicts_on_partition_failure(self, tmpdir, mocker, error, evicted):
+        from azext_iot.operations.events3 import _builders, _events
+
+        class StandInConnection(object):
+            def __init__(self, *args, **kwargs):
+                pass
+
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *args):
+                pass
+
+        async def monitor_events(partition, **kwargs):
+            if partition == "1":
+                raise error
+
+        mocker.patch.dict("os.environ", {"AZURE_CONFIG_DIR": str(tmpdir)})
+        mocker.patch.object(_events.uamqp, "ConnectionAsync", StandInConnection)
+        mocker.patch.object(_events, "monitor_events", monitor_events)
+        mocker.patch.object(_events, "DevicePartitionMap")
+        _builders.cache_endpoint(self.hub_host, self.events)
+        target = {
+            "endpoint": self.events["endpoint"],
+            "path": self.events["path"],
+            "auth": None,
+            "partitions": ["0", "1"],
+            "cache_key": self.hub_host,
+        }
+
+        # The default single process monitor surfaces the partition failure
+        with pytest.raises(RuntimeError):
+            _events.executor(target, "$Default", 0)
+
+        # Only failures that may come from a stale endpoint evict it
+        assert (_builders.load_cached_endpoint(self.hub_host) is None) == evicted
+
+
+class TestEventCapture:
+    @pytest.mark.parametrize("filename", ["events.cap", "events.cap.gz"])
+    def test_round_trip(self, tmpdir, filename):
+        from azext_iot.operations.events3._capture import CaptureWriter, read_capture
+        from azext_iot.operations.events3._views import EventView
+
+        path = str(tmpdir.join(filename))
+        msg = build_message(interface=interface_id, app_props={b"k": b"v", "n": 5})
+        msg.annotations[b"x-opt-sequence-number"] = 7
+
+        writer = CaptureWriter(path)
+        writer.write("3", msg, received_ms=1000)
+        writer.write(0, build_message(body=""), received_ms=1500)
+        writer.close()
+
+        records = list(read_capture(path))
+        assert [(p, t) for p, t, _ in records] == [("3", 1000), ("0", 1500)]
+
+        original, replayed = EventView(msg), EventView(records[0][2])
+        assert replayed.origin == original.origin
+        assert replayed.interface == original.interface
+        assert replayed.text() == original.text()
+        assert replayed.annotations() == original.annotations()
+        assert replayed.system_properties() == original.system_properties()
+        assert replayed.application_properties() == {"k": "v", "n": 5}
+        assert EventView(records[1][2]).text() == ""
+
+    def test_truncated_and_invalid(self, tmpdir):
+        from azext_iot.operations.events3._capture import CaptureWriter, read_capture
+
+        path = tmpdir.join("events.cap")
+        writer = CaptureWriter(str(path))
+        writer.write("0", build_message())
+        writer.write("0", build_message())
+        writer.close()
+        content = path.read_binary()
+        path.write_binary(content[:-5])
+        assert len(list(read_capture(str(path)))) == 1
+
+        path.write_binary(b"not a capture")
+        with pytest.raises(ValueError):
+            list(read_capture(str(path)))
+
+    def test_replay_pipeline(self, tmpdir):
+        import asyncio
+        from azext_iot.operations.events3._capture import CaptureWriter
+        from azext_iot.operations.events3._events import replay_events
+
+        path = str(tmpdir.join("events.cap"))
+        writer = CaptureWriter(path)
+        for i in range(300):
+            writer.write(str(i % 2), build_message(origin="device{}".format(i % 3)))
+        writer.close()
+
+        written = []
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(
+                replay_events(
+                    path, printer=written.append, device_id="device1", output="ndjson"
+                )
+            )
+        finally:
+            loop.close()
+
+        events = [json.loads(line)["event"] for chunk in written for line in chunk.split("\n")]
+        assert len(events) == 100
+        assert all(e["origin"] == "device1" for e in events)
+
+    def test_replay_metrics_lag(self, tmpdir, mocker):
+        import asyncio
+        from azext_iot.operations.events3._capture import CaptureWriter
+        from azext_iot.operations.events3._events import replay_events
+        from azext_iot.operations.events3._metrics import PartitionMetrics
+
+        path = str(tmpdir.join("events.cap"))
+        writer = CaptureWriter(path)
+        for i in range(3):
+            msg = build_message()
+            msg.annotations[b"x-opt-enqueuedtimeutc"] = 1000000 + i
+            writer.write("0", msg, received_ms=1002000 + i)
+        writer.close()
+
+        record = mocker.spy(PartitionMetrics, "record")
+        snapshot = mocker.spy(PartitionMetrics, "snapshot")
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(replay_events(path, printer=lambda dump: None, metrics=60))
+        finally:
+            loop.close()
+
+        # Lag of recorded events is the recorded 2s, not the age of the capture
+        assert [call[0][2] for call in record.call_args_list] == [1002000, 1002001, 1002002]
+        assert snapshot.spy_return["lag_p99"] == 2.0
+
+
+def build_feedback(*records):
+    import uamqp
+
+    return uamqp.Message(json.dumps(list(records)).encode("utf8"))
+
+
+def feedback_record(msg_id, device="device1", status="Success"):
+    return {
+        "originalMessageId": msg_id,
+        "deviceId": device,
+        "statusCode": status,
+        "description": status,
+    }
+
+
+class TestFeedbackCorrelator:
+    def test_batch_device_filter(self):
+        from azext_iot.operations.events3._feedback import FeedbackCorrelator
+
+        records = []
+        correlator = FeedbackCorrelator({}, device_id="Device1", on_record=records.append)
+        correlator.expect("a")
+        correlator.expect("b")
+        correlator.handle(
+            build_feedback(
+                feedback_record("x", device="other"),
+                feedback_record("a"),
+                feedback_record("b", status="Rejected"),
+            )
+        )
+
+        assert [r["originalMessageId"] for r in records] == ["a", "b"]
+        assert correlator.outstanding == 0
+        assert correlator.results["a"]["outcome"] == "Success"
+        assert correlator.results["b"]["outcome"] == "Rejected"
+        assert correlator.results["b"]["latencyMs"] >= 0
+
+    def test_wait(self, mocker):
+        import asyncio
+        from azext_iot.operations.events3 import _feedback
+
+        class StandInReceiveClient(object):
+            def __init__(self, source, **kwargs):
+                self.batches = [
+                    [build_feedback(feedback_record("a"))],
+                    [build_feedback(feedback_record("b", status="Expired"))],
+                ]
+
+            async def open_async(self):
+                pass
+
+            async def close_async(self):
+                pass
+
+            async def receive_message_batch_async(self, max_batch_size=None, timeout=0):
+                if self.batches:
+                    return self.batches.pop(0)
+                await asyncio.sleep(timeout / 1000)
+                return []
+
+        mocker.patch.object(_feedback.uamqp, "ReceiveClientAsync", StandInReceiveClient)
+        target = {"entity": "hub.azure-devices.net", "policy": "iothubowner", "primarykey": "c2VjcmV0"}
+
+        async def correlate(ids, timeout):
+            correlator = _feedback.FeedbackCorrelator(target)
+            for msg_id in ids:
+                correlator.expect(msg_id, sent_at=None)
+            await correlator.open()
+            try:
+                return await correlator.wait(timeout)
+            finally:
+                await correlator.close()
+
+        loop = asyncio.new_event_loop()
+        try:
+            results = loop.run_until_complete(correlate(["a", "b"], 5))
+            assert {r["messageId"]: r["outcome"] for r in results} == {"a": "Success", "b": "Expired"}
+
+            results = loop.run_until_complete(correlate(["a", "c"], 0.05))
+            assert {r["messageId"]: r["outcome"] for r in results} == {"a": "Success", "c": "Timeout"}
+        finally:
+            loop.close()
+
+    def test_send_wait_feedback(self, mocker):
+        import threading
+        from azext_iot.operations.events3 import _events
+
+        class StandInCorrelator(object):
+            instances = []
+
+            def __init__(self, target, device_id=None):
+                self.expected = []
+                self.instances.append(self)
+
+            async def open(self):
+                self.loop_thread = threading.get_ident()
+
+            async def close(self):
+                pass
+
+            def expect(self, msg_id):
+                self.expected.append(msg_id)
+
+            async def wait(self, timeout):
+                return [{"messageId": msg_id, "outcome": "Success"} for msg_id in self.expected]
+
+        send_threads = []
+
+        def send_c2d_message(target, device_id, data, **kwargs):
+            send_threads.append(threading.get_ident())
+            return kwargs["message_id"], []
+
+        mocker.patch.object(_events, "FeedbackCorrelator", StandInCorrelator)
+        mocker.patch.object(_events, "send_c2d_message", send_c2d_message)
+        msg_id, errors, result = _events.send_c2d_message_wait_feedback({}, "Device1", "data", ack="full")
+
+        # The blocking send does not run on the loop receiving feedback
+        assert send_threads and send_threads[0] != StandInCorrelator.instances[0].loop_thread
+        assert errors == []
+        assert result == {"messageId": msg_id, "outcome": "Success"}
+
+
+class TestC2DBatchSender:
+    def test_send(self, mocker):
+        import asyncio
+        import uamqp
+        from azext_iot.operations.events3 import _c2d
+        from azext_iot.operations.events3._feedback import FeedbackCorrelator
+
+        clients = []
+
+        class StandInSendClient(object):
+            def __init__(self, target, **kwargs):
+                self.pending = []
+                self.windows = []
+                clients.append(self)
+
+            async def open_async(self):
+                pass
+
+            async def close_async(self):
+                pass
+
+            def queue_message(self, message):
+                self.pending.append(message)
+
+            async def send_all_messages_async(self, close_on_done=True):
+                self.windows.append(len(self.pending))
+                for message in self.pending:
+                    failed = message.properties.to.startswith(b"/devices/bad/")
+                    message.state = (
+                        uamqp.constants.MessageState.SendFailed
+                        if failed
+                        else uamqp.constants.MessageState.SendComplete
+                    )
+                self.pending = []
+
+        mocker.patch.object(_c2d.uamqp, "SendClientAsync", StandInSendClient)
+        target = {"entity": "hub.azure-devices.net", "policy": "iothubowner", "primarykey": "c2VjcmV0"}
+        records = [
+            {"deviceId": "bad" if i == 3 else "d{}".format(i), "data": "x", "ack": "full" if i < 2 else None}
+            for i in range(10)
+        ]
+        correlator = FeedbackCorrelator(target)
+        sender = _c2d.C2DBatchSender(target, clients=2, window=3, correlator=correlator)
+
+        loop = asyncio.new_event_loop()
+        try:
+            results = loop.run_until_complete(sender.send(records))
+        finally:
+            loop.close()
+
+        assert len(clients) == 2
+        assert sum(sum(c.windows) for c in clients) == 10
+        assert max(w for c in clients for w in c.windows) == 3
+        assert [r["deviceId"] for r in results] == [r["deviceId"] for r in records]
+        assert correlator.outstanding == 2
+
+        feedback = [{"messageId": results[0]["messageId"], "outcome": "Success", "latencyMs": 5.0}]
+        report = _c2d.summarize_c2d_batch(results, 0.5, feedback)
+        assert report["sent"] == 9
+        assert report["failed"] == 1
+        assert report["messagesPerSec"] == 20.0
+        assert report["feedback"] == {"Success": 1}
+        assert report["results"][0]["feedback"] == "Success"
+
+    def test_open_failure(self, mocker):
+        import asyncio
+        import uamqp
+        from azext_iot.operations.events3 import _c2d
+
+        clients = []
+
+        class StandInSendClient(object):
+            def __init__(self, target, **kwargs):
+                self.closed = False
+                self.fails = len(clients) == 1
+                clients.append(self)
+
+            async def open_async(self):
+                if self.fails:
+                    raise uamqp.errors.AuthenticationException("token rejected")
+
+            async def close_async(self):
+                self.closed = True
+
+            def queue_message(self, message):
+                pass
+
+            async def send_all_messages_async(self, close_on_done=True):
+                await asyncio.sleep(60)
+
+        mocker.patch.object(_c2d.uamqp, "SendClientAsync", StandInSendClient)
+        target = {"entity": "hub.azure-devices.net", "policy": "iothubowner", "primarykey": "c2VjcmV0"}
+        records = [{"deviceId": "d{}".format(i), "data": "x"} for i in range(4)]
+        sender = _c2d.C2DBatchSender(target, clients=2, window=1)
+
+        loop = asyncio.new_event_loop()
+        try:
+            with pytest.raises(CLIError, match="token rejected"):
+                loop.run_until_complete(asyncio.wait_for(sender.send(records), 5))
+        finally:
+            loop.close()
+
+        # The worker still sending is stopped and every client is closed
+        assert len(clients) == 2
+        assert all(client.closed for client in clients)
+
+
+class TestMultiHubMonitor:
+    def test_hub_tag(self):
+        from azext_iot.operations.events3._filters import compile_event_handler
+
+        event = json.loads(compile_event_handler(output="ndjson", hub="hub1")(build_message()))
+        assert event["event"]["hub"] == "hub1"
+        assert "hub" not in json.loads(compile_event_handler(output="ndjson")(build_message()))["event"]
+
+    def test_shared_pipeline(self, mocker):
+        import asyncio
+        from azext_iot.operations.events3 import _events
+        from azext_iot.operations.events3._filters import compile_event_handler
+
+        async def initiate_event_monitor(target, pipeline=None, recorder=None, hub=None, **kwargs):
+            if hub == "broken":
+                raise RuntimeError("link detached")
+            handler = compile_event_handler(output="ndjson", hub=hub)
+            await pipeline.output_queue.put(handler(build_message()))
+
+        mocker.patch.object(_events, "initiate_event_monitor", initiate_event_monitor)
+        invalidate = mocker.patch.object(_events, "invalidate_cached_endpoint")
+
+        targets = [
+            {"hub": "hub1", "cache_key": "hub1.azure-devices.net"},
+            {"hub": "broken", "cache_key": "broken.azure-devices.net"},
+            {"hub": "hub2", "cache_key": "hub2.azure-devices.net"},
+        ]
+        written = []
+        loop = asyncio.new_event_loop()
+        try:
+            errors = loop.run_until_complete(
+                _events.monitor_hubs(targets, printer=written.append, output="ndjson")
+            )
+        finally:
+            loop.close()
+
+        events = [json.loads(line)["event"] for chunk in written for line in chunk.split("\n")]
+        assert sorted(e["hub"] for e in events) == ["hub1", "hub2"]
+        assert [hub for hub, _ in errors] == ["broken"]
+        invalidate.assert_called_once_with("broken.azure-devices.net")
+
+
+class TestCheckpointStore:
+    def build_store(self, path, flush_count=2):
+        from azext_iot.operations.events3._checkpoints import CheckpointStore
+
+        return CheckpointStore(
+            str(path),
+            "myhub.servicebus.windows.net",
+            "myhub",
+            "$Default",
+            flush_count=flush_count,
+            flush_interval=3600,
+        )
+
+    def test_batched_flush_and_resume(self, tmpdir):
+        store = self.build_store(tmpdir)
+        store.update("0", "1024", 10)
+        assert store.load("0") is None
+
+        store.update("1", "2048", 20)
+        resumed = self.build_store(tmpdir)
+        assert resumed.load("0") == {"offset": "1024", "sequence_number": 10}
+        assert resumed.load("1") == {"offset": "2048", "sequence_number": 20}
+        assert resumed.load("2") is None
+
+    def test_update_from_message(self, tmpdir):
+        store = self.build_store(tmpdir, flush_count=1)
+        msg = build_message()
+        msg.annotations[b"x-opt-offset"] = b"4096"
+        msg.annotations[b"x-opt-sequence-number"] = 42
+        store.update_from_message("3", msg)
+
+        assert store.load("3") == {"offset": "4096", "sequence_number": 42}
+
+    @pytest.mark.parametrize(
+        "checkpoint, expected",
+        [
+            (None, b"amqp.annotation.x-opt-enqueuedtimeutc > 1000"),
+            ({"offset": "4096"}, b"amqp.annotation.x-opt-offset > '4096'"),
+        ],
+    )
+    def test_source_filter(self, checkpoint, expected):
+        from azext_iot.operations.events3._checkpoints import build_source_filter
+
+        assert build_source_filter(1000, checkpoint) == expected
+
+    def test_flush_temp_files(self, tmpdir, mocker):
+        from azext_iot.operations.events3 import _cache
+
+        mkstemp = mocker.spy(_cache.tempfile, "mkstemp")
+        store = self.build_store(tmpdir, flush_count=1)
+        store.update("0", "100", 1)
+        store.update("0", "200", 2)
+
+        # Every write goes through its own temp file next to the checkpoint
+        temp_paths = [result[1] for result in mkstemp.spy_return_list]
+        assert len(set(temp_paths)) == 2
+        assert all(os.path.dirname(p) == store.root for p in temp_paths)
+
+        replace = mocker.patch.object(_cache.os, "replace", side_effect=OSError("busy"))
+        store.update("0", "300", 3)
+        assert replace.call_count == 1
+        mocker.stopall()
+        assert store.load("0")["offset"] == "200"
+        assert sorted(os.listdir(store.root)) == ["0.json"]
+
+
+class TestOutputSink:
+    def test_renderers(self):
+        from azext_iot.operations.events3._sinks import get_renderer
+
+        document = {"event": {"origin": device_id, "payload": {"temperature": 20}}}
+        assert get_renderer("ndjson")(document) == '{"event":{"origin":"mydevice","payload":{"temperature":20}}}'
+        assert json.loads(get_renderer("json")(document)) == document
+        assert get_renderer("yaml")(document).startswith("event:")
+
+    def test_buffered_flush(self, tmpdir):
+        from azext_iot.operations.events3._sinks import OutputSink
+
+        path = tmpdir.join("events.ndjson")
+        sink = OutputSink(str(path), flush_bytes=10, flush_interval=0)
+        sink.write("{}")
+        assert path.read() == ""
+
+        sink.write('{"a":1}')
+        assert path.read() == '{}\n{"a":1}\n'
+
+        sink.write("{}")
+        sink.close()
+        assert path.read() == '{}\n{"a":1}\n{}\n'
+
+    @pytest.mark.parametrize("compress", [False, True])
+    def test_rotation(self, tmpdir, compress):
+        import gzip
+        from azext_iot.operations.events3._sinks import OutputSink
+
+        path = tmpdir.join("events.ndjson")
+        sink = OutputSink(
+            str(path), rotate_bytes=8, compress=compress, flush_bytes=1, flush_interval=0
+        )
+        for i in range(3):
+            sink.write('{"i":%d}' % i)
+        sink.close()
+
+        def read(name):
+            if compress:
+                with gzip.open(str(tmpdir.join(name + ".gz")), "rt") as f:
+                    return f.read()
+            return tmpdir.join(name).read()
+
+        rotated = ["events.ndjson.{}".format(n) for n in (3, 2, 1)]
+        assert [read(name) for name in rotated] == ['{"i":%d}\n' % i for i in range(3)]
+        assert read("events.ndjson") == ""
+
+    def test_rotation_counts_bytes(self, tmpdir):
+        from azext_iot.operations.events3._sinks import OutputSink
+
+        path = tmpdir.join("events.ndjson")
+        path.write_binary(b"1234")
+        sink = OutputSink(str(path), rotate_bytes=16, flush_bytes=1, flush_interval=0)
+        # 5 characters with the newline but 11 utf8 bytes, on top of the 4 bytes already in the file
+        sink.write("\u00e9\u00e9\u20ac\u20ac")
+        assert not tmpdir.join("events.ndjson.1").exists()
+        sink.write("x")
+        sink.close()
+
+        assert tmpdir.join("events.ndjson.1").read_binary().decode("utf8") == "1234\u00e9\u00e9\u20ac\u20ac\nx\n"
+        assert path.read() == ""
@@ -12,6 +12,7 @@ from uuid import uuid4
 from random import randint
 from azext_iot.operations import hub as subject
 from azext_iot.common.utility import evaluate_literal, validate_min_python_version
+from azext_iot.common import sas_token_auth
 from azext_iot.common.sas_token_auth import SasTokenAuthentication
 from azext_iot.constants import TRACING_PROPERTY
 from knack.util import CLIError
@@ -2437,6 +2438,221 @@ class TestDeviceMessaging:
             )
 
 
+class TestDeviceSendMessage:
+    @pytest.fixture()
+    def d2c_device(self, mocker):
+        class FakeDevice(object):
+            instances = []
+
+            def __init__(self, target, device_id, loop, on_ack=None, properties=None, **kwargs):
+                self.loop = loop
+                self.on_ack = on_ack
+                self.properties = properties
+                self.connected = loop.create_future()
+                self.disconnected = False
+                self.pending = 0
+                self.max_pending = 0
+                self.published = []
+                self.expiry = [3600]
+                self.reconnected = 0
+                self.closed = 0
+                FakeDevice.instances.append(self)
+
+            def expires_in(self):
+                return self.expiry[min(self.reconnected, len(self.expiry) - 1)]
+
+            def connect(self):
+                pass
+
+            def prepare_reconnect(self):
+                self.connected = self.loop.create_future()
+
+            def reconnect(self):
+                self.reconnected += 1
+
+            def attach(self):
+                self.disconnected = False
+                self.connected.set_result(0)
+                # Unacknowledged messages are resent on the new connection
+                for _ in range(self.pending):
+                    self.loop.call_soon(self._ack)
+
+            def publish(self, payload):
+                self.published.append(payload)
+                self.pending += 1
+                self.max_pending = max(self.max_pending, self.pending)
+                self.loop.call_soon(self._ack)
+                return True
+
+            def _ack(self):
+                self.pending -= 1
+                self.on_ack(0.002)
+
+            def misc(self):
+                pass
+
+            def close(self):
+                self.closed += 1
+
+        mocker.patch("azext_iot.operations._d2c.AsyncMqttDevice", FakeDevice)
+        mocker.patch("azext_iot.operations._d2c.ReconnectBackoff.next_delay", return_value=0)
+        return FakeDevice
+
+    @pytest.mark.parametrize("mc, mif", [(1, None), (500, 8), (40, 1)])
+    def test_device_send_message(self, fixture_cmd, fixture_ghcs, fixture_sas, d2c_device, mc, mif):
+        result = subject.iot_device_send_message(
+            fixture_cmd, device_id, mock_target["entity"], data="ping", properties="a=b;$.mid=1",
+            msg_count=mc, max_inflight=mif
+        )
+
+        device = d2c_device.instances[0]
+        assert device.published == ["ping"] * mc
+        assert device.properties == {"a": "b", "$.mid": "1"}
+        assert device.max_pending <= (mif or 64)
+        assert result["messagesSent"] == mc
+        assert result["messagesAcked"] == mc
+        assert result["unacked"] == 0
+        assert result["pubackLatencyMs"]["p99"] == 2.0
+
+    def test_device_send_message_template(self, fixture_cmd, fixture_ghcs, fixture_sas, d2c_device):
+        result = subject.iot_device_send_message(
+            fixture_cmd, device_id, mock_target["entity"], msg_count=3, template='{"seq": {{counter}}}'
+        )
+        assert d2c_device.instances[0].published == [b'{"seq": 1}', b'{"seq": 2}', b'{"seq": 3}']
+        assert result["messagesAcked"] == 3
+
+    def test_device_send_message_reconnect(self, fixture_cmd, fixture_ghcs, fixture_sas, d2c_device):
+        publish = d2c_device.publish
+
+        def drop_third(self, payload):
+            if len(self.published) != 2:
+                return publish(self, payload)
+            self.published.append(payload)
+            self.pending += 1
+            self.disconnected = True
+            return True
+
+        d2c_device.publish = drop_third
+        result = subject.iot_device_send_message(
+            fixture_cmd, device_id, mock_target["entity"], msg_count=6, max_inflight=1,
+            template="{{counter}}"
+        )
+        device = d2c_device.instances[0]
+        # The lost message is resent and the sequence carries on
+        assert device.published == [b"1", b"2", b"3", b"4", b"5", b"6"]
+        assert device.reconnected == 1
+        assert result["reconnects"] == 1
+        assert result["messagesAcked"] == 6
+        assert result["unacked"] == 0
+
+    def test_device_send_message_lost(self, fixture_cmd, fixture_ghcs, fixture_sas, d2c_device, mocker):
+        mocker.patch("azext_iot.operations._d2c.D2C_RECONNECT_MAX_ATTEMPTS", 2)
+
+        def drop(self, payload):
+            self.published.append(payload)
+            self.pending += 1
+            self.disconnected = True
+            return True
+
+        def refuse(self):
+            raise Exception("refused")
+
+        d2c_device.publish = drop
+        d2c_device.reconnect = refuse
+        with pytest.raises(CLIError) as e:
+            subject.iot_device_send_message(
+                fixture_cmd, device_id, mock_target["entity"], msg_count=10, max_inflight=1
+            )
+        assert "0 of 10 messages were acknowledged (1 sent, 1 unacknowledged" in str(e.value)
+
+    def test_device_send_message_token_renewal(self, fixture_cmd, fixture_ghcs, fixture_sas, d2c_device, mocker):
+        next_delay = mocker.patch("azext_iot.operations._d2c.ReconnectBackoff.next_delay", return_value=0)
+        original_init = d2c_device.__init__
+
+        def init(self, *args, **kwargs):
+            original_init(self, *args, **kwargs)
+            self.expiry = [120, 3600]
+
+        d2c_device.__init__ = init
+        result = subject.iot_device_send_message(fixture_cmd, device_id, mock_target["entity"], msg_count=3)
+
+        device = d2c_device.instances[0]
+        assert device.closed >= 1
+        assert device.reconnected == 1
+        assert result["reconnects"] == 1
+        assert result["messagesAcked"] == 3
+        # Planned reconnects skip the backoff
+        assert next_delay.call_count == 0
+
+    @pytest.mark.parametrize(
+        "mc, mif, protocol, bs",
+        [(0, None, "mqtt", None), (1, 0, "mqtt", None), (1, None, "mqtt", 10), (1, None, "http", 0), (1, 8, "http", None)],
+    )
+    def test_device_send_message_invalid_args(self, fixture_cmd, fixture_ghcs, mc, mif, protocol, bs):
+        with pytest.raises(CLIError):
+            subject.iot_device_send_message(
+                fixture_cmd, device_id, mock_target["entity"], msg_count=mc, max_inflight=mif,
+                protocol_type=protocol, batch_size=bs
+            )
+
+    @pytest.mark.parametrize("mc, bs, expected", [(5, 2, [2, 2, 1]), (300, None, [300]), (4, 1, [1, 1, 1, 1])])
+    def test_device_send_message_http_batches(self, fixture_cmd, fixture_ghcs, fixture_sas, mocker, mc, bs, expected):
+        from base64 import b64decode
+
+        service_client = mocker.patch(path_service_client)
+        service_client.return_value = build_mock_response(mocker, 204, "")
+
+        result = subject.iot_device_send_message(
+            fixture_cmd, device_id, mock_target["entity"], properties="a=b;$.mid=1", msg_count=mc,
+            template="{{counter}}", protocol_type="http", batch_size=bs
+        )
+
+        calls = service_client.call_args_list
+        assert all(call[0][1]["Content-Type"] == "application/vnd.microsoft.iothub.json" for call in calls)
+        batches = [json.loads(call[0][2]) for call in calls]
+        assert [len(batch) for batch in batches] == expected
+        entries = [entry for batch in batches for entry in batch]
+        assert [b64decode(entry["body"]) for entry in entries] == [str(i).encode() for i in range(1, mc + 1)]
+        assert all(entry["base64Encoded"] for entry in entries)
+        assert entries[0]["properties"] == {"iothub-app-a": "b", "iothub-messageid": "1"}
+        assert result["messagesSent"] == mc
+        assert result["batches"] == len(expected)
+        assert result["bytesSent"] == sum(len(call[0][2]) for call in calls)
+        assert set(result["batchLatencyMs"]) == {"p50", "p90", "p99", "max"}
+
+    def test_device_send_message_http_error(self, fixture_cmd, fixture_ghcs, fixture_sas, mocker):
+        service_client = mocker.patch(path_service_client)
+        service_client.return_value = build_mock_response(mocker, 400, {})
+        with pytest.raises(CLIError):
+            subject.iot_device_send_message(
+                fixture_cmd, device_id, mock_target["entity"], msg_count=3, protocol_type="http"
+            )
+
+    def test_http_d2c_batcher_size_limit(self):
+        from azext_iot.operations._d2c import HttpD2CBatcher
+
+        batcher = HttpD2CBatcher({"k": "v"}, max_bytes=400)
+        payloads = ["x" * n for n in (10, 100, 150, 20, 30, 160, 5)]
+        batches = list(batcher.batches(payloads))
+
+        assert len(batches) > 1
+        assert all(len(body) <= 400 for body, _ in batches)
+        assert sum(count for _, count in batches) == len(payloads)
+        bodies = [json.loads(body) for body, _ in batches]
+        assert [len(body) for body in bodies] == [count for _, count in batches]
+        # A batch only closes when the next message does not fit
+        for (body, _), (next_body, _) in zip(batches, batches[1:]):
+            first = json.dumps(json.loads(next_body)[0], separators=(",", ":"))
+            assert len(body) + len(first) + 1 > 400
+
+        with pytest.raises(ValueError):
+            batcher.add("x" * 400)
+
+    def test_device_send_message_connect_error(self, fixture_cmd, mqttclient_generic_error):
+        with pytest.raises(CLIError):
+            subject.iot_device_send_message(fixture_cmd, device_id, mock_target["entity"])
+
+
 class TestSasTokenAuth:
     def test_generate_sas_token(self):
         # Prepare parameters
@@ -2490,6 +2706,25 @@ class TestSasTokenAuth:
         )
         assert "skn=iothubowner" in token
 
+    def test_sas_token_cache_and_renew(self, mocker):
+        access_key = "+XLy+MVZ+aTeOnVzN2kLeB16O+kSxmz6g3rS6fAf6rw="
+        sas_auth = SasTokenAuthentication("iot-hub-for-test.azure-devices.net", None, access_key, 1471940363)
+        hmac = mocker.spy(sas_token_auth, "HMAC")
+
+        token = sas_auth.generate_sas_token()
+        assert sas_auth.generate_sas_token() is token
+        assert hmac.call_count == 1
+
+        assert sas_auth.renew(3600, 300)
+        assert not sas_auth.renew(3600, 300)
+        renewed = sas_auth.generate_sas_token()
+        assert renewed != token
+        assert hmac.call_count == 2
+
+        session = mocker.MagicMock(headers={})
+        assert sas_auth.signed_session(session) is session
+        assert session.headers["Authorization"] == renewed
+
 
 class TestDeviceSimulate:
     @pytest.fixture(params=[204])
@@ -2534,12 +2769,62 @@ class TestDeviceSimulate:
             assert mqttclient().tls_set.call_count == 1
             assert mqttclient().username_pw_set.call_count == 1
 
+    @pytest.mark.parametrize("protocol", ["http", "mqtt"])
+    def test_device_simulate_template(self, serviceclient, mqttclient, protocol):
+        subject.iot_simulate_device(
+            fixture_cmd,
+            device_id,
+            mock_target["entity"],
+            msg_count=2,
+            msg_rate=50,
+            protocol_type=protocol,
+            template='{"device": "{{deviceId}}", "seq": {{counter}}}',
+        )
+        if protocol == "mqtt":
+            payloads = [call[0][1] for call in mqttclient().publish.call_args_list]
+            assert payloads == [
+                '{{"device": "{}", "seq": {}}}'.format(device_id, i).encode() for i in (1, 2)
+            ]
+        else:
+            bodies = [call[0][2] for call in serviceclient.call_args_list if call[0][0].method == "POST"]
+            assert bodies == [{"device": device_id, "seq": 1}, {"device": device_id, "seq": 2}]
+
+    def test_device_simulate_template_invalid(self, serviceclient):
+        with pytest.raises(CLIError):
+            subject.iot_simulate_device(
+                fixture_cmd, device_id, mock_target["entity"], template="{{nope}}"
+            )
+
+    @pytest.mark.parametrize("protocol", ["http", "mqtt"])
+    def test_device_simulate_rate(self, serviceclient, mqttclient, protocol):
+        result = subject.iot_simulate_device(
+            fixture_cmd,
+            device_id,
+            mock_target["entity"],
+            msg_count=5,
+            msg_rate=20,
+            burst=2,
+            protocol_type=protocol,
+        )
+        assert result["messagesSent"] == 5
+        assert result["requestedRate"] == 20
+        assert result["burst"] == 2
+        assert result["achievedRate"] > 0
+
     @pytest.mark.parametrize(
-        "rs, mc, mi, protocol, exception",
-        [("reject", 4, 0, "mqtt", CLIError), ("complete", 0, 1, "mqtt", CLIError)],
+        "rs, mc, mi, protocol, exception, kwargs",
+        [
+            ("reject", 4, 0, "mqtt", CLIError, {}),
+            ("complete", 0, 1, "mqtt", CLIError, {}),
+            ("complete", 1, 0, "http", CLIError, {}),
+            ("complete", 1, 1, "mqtt", CLIError, {"msg_rate": 2}),
+            ("complete", 1, None, "mqtt", CLIError, {"msg_rate": 0}),
+            ("complete", 1, None, "mqtt", CLIError, {"burst": 0}),
+            ("complete", 1, None, "mqtt", CLIError, {"ramp_up": -1}),
+        ],
     )
     def test_device_simulate_invalid_args(
-        self, serviceclient, rs, mc, mi, protocol, exception
+        self, serviceclient, rs, mc, mi, protocol, exception, kwargs
     ):
         with pytest.raises(exception):
             subject.iot_simulate_device(
@@ -2550,8 +2835,142 @@ class TestDeviceSimulate:
                 msg_count=mc,
                 msg_interval=mi,
                 protocol_type=protocol,
+                **kwargs
             )
 
+    def test_device_simulate_http_session(self, mocker, fixture_ghcs, fixture_sas):
+        from msrest.service_client import ServiceClient
+
+        received = []
+        clients = set()
+
+        def send(client, request, *args, **kwargs):
+            assert client.config.keep_alive
+            clients.add(id(client))
+            if request.method == "GET":
+                received.append(request.url)
+                if len(received) <= 2:
+                    return build_mock_response(mocker, 200, TestDeviceMessaging.data, sample_c2d_receive, raw=True)
+            return build_mock_response(mocker, 204, "")
+
+        service_client = mocker.patch.object(ServiceClient, "send", autospec=True)
+        service_client.side_effect = send
+        bind_sdk = mocker.spy(subject, "_bind_sdk")
+
+        result = subject.iot_simulate_device(
+            fixture_cmd, device_id, mock_target["entity"], msg_count=4, msg_rate=8, protocol_type="http"
+        )
+
+        assert result["messagesSent"] == 4
+        # One kept alive client per direction for the whole simulation
+        assert bind_sdk.call_count == 2
+        assert len(clients) == 2
+        # Queued messages are drained back to back, then polling backs off
+        completes = [call for call in service_client.call_args_list if call[0][1].method == "DELETE"]
+        assert len(completes) == 2
+        assert 3 <= len(received) <= 4
+
+    def test_device_simulate_mqtt_token_renewal(self, mqttclient, mocker):
+        from azext_iot.operations._mqtt import mqtt_client_wrap, MQTT_TOKEN_RENEW_MARGIN_SEC
+        from time import time
+
+        wrap = mqtt_client_wrap(mock_target, device_id)
+        wrap.auth.expiry = time() + MQTT_TOKEN_RENEW_MARGIN_SEC - 1
+        passwords = mqttclient().username_pw_set.call_count
+
+        def loop(timeout):
+            wrap._stop.set()
+            return 0
+
+        mqttclient().loop.side_effect = loop
+        wrap._network_loop()
+
+        assert mqttclient().disconnect.call_count == 1
+        assert mqttclient().username_pw_set.call_count == passwords + 1
+        assert wrap.auth.expiry - time() > MQTT_TOKEN_RENEW_MARGIN_SEC
+
+    def test_device_simulate_mqtt_reconnect(self, mqttclient, mocker):
+        from azext_iot.operations._mqtt import mqtt_client_wrap, mqtt
+
+        wrap = mqtt_client_wrap(mock_target, device_id)
+        next_delay = mocker.patch.object(wrap.backoff, "next_delay", return_value=0)
+        results = [mqtt.MQTT_ERR_CONN_LOST, mqtt.MQTT_ERR_SUCCESS]
+
+        def loop(timeout):
+            if len(results) == 1:
+                wrap._stop.set()
+            return results.pop(0)
+
+        mqttclient().loop.side_effect = loop
+        wrap._network_loop()
+
+        assert next_delay.call_count == 1
+        assert mqttclient().reconnect.call_count == 1
+        assert mqttclient().disconnect.call_count == 0
+        assert wrap.reconnects == 1
+
+    @pytest.mark.parametrize("rc, error", [(4, "bad username or password"), (5, "not authorized")])
+    def test_device_simulate_mqtt_refused(self, mqttclient, mocker, rc, error):
+        from azext_iot.operations._mqtt import mqtt_client_wrap
+
+        mocker.patch.object(mqtt_client_wrap, "is_connected", lambda self: self.connected)
+
+        def loop(timeout):
+            mqttclient().on_connect(None, None, {}, rc)
+            return 0
+
+        mqttclient().loop.side_effect = loop
+        with pytest.raises(CLIError) as e:
+            subject.iot_simulate_device(fixture_cmd, device_id, mock_target["entity"], msg_count=2, msg_rate=10)
+        assert error in str(e.value)
+        assert mqttclient().reconnect.call_count == 0
+        assert mqttclient().publish.call_count == 0
+
+    def test_device_simulate_mqtt_reconnect_limit(self, mqttclient, mocker):
+        from azext_iot.operations._mqtt import mqtt_client_wrap, mqtt, MQTT_RECONNECT_MAX_ATTEMPTS
+
+        mocker.patch.object(mqtt_client_wrap, "is_connected", lambda self: self.connected)
+        mocker.patch("azext_iot.operations._mqtt.uniform", return_value=0)
+        mqttclient().loop.return_value = mqtt.MQTT_ERR_CONN_LOST
+        with pytest.raises(CLIError) as e:
+            subject.iot_simulate_device(fixture_cmd, device_id, mock_target["entity"], msg_count=2, msg_rate=10)
+        assert "failed {} times".format(MQTT_RECONNECT_MAX_ATTEMPTS) in str(e.value)
+        assert mqttclient().reconnect.call_count == MQTT_RECONNECT_MAX_ATTEMPTS
+
+    def test_reconnect_backoff(self, mocker):
+        from azext_iot.operations import _mqtt
+
+        uniform = mocker.patch.object(_mqtt, "uniform", side_effect=lambda low, high: high)
+        backoff = _mqtt.ReconnectBackoff(min_delay=1, max_delay=10)
+        assert [backoff.next_delay() for _ in range(6)] == [1, 2, 4, 8, 10, 10]
+        assert all(call[0][0] == 0 for call in uniform.call_args_list)
+        backoff.reset()
+        assert backoff.next_delay() == 1
+
+    def test_device_simulate_mqtt_publish_queued(self, mqttclient, mocker):
+        from azext_iot.operations._mqtt import mqtt_client_wrap, mqtt
+
+        wrap = mqtt_client_wrap(mock_target, device_id)
+        mqttclient().publish.return_value = mocker.Mock(rc=mqtt.MQTT_ERR_NO_CONN)
+        wrap._publish(b"1")
+
+        # The client keeps the message and resends it on reconnect, publishing again would duplicate it
+        assert [call[0][1] for call in mqttclient().publish.call_args_list] == [b"1"]
+        assert mqttclient().publish.call_args[1]["qos"] == 1
+
+    def test_device_simulate_http_batches(self, serviceclient):
+        result = subject.iot_simulate_device(
+            fixture_cmd, device_id, mock_target["entity"], msg_count=7, msg_rate=100, burst=7,
+            protocol_type="http", batch_size=3, template='{"seq": {{counter}}}'
+        )
+
+        posts = [call[0] for call in serviceclient.call_args_list if call[0][0].method == "POST"]
+        assert all(post[1]["Content-Type"] == "application/vnd.microsoft.iothub.json" for post in posts)
+        assert [len(json.loads(post[2])) for post in posts] == [3, 3, 1]
+        assert result["messagesSent"] == 7
+        assert result["batches"] == 3
+        assert result["messagesPerBatch"] == 2.3
+
     def test_device_simulate_http_error(self, serviceclient_generic_error):
         with pytest.raises(CLIError):
             subject.iot_simulate_device(
@@ -2568,6 +2987,141 @@ class TestDeviceSimulate:
             )
 
 
+class TestDeviceSimulateFleet:
+    @pytest.fixture()
+    def fleet_device(self, mocker):
+        class FakeDevice(object):
+            instances = []
+
+            def __init__(self, target, device_id, loop, on_ack=None, **kwargs):
+                self.device_id = device_id
+                self.loop = loop
+                self.on_ack = on_ack
+                self.connected = loop.create_future()
+                self.disconnected = False
+                self.pending = 0
+                self.published = []
+                FakeDevice.instances.append(self)
+
+            def connect(self):
+                if self.device_id == "refused":
+                    raise Exception("connection refused")
+
+            def attach(self):
+                self.connected.set_result(0)
+
+            def publish(self, payload):
+                self.published.append(json.loads(payload))
+                self.loop.call_soon(self.on_ack, 0.01)
+                return True
+
+            def misc(self):
+                pass
+
+            def close(self):
+                pass
+
+        mocker.patch("azext_iot.operations._fleet.AsyncMqttDevice", FakeDevice)
+        return FakeDevice
+
+    def test_simulate_fleet_prefix(self, fixture_cmd, fixture_ghcs, fixture_sas, fleet_device):
+        result = subject.iot_simulate_fleet(
+            fixture_cmd, hub_name=mock_target["entity"], device_prefix="sim", device_count=3,
+            msg_count=2, msg_interval=0.01
+        )
+
+        assert [d.device_id for d in fleet_device.instances] == ["sim0", "sim1", "sim2"]
+        assert all(len(d.published) == 2 for d in fleet_device.instances)
+        assert fleet_device.instances[0].published[1]["deviceId"] == "sim0"
+        assert result["connected"] == 3
+        assert result["messagesSent"] == 6
+        assert result["messagesAcked"] == 6
+        assert result["pubackLatencyMs"]["p50"] == 10.0
+
+    def test_simulate_fleet_device_schedules(self, fixture_cmd, fixture_ghcs, fixture_sas, fleet_device, mocker):
+        from azext_iot.operations import _fleet
+
+        schedules = mocker.spy(_fleet, "RateSchedule")
+        result = subject.iot_simulate_fleet(
+            fixture_cmd, hub_name=mock_target["entity"], device_prefix="sim", device_count=3,
+            msg_count=2, msg_interval=0.02
+        )
+
+        # Every device is paced on its own timeline at the per-device rate
+        assert schedules.call_count == 3
+        assert all(call[0][0] == 50 for call in schedules.call_args_list)
+        assert len({id(schedule) for schedule in schedules.spy_return_list}) == 3
+        assert result["skippedSlots"] == 0
+
+    def test_simulate_fleet_connect_failure(self, fixture_cmd, fixture_ghcs, fixture_sas, fleet_device):
+        result = subject.iot_simulate_fleet(
+            fixture_cmd, hub_name=mock_target["entity"], device_ids=["d1", "refused", "d1"],
+            msg_count=1, msg_interval=0.01
+        )
+
+        assert result["devices"] == 2
+        assert result["connected"] == 1
+        assert result["messagesSent"] == 1
+        assert result["connectFailures"] == [{"deviceId": "refused", "error": "connection refused"}]
+
+    @pytest.mark.parametrize(
+        "device_query, device_ids, device_prefix, device_count, mc, mi, cc",
+        [
+            (None, None, None, None, 1, 1, None),
+            ("select * from devices", ["d1"], None, None, 1, 1, None),
+            (None, None, "sim", None, 1, 1, None),
+            (None, ["d1"], None, 2, 1, 1, None),
+            (None, ["d1"], None, None, 0, 1, None),
+            (None, ["d1"], None, None, 1, 0, None),
+            (None, ["d1"], None, None, 1, 1, 0),
+        ],
+    )
+    def test_simulate_fleet_invalid_args(
+        self, fixture_cmd, fixture_ghcs, device_query, device_ids, device_prefix, device_count, mc, mi, cc
+    ):
+        with pytest.raises(CLIError):
+            subject.iot_simulate_fleet(
+                fixture_cmd, hub_name=mock_target["entity"], device_query=device_query, device_ids=device_ids,
+                device_prefix=device_prefix, device_count=device_count, msg_count=mc, msg_interval=mi,
+                connect_concurrency=cc
+            )
+
+    def test_async_mqtt_device_ack(self, mocker, mqttclient):
+        import asyncio
+        from azext_iot.operations._mqtt import AsyncMqttDevice
+
+        client = mqttclient
+        client().publish.return_value = mocker.MagicMock(rc=0, mid=7)
+        client().want_write.return_value = False
+        acks = []
+        loop = asyncio.new_event_loop()
+        try:
+            device = AsyncMqttDevice(mock_target, device_id, loop, on_ack=acks.append)
+            assert device.publish("{}")
+            assert client().publish.call_args[1]["qos"] == 1
+            assert device.pending == 1
+
+            device._on_publish(client(), None, 7)
+            assert device.pending == 0
+            assert len(acks) == 1
+
+            device._on_connect(client(), None, {}, 0)
+            assert device.connected.result() == 0
+            client().subscribe.assert_called_once_with(
+                "devices/{}/messages/devicebound/#".format(device_id), qos=1
+            )
+        finally:
+            loop.close()
+
+    def test_percentiles(self):
+        from azext_iot.operations._fleet import percentiles
+
+        assert percentiles([]) == {}
+        result = percentiles([i / 1000.0 for i in range(1, 101)])
+        assert result == {"p50": 50.0, "p90": 90.0, "p99": 99.0, "max": 100.0}
+        assert percentiles([0.00012, 0.5], points=(50,), scale=1, ndigits=None) == {"p50": 0.00012, "max": 0.5}
+
+
 @pytest.mark.skipif(
     not validate_min_python_version(3, 5, exit_on_fail=False),
     reason="minimum python version not satisfied",
@@ -2582,13 +3136,164 @@ class TestMonitorEvents:
         existing_target["events"]["partition_ids"] = []
         return service_client
 
-    @pytest.mark.parametrize("timeout, exception", [(-1, CLIError)])
+    @pytest.mark.parametrize(
+        "timeout, workers, prefetch, batch_size, exception",
+        [
+            (-1, None, None, None, CLIError),
+            (300, 0, None, None, CLIError),
+            (300, None, -1, None, CLIError),
+            (300, None, None, 0, CLIError),
+            (300, None, 10, 100, CLIError),
+        ],
+    )
     def test_monitor_events_invalid_args(
-        self, fixture_cmd, serviceclient, timeout, exception
+        self, fixture_cmd, serviceclient, timeout, workers, prefetch, batch_size, exception
     ):
         with pytest.raises(exception):
             subject.iot_hub_monitor_events(
-                fixture_cmd, mock_target["entity"], device_id, timeout=timeout
+                fixture_cmd,
+                mock_target["entity"],
+                device_id,
+                timeout=timeout,
+                workers=workers,
+                prefetch=prefetch,
+                batch_size=batch_size,
+            )
+
+    @pytest.mark.parametrize(
+        "aggregate, record",
+        [(10, None), (None, "capture.ndjson")],
+    )
+    def test_monitor_events_workers_per_process_state(self, fixture_cmd, serviceclient, aggregate, record):
+        # Aggregation windows and captures are kept per worker process, so they are rejected with workers
+        with pytest.raises(CLIError, match="monitor worker"):
+            subject.iot_hub_monitor_events(
+                fixture_cmd,
+                mock_target["entity"],
+                device_id,
+                workers=2,
+                aggregate=aggregate,
+                record=record,
+            )
+
+    @pytest.mark.parametrize(
+        "output_file, rotate_size, compress",
+        [(None, 10, False), (None, None, True), ("events.ndjson", 0, False)],
+    )
+    def test_monitor_events_invalid_output_args(
+        self, fixture_cmd, serviceclient, output_file, rotate_size, compress
+    ):
+        with pytest.raises(CLIError):
+            subject.iot_hub_monitor_events(
+                fixture_cmd,
+                mock_target["entity"],
+                device_id,
+                output_file=output_file,
+                rotate_size=rotate_size,
+                compress=compress,
+            )
+
+    @pytest.mark.parametrize(
+        "record, replay, replay_pace",
+        [("events.cap", __file__, None), (None, None, "original"), (None, "missing.cap", None)],
+    )
+    def test_monitor_events_invalid_capture_args(
+        self, fixture_cmd, serviceclient, record, replay, replay_pace
+    ):
+        with pytest.raises(CLIError):
+            subject.iot_hub_monitor_events(
+                fixture_cmd,
+                mock_target["entity"],
+                device_id,
+                record=record,
+                replay=replay,
+                replay_pace=replay_pace,
+            )
+
+
+class TestC2DSendBatch:
+    @pytest.mark.parametrize(
+        "lines, clients, wait",
+        [
+            (['{"deviceId": "d1"}'], 0, False),
+            (['{"deviceId": "d1"}'], None, True),
+            (['{"deviceId": "d1"', ], None, False),
+            (['{"data": "no device"}'], None, False),
+            (['{"deviceId": "d1", "ack": "sometimes"}'], None, False),
+            (['{"deviceId": "d1", "properties": "k=v"}'], None, False),
+            ([""], None, False),
+        ],
+    )
+    def test_c2d_send_batch_invalid_args(self, fixture_cmd, tmpdir, lines, clients, wait):
+        input_file = tmpdir.join("messages.ndjson")
+        input_file.write("\n".join(lines))
+        with pytest.raises(CLIError):
+            subject.iot_c2d_message_send_batch(
+                fixture_cmd, str(input_file), mock_target["entity"], clients=clients, wait_on_feedback=wait
+            )
+
+    def test_c2d_send_batch_records(self, tmpdir):
+        input_file = tmpdir.join("messages.ndjson")
+        input_file.write(
+            '{"deviceId": "d1", "data": {"cmd": "reboot"}, "properties": {"n": 1}, "ack": "full"}\n\n'
+            '{"deviceId": "d2"}\n'
+        )
+        records = subject._load_c2d_batch(str(input_file))
+
+        assert [r["deviceId"] for r in records] == ["d1", "d2"]
+        assert json.loads(records[0]["data"]) == {"cmd": "reboot"}
+        assert records[0]["properties"] == {"n": "1"}
+        assert records[1]["ack"] is None
+
+
+class TestC2DPurge:
+    def test_c2d_purge_fleet(self, fixture_cmd, fixture_ghcs, fixture_sas, mocker, tmpdir):
+        throttled = []
+
+        def send(request, *args, **kwargs):
+            device = request.url.split("/devices/")[1].split("/")[0]
+            if device == "throttled" and not throttled:
+                throttled.append(device)
+                return build_mock_response(mocker, 429, {"error": "throttled"}, headers={"Retry-After": "0"})
+            if device == "missing":
+                return build_mock_response(mocker, 404, {"error": "not found"})
+            if device == "reset":
+                raise ConnectionResetError("connection reset by peer")
+            return build_mock_response(mocker, 200, {"totalMessagesPurged": 2, "deviceId": device})
+
+        service_client = mocker.patch(path_service_client)
+        service_client.side_effect = send
+        id_file = tmpdir.join("devices.txt")
+        id_file.write("# campaign c1\nd1\nthrottled\n\nmissing\nreset\nd1\n")
+
+        result = subject.iot_c2d_message_purge(
+            fixture_cmd, id_file=str(id_file), hub_name=mock_target["entity"], workers=2
+        )
+
+        assert result["devices"] == 4
+        assert result["purgedDevices"] == 2
+        assert result["purgedMessages"] == 4
+        assert result["throttled"] == 1
+        # Failures other than service errors are reported per device instead of aborting the purge
+        failures = {f["deviceId"]: f["error"] for f in result["failedDevices"]}
+        assert sorted(failures) == ["missing", "reset"]
+        assert "connection reset" in failures["reset"]
+        assert service_client.call_count == 5
+
+    @pytest.mark.parametrize(
+        "device_id, device_query, id_file, workers",
+        [
+            (None, None, None, None),
+            ("d1", "select * from devices", None, None),
+            ("d1", None, None, 0),
+            (None, None, "missing.txt", None),
+        ],
+    )
+    def test_c2d_purge_invalid_args(self, fixture_cmd, fixture_ghcs, device_id, device_query, id_file, workers):
+        with pytest.raises(CLIError):
+            subject.iot_c2d_message_purge(
+                fixture_cmd, device_id=device_id, device_query=device_query, id_file=id_file,
+                workers=workers, hub_name=mock_target["entity"]
             )
 
 
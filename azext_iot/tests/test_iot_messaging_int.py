@@ -227,7 +227,7 @@ class TestIoTHubMessaging(IoTLiveScenarioTest):
             "iot device simulate -d {} -n {} -g {} --mc {} --mi {} --data '{}' --rs 'complete'".format(
                 device_ids[0], LIVE_HUB, LIVE_RG, 2, 1, "IoT Ext Test"
             ),
-            checks=self.is_empty(),
+            checks=[self.check("messagesSent", 2)],
         )
 
         # With connection string
@@ -235,14 +235,14 @@ class TestIoTHubMessaging(IoTLiveScenarioTest):
             "iot device simulate -d {} --login {} --mc {} --mi {} --data '{}' --rs 'complete'".format(
                 device_ids[0], LIVE_HUB_CS, 2, 1, "IoT Ext Test"
             ),
-            checks=self.is_empty(),
+            checks=[self.check("messagesSent", 2)],
         )
 
         self.cmd(
             "iot device simulate -d {} -n {} -g {} --mc {} --mi {} --data '{}' --rs 'abandon' --protocol http".format(
                 device_ids[0], LIVE_HUB, LIVE_RG, 2, 1, "IoT Ext Test"
             ),
-            checks=self.is_empty(),
+            checks=[self.check("messagesSent", 2)],
         )
 
         # With connection string
@@ -250,7 +250,7 @@ class TestIoTHubMessaging(IoTLiveScenarioTest):
             "iot device simulate -d {} --login {} --mc {} --mi {} --data '{}' --rs 'abandon' --protocol http".format(
                 device_ids[0], LIVE_HUB_CS, 2, 1, "IoT Ext Test"
             ),
-            checks=self.is_empty(),
+            checks=[self.check("messagesSent", 2)],
         )
 
         self.cmd(
@@ -265,14 +265,14 @@ class TestIoTHubMessaging(IoTLiveScenarioTest):
             "iot device send-d2c-message -d {} -n {} -g {}".format(
                 device_ids[0], LIVE_HUB, LIVE_RG
             ),
-            checks=self.is_empty(),
+            checks=[self.check("messagesAcked", 1)],
         )
 
         self.cmd(
             'iot device send-d2c-message -d {} -n {} -g {} --props "MessageId=12345;CorrelationId=54321"'.format(
                 device_ids[0], LIVE_HUB, LIVE_RG
             ),
-            checks=self.is_empty(),
+            checks=[self.check("messagesAcked", 1)],
         )
 
         # With connection string
@@ -280,7 +280,7 @@ class TestIoTHubMessaging(IoTLiveScenarioTest):
             'iot device send-d2c-message -d {} --login {} --props "MessageId=12345;CorrelationId=54321"'.format(
                 device_ids[0], LIVE_HUB_CS
             ),
-            checks=self.is_empty(),
+            checks=[self.check("messagesAcked", 1)],
         )
 
     @pytest.mark.skipif(
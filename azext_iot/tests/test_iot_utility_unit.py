@@ -1,7 +1,11 @@
+import json
+import uuid
 import pytest
 from knack.util import CLIError
 from azext_iot.common.utility import validate_min_python_version
 from azext_iot.common.deps import ensure_uamqp
+from azext_iot.common.scheduler import RateSchedule
+from azext_iot.common.payload_template import compile_template, default_template
 from azext_iot._validators import mode2_iot_login_handler
 from azext_iot.constants import EVENT_LIB
 
@@ -131,3 +135,124 @@ class TestEnsureUamqp():
             install_args = uamqp_scenario['installer'].call_args
             assert install_args[0][0] == EVENT_LIB[0]
             assert install_args[1]['custom_version'] == '>={},<{}'.format(EVENT_LIB[1], EVENT_LIB[2])
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestRateSchedule():
+    def send_times(self, schedule, clock, count, work=0.0):
+        times = []
+        for _ in range(count):
+            schedule.wait(sleep=clock.sleep)
+            times.append(round(clock.now - 100.0, 6))
+            clock.now += work
+        return times
+
+    def test_fractional_rate_without_drift(self):
+        clock = FakeClock()
+        schedule = RateSchedule(4, clock=clock)
+        # Time spent sending does not push back later messages
+        times = self.send_times(schedule, clock, 9, work=0.1)
+        assert times == [0.0, 0.25, 0.5, 0.75, 1.0, 1.25, 1.5, 1.75, 2.0]
+        report = schedule.report()
+        assert report["requestedRate"] == 4
+        assert report["achievedRate"] == 4
+        assert report["skippedSlots"] == 0
+        assert report["messagesSent"] == 9
+
+    def test_burst(self):
+        clock = FakeClock()
+        schedule = RateSchedule(1, burst=3, clock=clock)
+        assert self.send_times(schedule, clock, 5) == [0.0, 0.0, 0.0, 1.0, 2.0]
+
+    def test_stall_skips_slots_beyond_burst(self):
+        clock = FakeClock()
+        schedule = RateSchedule(1, burst=2, clock=clock)
+        assert self.send_times(schedule, clock, 2) == [0.0, 0.0]
+        clock.now += 5.5
+        # Two messages catch up, the other missed slots are skipped, the half slot is kept
+        assert self.send_times(schedule, clock, 4) == [5.5, 5.5, 6.0, 7.0]
+        assert schedule.skipped == 3
+
+    def test_late_wake_ups_keep_timeline(self):
+        clock = FakeClock()
+        schedule = RateSchedule(2, clock=clock)
+
+        def late_sleep(seconds):
+            clock.now += seconds + 0.01
+
+        times = []
+        for _ in range(5):
+            schedule.wait(sleep=late_sleep)
+            times.append(round(clock.now - 100.0, 6))
+        assert times == [0.0, 0.51, 1.01, 1.51, 2.01]
+        assert schedule.report()["scheduleLagMs"]["max"] == 10.0
+
+    def test_ramp(self):
+        clock = FakeClock()
+        schedule = RateSchedule(2, ramp=4, clock=clock)
+        times = self.send_times(schedule, clock, 7)
+        # 4 messages accrue over the ramp, then one every 0.5 seconds
+        assert times == [0.0, 2.0, 2.828427, 3.464102, 4.0, 4.5, 5.0]
+
+    @pytest.mark.parametrize("rate, burst, ramp", [(0, 1, 0), (1, 0, 0), (1, 1, -1)])
+    def test_invalid(self, rate, burst, ramp):
+        with pytest.raises(ValueError):
+            RateSchedule(rate, burst=burst, ramp=ramp)
+
+
+class TestPayloadTemplate():
+    def test_render(self):
+        template = compile_template(
+            '{"device": "{{deviceId}}", "seq": {{ counter }}, "ts": "{{timestamp}}", "id": "{{uuid}}", '
+            '"level": {{randint:1:3}}, "humidity": {{random:40:60:1}}, "temp": {{walk:20:0.5:19:21}}}'
+        )
+        payloads = [json.loads(p) for p in template.render(600, device_id='dev"1', seed=7)]
+
+        assert len(payloads) == 600
+        assert [p["seq"] for p in payloads] == list(range(1, 601))
+        assert all(p["device"] == 'dev"1' for p in payloads)
+        assert len(set(p["id"] for p in payloads)) == 600
+        assert all(uuid.UUID(p["id"]).version == 4 for p in payloads)
+        assert all(p["ts"].endswith("Z") for p in payloads)
+        assert all(1 <= p["level"] <= 3 for p in payloads)
+        assert all(40 <= p["humidity"] <= 60 for p in payloads)
+        temps = [p["temp"] for p in payloads]
+        assert temps[0] == 20
+        assert all(19 <= t <= 21 for t in temps)
+        # Walks move at most one step between messages, across batch boundaries too
+        assert all(abs(a - b) <= 0.5 + 1e-9 for a, b in zip(temps, temps[1:]))
+
+    def test_renderers_are_independent(self):
+        template = compile_template("{{counter}}")
+        first = template.renderer("d1")
+        second = template.renderer("d2")
+        assert [first(), first(), second()] == [b"1", b"2", b"1"]
+
+    def test_static(self):
+        template = compile_template('{"data": "{not a placeholder}"}')
+        assert template.static
+        assert list(template.render(2)) == [b'{"data": "{not a placeholder}"}'] * 2
+
+    def test_default_template(self):
+        render = default_template('Ping "x"', device_id=True).renderer("sim0")
+        payload = json.loads(render())
+        assert payload["deviceId"] == "sim0"
+        assert payload["data"] == 'Ping "x" #1'
+        assert json.loads(render())["data"] == 'Ping "x" #2'
+
+    @pytest.mark.parametrize(
+        "text", ["{{unknown}}", "{{random:1}}", "{{random:a:b}}", "{{walk:1:2:3:4:5:6}}", "{{counter:1}}"]
+    )
+    def test_invalid(self, text):
+        with pytest.raises(ValueError):
+            compile_template(text)